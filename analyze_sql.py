@@ -1,43 +1,184 @@
 import sqlite3
 
-# check the tables in the database
-con = sqlite3.connect("fk_map")
-cur = con.cursor() 
-cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;")
-available_table = (cur.fetchall())
-
-# number of nodes
-cur.execute("SELECT COUNT(*) FROM nodes;")
-number_nodes = (cur.fetchall())
-
-# number of ways
-cur.execute("SELECT COUNT(*) FROM ways;")
-number_ways = (cur.fetchall())
-
-# number of unique users
-cur.execute("SELECT count(DISTINCT user) as num FROM (SELECT user from nodes union all select user from ways);")
-unique_users = (cur.fetchall())
-
-# number of unique users and their contributions
-cur.execute("SELECT count(user) as num FROM (SELECT user from nodes union all select user from ways) GROUP BY user ORDER BY num DESC;")
-unique_users2 = (cur.fetchall())
-
-# number of rare users 
-cur.execute("SELECT count(user) as num FROM (SELECT user from nodes union all select user from ways) GROUP BY user HAVING num < 4;")
-rare_users = (cur.fetchall())
-
-# top ten amenities
-cur.execute("SELECT value, COUNT(*) as num FROM nodes_tags WHERE key='amenity' GROUP BY value ORDER BY num DESC;")
-top_amenites = (cur.fetchall())
-
-# drinks and food
-cur.execute("SELECT COUNT(*) as num FROM nodes_tags WHERE value='cafe' OR value='fast_food' OR value='bar' or value='pub' OR value ='restaurant';")
-goingout = (cur.fetchall())
-
-# entries in nodes over time 
-cur.execute("SELECT COUNT(*), strftime('%Y', timestamp) as Year FROM nodes Group by year ORDER by year;")
-over_time_nodes = (cur.fetchall())
-
-# entries in ways over time 
-cur.execute("SELECT COUNT(*), strftime('%Y', timestamp) as Year FROM ways Group by year ORDER by year;")
-over_time_ways = (cur.fetchall())
+###############################################################################
+# OPTIMIZE: INDEXES AND PRECOMPUTED AGGREGATES
+###############################################################################
+# The reports below only read small summary tables. They are rebuilt by
+# "optimize" after every load, the indexes speed up the rebuild as well as ad
+# hoc queries on the raw tables.
+
+OPTIMIZE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS nodes_user ON nodes (user);",
+    "CREATE INDEX IF NOT EXISTS ways_user ON ways (user);",
+    "CREATE INDEX IF NOT EXISTS nodes_tags_key_value ON nodes_tags (key, value);",
+    "CREATE INDEX IF NOT EXISTS nodes_tags_value ON nodes_tags (value);",
+    "CREATE INDEX IF NOT EXISTS ways_tags_key_value ON ways_tags (key, value);",
+    "CREATE INDEX IF NOT EXISTS nodes_year ON nodes (strftime('%Y', timestamp));",
+    "CREATE INDEX IF NOT EXISTS ways_year ON ways (strftime('%Y', timestamp));",
+]
+
+# the same for a database with dictionary encoded tags (see load_into_sql.py),
+# the tag indexes are on the integer ids
+ENCODED_OPTIMIZE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS nodes_user ON nodes (user);",
+    "CREATE INDEX IF NOT EXISTS ways_user ON ways (user);",
+    "CREATE INDEX IF NOT EXISTS nodes_tags_encoded_key_value ON nodes_tags_encoded (key_id, value_id);",
+    "CREATE INDEX IF NOT EXISTS nodes_tags_encoded_value ON nodes_tags_encoded (value_id);",
+    "CREATE INDEX IF NOT EXISTS ways_tags_encoded_key_value ON ways_tags_encoded (key_id, value_id);",
+    "CREATE INDEX IF NOT EXISTS nodes_year ON nodes (strftime('%Y', timestamp));",
+    "CREATE INDEX IF NOT EXISTS ways_year ON ways (strftime('%Y', timestamp));",
+]
+
+SUMMARY_TABLES = [
+    # contributions per user over nodes and ways
+    ("user_contributions",
+     "CREATE TABLE user_contributions (user TEXT, nodes INTEGER, ways INTEGER, num INTEGER);",
+     "INSERT INTO user_contributions "
+     "SELECT user, SUM(element = 'node'), SUM(element = 'way'), count(user) "
+     "FROM (SELECT user, 'node' as element from nodes "
+     "union all select user, 'way' from ways) GROUP BY user;",
+     "CREATE INDEX user_contributions_num ON user_contributions (num);"),
+    # number of tags per element type, key and value
+    ("tag_counts",
+     "CREATE TABLE tag_counts (element TEXT, key TEXT, value TEXT, num INTEGER);",
+     "INSERT INTO tag_counts "
+     "SELECT 'node', key, value, COUNT(*) FROM nodes_tags GROUP BY key, value "
+     "union all "
+     "SELECT 'way', key, value, COUNT(*) FROM ways_tags GROUP BY key, value;",
+     "CREATE INDEX tag_counts_key_value ON tag_counts (element, key, value);"),
+    # number of entries per element type and year of the timestamp
+    ("year_counts",
+     "CREATE TABLE year_counts (element TEXT, year TEXT, num INTEGER);",
+     "INSERT INTO year_counts "
+     "SELECT 'node', strftime('%Y', timestamp) as Year, COUNT(*) FROM nodes Group by year "
+     "union all "
+     "SELECT 'way', strftime('%Y', timestamp) as Year, COUNT(*) FROM ways Group by year;",
+     "CREATE INDEX year_counts_year ON year_counts (element, year);"),
+]
+
+# fills of the summary tables that count integer ids in an encoded database
+# and only look up the strings of the groups
+ENCODED_FILLS = {
+    "tag_counts":
+    "INSERT INTO tag_counts "
+    "SELECT 'node', k.key, v.value, SUM(c.num) FROM (SELECT key_id, value_id, COUNT(*) as num "
+    "FROM nodes_tags_encoded GROUP BY key_id, value_id) c "
+    "JOIN tag_keys k ON k.id = c.key_id JOIN tag_values v ON v.id = c.value_id GROUP BY k.key, v.value "
+    "union all "
+    "SELECT 'way', k.key, v.value, SUM(c.num) FROM (SELECT key_id, value_id, COUNT(*) as num "
+    "FROM ways_tags_encoded GROUP BY key_id, value_id) c "
+    "JOIN tag_keys k ON k.id = c.key_id JOIN tag_values v ON v.id = c.value_id GROUP BY k.key, v.value;",
+}
+
+def is_encoded(con):
+    """True if the tags of the database are dictionary encoded"""
+    cur = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='tag_keys';")
+    return cur.fetchone()[0] > 0
+
+def refresh_summaries(con):
+    """Rebuild the summary tables from the raw tables in one transaction"""
+    fills = ENCODED_FILLS if is_encoded(con) else {}
+    with con:
+        for name, create, fill, index in SUMMARY_TABLES:
+            con.execute("DROP TABLE IF EXISTS {0};".format(name))
+            con.execute(create)
+            con.execute(fills.get(name, fill))
+            con.execute(index)
+
+def optimize(con):
+    """Create the indexes and (re)build the summary tables, run after every
+    load of the database"""
+    indexes = ENCODED_OPTIMIZE_INDEXES if is_encoded(con) else OPTIMIZE_INDEXES
+    with con:
+        for index in indexes:
+            con.execute(index)
+    refresh_summaries(con)
+    con.execute("ANALYZE;")
+
+def is_optimized(con):
+    """True if all summary tables exist"""
+    cur = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ({0});".format(
+        ", ".join("'{0}'".format(name) for name, create, fill, index in SUMMARY_TABLES)))
+    return cur.fetchone()[0] == len(SUMMARY_TABLES)
+
+###############################################################################
+# REPORTS
+###############################################################################
+# Every report is a named query with its parameters, so the same set can be
+# run for the reports and timed by benchmark_queries.py. REPORT_QUERIES read
+# the summary tables of "optimize", RAW_QUERIES are the same reports on the
+# raw tables and do not need "optimize". ENCODED_QUERIES are the raw
+# reports for a database with dictionary encoded tags, the RAW_QUERIES work
+# there as well through the views of the tag tables.
+
+GOING_OUT = {"v1": "cafe", "v2": "fast_food", "v3": "bar", "v4": "pub", "v5": "restaurant"}
+
+REPORT_QUERIES = [
+    # check the tables in the database
+    ("available_table", "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;", {}),
+    # number of nodes
+    ("number_nodes", "SELECT COUNT(*) FROM nodes;", {}),
+    # number of ways
+    ("number_ways", "SELECT COUNT(*) FROM ways;", {}),
+    # number of unique users
+    ("unique_users", "SELECT count(user) as num FROM user_contributions;", {}),
+    # number of unique users and their contributions
+    ("unique_users2", "SELECT num FROM user_contributions ORDER BY num DESC;", {}),
+    # number of rare users
+    ("rare_users", "SELECT num FROM user_contributions WHERE num < :max_num;", {"max_num": 4}),
+    # top ten amenities
+    ("top_amenites", "SELECT value, num FROM tag_counts WHERE element='node' AND key=:key ORDER BY num DESC;",
+     {"key": "amenity"}),
+    # drinks and food
+    ("goingout", "SELECT COALESCE(SUM(num), 0) as num FROM tag_counts WHERE element='node' AND value IN (:v1, :v2, :v3, :v4, :v5);",
+     GOING_OUT),
+    # entries in nodes over time
+    ("over_time_nodes", "SELECT num, year FROM year_counts WHERE element='node' ORDER by year;", {}),
+    # entries in ways over time
+    ("over_time_ways", "SELECT num, year FROM year_counts WHERE element='way' ORDER by year;", {}),
+]
+
+RAW_QUERIES = [
+    ("available_table", "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;", {}),
+    ("number_nodes", "SELECT COUNT(*) FROM nodes;", {}),
+    ("number_ways", "SELECT COUNT(*) FROM ways;", {}),
+    ("unique_users", "SELECT count(DISTINCT user) as num FROM (SELECT user from nodes union all select user from ways);", {}),
+    ("unique_users2", "SELECT count(user) as num FROM (SELECT user from nodes union all select user from ways) GROUP BY user ORDER BY num DESC;", {}),
+    ("rare_users", "SELECT count(user) as num FROM (SELECT user from nodes union all select user from ways) GROUP BY user HAVING num < :max_num;",
+     {"max_num": 4}),
+    ("top_amenites", "SELECT value, COUNT(*) as num FROM nodes_tags WHERE key=:key GROUP BY value ORDER BY num DESC;",
+     {"key": "amenity"}),
+    ("goingout", "SELECT COUNT(*) as num FROM nodes_tags WHERE value IN (:v1, :v2, :v3, :v4, :v5);", GOING_OUT),
+    ("over_time_nodes", "SELECT COUNT(*), strftime('%Y', timestamp) as Year FROM nodes Group by year ORDER by year;", {}),
+    ("over_time_ways", "SELECT COUNT(*), strftime('%Y', timestamp) as Year FROM ways Group by year ORDER by year;", {}),
+]
+
+ENCODED_RAW = {
+    # CROSS JOIN looks up the key ids first, sqlite would scan all tags
+    "top_amenites": "SELECT v.value, c.num FROM (SELECT t.value_id, COUNT(*) as num FROM tag_keys k "
+                    "CROSS JOIN nodes_tags_encoded t ON t.key_id = k.id WHERE k.key=:key GROUP BY t.value_id) c "
+                    "JOIN tag_values v ON v.id = c.value_id ORDER BY c.num DESC;",
+    "goingout": "SELECT COUNT(*) as num FROM nodes_tags_encoded "
+                "WHERE value_id IN (SELECT id FROM tag_values WHERE value IN (:v1, :v2, :v3, :v4, :v5));",
+}
+ENCODED_QUERIES = [(name, ENCODED_RAW.get(name, sql), params) for name, sql, params in RAW_QUERIES]
+
+QUERY_SETS = {"reports": REPORT_QUERIES, "raw": RAW_QUERIES, "encoded": ENCODED_QUERIES}
+
+def run_queries(con, queries=REPORT_QUERIES):
+    """Run a query set and return {name: rows}"""
+    cur = con.cursor()
+    results = {}
+    for name, sql, params in queries:
+        cur.execute(sql, params)
+        results[name] = cur.fetchall()
+    return results
+
+if __name__ == '__main__':
+
+    con = sqlite3.connect("fk_map")
+    if not is_optimized(con):
+        optimize(con)
+    results = run_queries(con)
+    for name, rows in results.items():
+        print(name, rows[:10])
@@ -0,0 +1,126 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# APPLY AN OSMCHANGE (.osc) DIFF TO THE SQLITE DATABASE INSTEAD OF CONVERTING
+# AND LOADING THE WHOLE EXTRACT AGAIN.
+#
+# - the .osc file is streamed, its create/modify/delete blocks are applied in
+#   file order
+# - created and modified nodes and ways are shaped and cleaned exactly like in
+#   "parse_to_csv.py" (shape_element and the cleaners of "audit.py") and
+#   replace the element with all its tags and way nodes
+# - deleted nodes and ways are removed with all their tags and way nodes
+# - everything happens in one transaction, a broken diff changes nothing
+# - the summary tables of "analyze_sql.py" are dropped since they are stale,
+#   the next run of the reports rebuilds them
+# - the spatial index of the nodes (if the database has one) is kept up to date
+#
+# Example:
+#   python apply_osc.py 2024-05-01.osc fk_map
+###############################################################################
+
+import argparse
+import sqlite3
+import time
+import schema
+from analyze_sql import SUMMARY_TABLES
+from fast_validator import FastValidator
+from load_into_sql import SPATIAL_INDEX
+from osm_io import osc_records
+from parse_to_csv import shape_element
+from parse_to_csv import validate_element
+
+# element type -> main table and the child tables keyed by the element id
+ELEMENT_TABLES = {
+    'node': ('nodes', [('node_tags', 'nodes_tags')]),
+    'way': ('ways', [('way_nodes', 'ways_nodes'), ('way_tags', 'ways_tags')]),
+}
+
+###############################################################################
+def named_insert(table):
+    """INSERT statement that takes the rows of shape_element"""
+    columns = [name for name, sql_type in schema.sql_schema[table]]
+    return "INSERT INTO {0} ({1}) VALUES ({2});".format(
+        table, ", ".join(columns), ", ".join(":" + c for c in columns))
+
+###############################################################################
+def has_table(cur, name):
+    """True if the database has a table (or virtual table) of that name"""
+    cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?;", (name,))
+    return cur.fetchone()[0] > 0
+
+###############################################################################
+def delete_element(cur, element_type, element_id, spatial=False):
+    """Remove an element with its tags (and way nodes)"""
+    table, children = ELEMENT_TABLES[element_type]
+    cur.execute("DELETE FROM {0} WHERE id = ?;".format(table), (element_id,))
+    for key, child_table in children:
+        cur.execute("DELETE FROM {0} WHERE id = ?;".format(child_table), (element_id,))
+    if spatial and element_type == 'node':
+        cur.execute("DELETE FROM {0} WHERE id = ?;".format(SPATIAL_INDEX), (element_id,))
+
+###############################################################################
+def upsert_element(cur, el, element_type, spatial=False):
+    """Replace an element with the output of shape_element"""
+    table, children = ELEMENT_TABLES[element_type]
+    delete_element(cur, element_type, el[element_type]['id'], spatial)
+    cur.execute(named_insert(table), el[element_type])
+    for key, child_table in children:
+        if el[key]:
+            cur.executemany(named_insert(child_table), el[key])
+    if spatial and element_type == 'node':
+        node = el['node']
+        cur.execute("INSERT INTO {0} VALUES (?, ?, ?, ?, ?);".format(SPATIAL_INDEX),
+                    (node['id'], node['lat'], node['lat'], node['lon'], node['lon']))
+
+###############################################################################
+def apply_osc(osc_file, connection, validate=True):
+    """Apply an OsmChange file to a database in one transaction.
+
+        Args:
+            osc_file: Filename of the .osc file
+            connection: Filename of the sqlite database
+            validate: validate the shaped elements against schema.py
+
+        Output:
+            dict with the number of applied changes per action
+    """
+    con = sqlite3.connect(connection)
+    validator = FastValidator(schema.schema)
+    counts = {'create': 0, 'modify': 0, 'delete': 0}
+    try:
+        with con:
+            cur = con.cursor()
+            spatial = has_table(cur, SPATIAL_INDEX)
+            for action, record in osc_records(osc_file):
+                if record.tag not in ELEMENT_TABLES:
+                    continue
+                if action == 'delete':
+                    delete_element(cur, record.tag, record.attrib['id'], spatial)
+                else:
+                    el = shape_element(record)
+                    if validate:
+                        validate_element(el, validator)
+                    upsert_element(cur, el, record.tag, spatial)
+                counts[action] += 1
+            for name, create, fill, index in SUMMARY_TABLES:
+                cur.execute("DROP TABLE IF EXISTS {0};".format(name))
+    finally:
+        con.close()
+    return counts
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Apply an OsmChange file to the sqlite database")
+    parser.add_argument("osc_file")
+    parser.add_argument("database")
+    parser.add_argument("--no-validate", dest="validate", action="store_false")
+    args = parser.parse_args()
+
+    start = time.time()
+    counts = apply_osc(args.osc_file, args.database, args.validate)
+    print("created {create}, modified {modify}, deleted {delete} elements".format(**counts),
+          "in {0:.1f} s".format(time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -10,9 +10,318 @@
 #
 ###############################################################################
 
-import xml.etree.cElementTree as ET
+import argparse
 import csv
+import heapq
+import os
+import sys
 from collections import Counter
+from osm_io import PARSERS
+from osm_io import detect_parser
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# number of top level elements between two checks of the memory ceiling
+MEMORY_CHECK_EVERY = 10000
+
+###############################################################################
+####### 0. AUDIT ENGINE #######################################################
+###############################################################################
+
+## - EVERY COUNT, ISNOT, ENDS_WITH, STARTS_WITH AND UPDATE CHECK IS A RULE
+## - ALL RULES ARE FED FROM ONE SINGLE PASS OVER THE XML FILE
+## - EACH RULE WRITES ITS OWN CSV FILE WHEN THE PASS IS DONE
+
+###############################################################################
+class AuditRule(object):
+    """Base class of all audit rules. A rule counts values it is fed during
+    the pass and writes them to "outputname" (ordered by number of occurances).
+    Rules with a "kvalue" are only fed tags with that attribute name, rules
+    without one are fed every tag.
+    """
+    kvalue = None
+    header = ["attrib_value", "num"]
+    topx = None
+
+    def __init__(self, outputname):
+        self.outputname = outputname
+        self.counts = Counter()
+
+    def feed_element(self, tag, n):
+        """Called with the name of XML elements and how often they occured"""
+        pass
+
+    def feed_tag(self, k, v):
+        """Called with key and value of every matching "tag" element"""
+        pass
+
+    def rows(self):
+        rows = sorted(self.counts.items(), key = lambda x:x[1], reverse = True)
+        if self.topx is not None:
+            rows = rows[:self.topx]
+        return rows
+
+    def write(self):
+        with open(self.outputname, "w", newline="", encoding = "utf-8") as out:
+            csv_out = csv.writer(out)
+            csv_out.writerow(self.header)
+            csv_out.writerows(self.rows())
+
+
+class CountTags(AuditRule):
+    """Count the names of all XML elements, e.g. "node" or "tag" """
+    header = ["tags", "num"]
+
+    def feed_element(self, tag, n):
+        self.counts[tag] += n
+
+
+class CountKeys(AuditRule):
+    """Count the attribute names (k) of all tags, e.g. "addr:street" """
+    header = ["attrib", "num"]
+
+    def feed_tag(self, k, v):
+        self.counts[k] += 1
+
+
+class SpaceSaving(object):
+    """Approximate top-k counter (Space-Saving, Metwally et al. 2005) that
+    never monitors more than "capacity" distinct values. Once full, a new value
+    takes over the counter of the least frequent one and inherits its count as
+    possible overestimation ("error"). Every estimated count is at most
+    total / capacity too high and every value occuring more often than that is
+    guaranteed to be monitored.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # one (count, value) entry per monitored value, the count may be lower
+        # than the real one and is only refreshed when it reaches the top
+        self.heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, value):
+        self.total += 1
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < self.capacity:
+            counts[value] = 1
+            self.errors[value] = 0
+            heapq.heappush(self.heap, (1, value))
+        else:
+            heap = self.heap
+            while heap[0][0] != counts[heap[0][1]]:
+                heapq.heapreplace(heap, (counts[heap[0][1]], heap[0][1]))
+            minimum, victim = heap[0]
+            del counts[victim]
+            del self.errors[victim]
+            counts[value] = minimum + 1
+            self.errors[value] = minimum
+            heapq.heapreplace(heap, (minimum + 1, value))
+
+    def max_error(self):
+        """Upper bound for the overestimation of any count"""
+        return self.total // self.capacity
+
+    def items(self):
+        """Return (value, estimated count, error) ordered by count"""
+        rows = [(v, c, self.errors[v]) for v, c in self.counts.items()]
+        return sorted(rows, key = lambda x:x[1], reverse = True)
+
+
+class CountKeyValues(AuditRule):
+    """Count all values of the attribute "kvalue", keep the top "topx" """
+
+    def __init__(self, outputname, kvalue, topx):
+        AuditRule.__init__(self, outputname)
+        self.kvalue = kvalue
+        self.topx = topx
+
+    def feed_tag(self, k, v):
+        self.counts[v] += 1
+
+
+class ApproxKeyValues(CountKeyValues):
+    """Like CountKeyValues but counts in a SpaceSaving sketch with at most
+    "capacity" counters, so memory stays fixed for high cardinality keys. The
+    csv file gets a third column with the maximum overestimation of each count
+    """
+    header = ["attrib_value", "num", "max_error"]
+
+    def __init__(self, outputname, kvalue, topx, capacity):
+        CountKeyValues.__init__(self, outputname, kvalue, topx)
+        self.counts = SpaceSaving(capacity)
+
+    def feed_tag(self, k, v):
+        self.counts.add(v)
+
+    def rows(self):
+        return self.counts.items()[:self.topx]
+
+
+class ValueIsNot(AuditRule):
+    """Count values of the attribute "kvalue" that are not in "expected" """
+
+    def __init__(self, outputname, kvalue, expected):
+        AuditRule.__init__(self, outputname)
+        self.kvalue = kvalue
+        self.expected = expected
+
+    def feed_tag(self, k, v):
+        if v not in self.expected:
+            self.counts[v] += 1
+
+
+class ValueEndsWith(AuditRule):
+    """Count values of the attribute "kvalue" that do not end with any of
+    "expected"
+    """
+
+    def __init__(self, outputname, kvalue, expected):
+        AuditRule.__init__(self, outputname)
+        self.kvalue = kvalue
+        self.expected = tuple(expected)
+
+    def feed_tag(self, k, v):
+        if not v.endswith(self.expected):
+            self.counts[v] += 1
+
+
+class ValueStartsWith(AuditRule):
+    """Count values of the attribute "kvalue" that do not start with any of
+    "expected"
+    """
+
+    def __init__(self, outputname, kvalue, expected):
+        AuditRule.__init__(self, outputname)
+        self.kvalue = kvalue
+        self.expected = tuple(expected)
+
+    def feed_tag(self, k, v):
+        if not v.startswith(self.expected):
+            self.counts[v] += 1
+
+
+class UpdatePreview(AuditRule):
+    """Count values of the attribute "kvalue" after applying the cleaning
+    function "update" to them
+    """
+
+    def __init__(self, outputname, kvalue, update):
+        AuditRule.__init__(self, outputname)
+        self.kvalue = kvalue
+        self.update = update
+
+    def feed_tag(self, k, v):
+        self.counts[self.update(v)] += 1
+
+###############################################################################
+def run_audit(filename, rules, max_memory_mb=None, parser='expat'):
+    """Evaluate all audit rules together in one single pass over an XML file
+    and write the csv file of every rule. The file is read as a stream of
+    lightweight records (see osm_io.PARSERS), so memory only grows with the
+    number of distinct values the rules count, not with the size of the file.
+
+        Input: XML file
+
+        Args:
+            filename: Filename of imput XML file
+            rules: a list of AuditRule objects
+            max_memory_mb: optional ceiling in MB for how much the peak
+                memory of the process (ru_maxrss) grows during the audit,
+                it stops with a MemoryError if exceeded. The peak before
+                the audit is the baseline, memory freed since then does
+                not count.
+            parser: name of the parser backend, PBF files always use "pbf"
+
+        Output:
+            one csv file per rule, returns the number of top level elements
+    """
+    element_rules = [r for r in rules if type(r).feed_element is not AuditRule.feed_element]
+    any_key_rules = [r for r in rules if r.kvalue is None and
+                     type(r).feed_tag is not AuditRule.feed_tag]
+    key_rules = {}
+    for rule in rules:
+        if rule.kvalue is not None:
+            key_rules.setdefault(rule.kvalue, []).append(rule)
+
+    parser = detect_parser(filename, parser)
+    # the XML backends count every element of the file, a PBF file has no
+    # XML elements, there they are counted from the records below
+    element_counts = Counter() if element_rules and parser != 'pbf' else None
+    if element_counts is not None:
+        records = PARSERS[parser](filename, None, element_counts=element_counts)
+    else:
+        records = PARSERS[parser](filename, None)
+
+    start_peak = peak_memory_mb() if max_memory_mb is not None else None
+    seen = 0
+    for record in records:
+        if element_rules and element_counts is None:
+            # children end before their parent, count them first
+            for name, n in (("tag", len(record.tags)), ("nd", len(record.nds)),
+                            ("member", len(record.members)), (record.tag, 1)):
+                if n:
+                    for rule in element_rules:
+                        rule.feed_element(name, n)
+        for k, v in record.tags:
+            for rule in any_key_rules:
+                rule.feed_tag(k, v)
+            for rule in key_rules.get(k, ()):
+                rule.feed_tag(k, v)
+        seen += 1
+        if max_memory_mb is not None and seen % MEMORY_CHECK_EVERY == 0:
+            check_memory(max_memory_mb, rules, start_peak)
+    if element_counts is not None:
+        for name, n in element_counts.items():
+            for rule in element_rules:
+                rule.feed_element(name, n)
+    else:
+        # the root element of every .osm file
+        for rule in element_rules:
+            rule.feed_element("osm", 1)
+
+    for rule in rules:
+        rule.write()
+    return seen
+
+###############################################################################
+def peak_memory_mb():
+    """Return the peak resident memory of this process in MB or None if the
+    platform does not report it
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+###############################################################################
+def check_memory(max_memory_mb, rules, start_peak=None):
+    """Raise MemoryError if the peak memory of the process grew by more than
+    "max_memory_mb" since "start_peak" (the peak when the audit started, None
+    checks the peak itself). The peak never goes down, so this is the memory
+    the audit added on top of what the process ever used before. Names the
+    rule holding the most distinct values since that is what still grows
+    """
+    peak = peak_memory_mb()
+    if peak is None or peak - (start_peak or 0.0) <= max_memory_mb:
+        return
+    largest = max(rules, key = lambda r: len(r.counts))
+    raise MemoryError("Audit grew the peak memory by more than {0} MB (peak {1:.0f} MB, "
+                      "{2:.0f} MB at the start), rule for '{3}' holds {4} distinct "
+                      "values".format(max_memory_mb, peak, start_peak or 0.0,
+                                      largest.outputname, len(largest.counts)))
 
 ###############################################################################
 ####### 1. EXPLORE TAGS #######################################################
@@ -24,7 +333,7 @@ from collections import Counter
 ## - GENERALLY JUST GET A FEELING FOR THE DATA
 
 ###############################################################################
-def count_unique_tags(filename, outputname):
+def count_unique_tags(filename, outputname, max_memory_mb=None):
     """Get prevelance of all unique top level tags of an XML file. For example
     "nodes"
 
@@ -33,26 +342,16 @@ def count_unique_tags(filename, outputname):
         Args:
             filename: Filename of imput XML file
             outputname: Filename of output csv file
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of top level node and number
             of occurances (ordered)
         """
-    tags = []
-    for event, element in ET.iterparse(filename):
-        tags.append(element.tag)
-    k = Counter(tags).keys()
-    v = Counter(tags).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-        csv_out = csv.writer(out)
-        csv_out.writerow(["tags", "num"])
-        for row in dic:
-            csv_out.writerow(row)
+    run_audit(filename, [CountTags(outputname)], max_memory_mb)
        
 ###############################################################################
-def count_unique_keys(filename, outputname):
+def count_unique_keys(filename, outputname, max_memory_mb=None):
     """Get prevelance of all unique attributes for the top level tag "tag". For 
     example, "addr:street"
 
@@ -61,28 +360,16 @@ def count_unique_keys(filename, outputname):
         Args:
             filename: Filename of imput XML file
             outputname: Filename of output csv file
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of attribute and number
             of occurances
         """
-    attrib_k = []
-    for event, element in ET.iterparse(filename):      
-       if element.tag == "tag":
-            for tag in element.iter("tag"):
-                attrib_k.append(tag.attrib["k"])
-    k = Counter(attrib_k).keys()
-    v = Counter(attrib_k).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-        csv_out = csv.writer(out)
-        csv_out.writerow(["attrib", "num"])
-        for row in dic:
-            csv_out.writerow(row)
+    run_audit(filename, [CountKeys(outputname)], max_memory_mb)
 
 ###############################################################################
-def count_unique_key_values(filename, outputname, kvalue, topx):
+def count_unique_key_values(filename, outputname, kvalue, topx, capacity=None, max_memory_mb=None):
     """Get prevelance of all values for the attribute x of the tag "tag". For
     example, "Köpenicker Straße" for "addr:street"
     
@@ -93,27 +380,20 @@ def count_unique_key_values(filename, outputname, kvalue, topx):
             outputname: Filename of output csv file
             kvalue: the name of the attribute
             topx: the number of top n values 
+            capacity: if set, count approximately with at most this many
+                counters (use for high cardinality keys such as "name")
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of attribute value and number
-            of occurances
+            of occurances. In approximate mode a third variable gives the
+            maximum overestimation of each number
     """
-    attrib_v = []
-    for event, element in ET.iterparse(filename):
-        if element.tag == "tag":
-            for tag in element.iter("tag"):
-                if element.attrib['k'] == kvalue:
-                    attrib_v.append(element.attrib["v"])
-    k = Counter(attrib_v).keys()
-    v = Counter(attrib_v).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    dic = dic[:topx]
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-       csv_out = csv.writer(out)
-       csv_out.writerow(["attrib_value", "num"])
-       for row in dic:
-           csv_out.writerow(row)
+    if capacity is None:
+        rule = CountKeyValues(outputname, kvalue, topx)
+    else:
+        rule = ApproxKeyValues(outputname, kvalue, topx, capacity)
+    run_audit(filename, [rule], max_memory_mb)
     
 ###############################################################################
 ######### 2. AUDIT TAGS #######################################################
@@ -126,7 +406,7 @@ def count_unique_key_values(filename, outputname, kvalue, topx):
 #   WHICH CORRESPONDING CLEANING FUNCTIONS MUST BE WRITTEN LATER ON
 
 ###############################################################################
-def audit_value_isnot_x(filename, outputname, kvalue, expected):
+def audit_value_isnot_x(filename, outputname, kvalue, expected, max_memory_mb=None):
     """Get prevelance of some values for the attribute x of the tag "tag". 
     Attribute values must match to past the test
 
@@ -137,29 +417,16 @@ def audit_value_isnot_x(filename, outputname, kvalue, expected):
             outputname: Filename of output csv file
             vvalue: the name of the attribute
             expected: a list of accapted values 
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of attribute value and number
             of occurances
     """
-    attrib_v = []
-    for event, element in ET.iterparse(filename):
-        if element.tag == "tag":
-            for tag in element.iter("tag"):
-                if element.attrib['k'] == kvalue and element.attrib["v"] not in expected:
-                    attrib_v.append(element.attrib["v"])
-    k = Counter(attrib_v).keys()
-    v = Counter(attrib_v).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-       csv_out = csv.writer(out)
-       csv_out.writerow(["attrib_value", "num"])
-       for row in dic:
-           csv_out.writerow(row)
+    run_audit(filename, [ValueIsNot(outputname, kvalue, expected)], max_memory_mb)
 
 ###############################################################################
-def audit_value_ends_with_x(filename, outputname, kvalue, expected):
+def audit_value_ends_with_x(filename, outputname, kvalue, expected, max_memory_mb=None):
     """Get prevelance of some values for the attribute x of the tag "tag". 
     Ending of attribute values must match to past the test
 
@@ -170,28 +437,16 @@ def audit_value_ends_with_x(filename, outputname, kvalue, expected):
             outputname: Filename of output csv file
             vvalue: the name of the attribute
             expected: a list of accapted values 
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of attribute value and number
             of occurances
     """    
-    attrib_v = []
-    for event, element in ET.iterparse(filename):
-        if element.tag == "tag":
-            for tag in element.iter("tag"):
-                if element.attrib['k'] == kvalue and not element.attrib["v"].endswith(tuple(expected)):
-                    attrib_v.append(element.attrib["v"])
-    k = Counter(attrib_v).keys()
-    v = Counter(attrib_v).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-       csv_out = csv.writer(out)
-       csv_out.writerow(["attrib_value", "num"])
-       for row in dic:
-           csv_out.writerow(row)
+    run_audit(filename, [ValueEndsWith(outputname, kvalue, expected)], max_memory_mb)
+
 ###############################################################################
-def audit_value_starts_with_x(filename, outputname, kvalue, expected):
+def audit_value_starts_with_x(filename, outputname, kvalue, expected, max_memory_mb=None):
     """Get prevelance of some values for the attribute x of the tag "tag". 
     Starting of attribute values must match to past the test
 
@@ -202,26 +457,14 @@ def audit_value_starts_with_x(filename, outputname, kvalue, expected):
             outputname: Filename of output csv file
             vvalue: the name of the attribute
             expected: a list of accapted values 
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
 
         Output:
             csv file with two variables: name of attribute value and number
             of occurances
     """    
-    attrib_v = []
-    for event, element in ET.iterparse(filename):
-        if element.tag == "tag":
-            for tag in element.iter("tag"):
-                if element.attrib['k'] == kvalue and not element.attrib["v"].startswith(tuple(expected)):
-                    attrib_v.append(element.attrib["v"])
-    k = Counter(attrib_v).keys()
-    v = Counter(attrib_v).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-       csv_out = csv.writer(out)
-       csv_out.writerow(["attrib_value", "num"])
-       for row in dic:
-           csv_out.writerow(row)
+    run_audit(filename, [ValueStartsWith(outputname, kvalue, expected)], max_memory_mb)
+
 ###############################################################################
 ########## 3. WORKFLOW ########################################################
 ###############################################################################
@@ -230,37 +473,40 @@ def audit_value_starts_with_x(filename, outputname, kvalue, expected):
 ## - INCORPORATE UPDATE FUNCTIONS IN AUDIT FUNCTIONS TO TEST THEM
 ## - XML FILE IS NOT UPDATED! INSTEAD DATA IS CORRECTED WHEN CSVs ARE GENERATED
 
+## - THE MAPPINGS ARE BUILT ONCE, parse_to_csv.py CALLS THE UPDATE FUNCTIONS
+##   FOR EVERY MATCHING TAG (THROUGH A CACHE OF THEIR RESULTS)
+
+MAPPING_COUNTRY = {"GE"  : "DE",
+                   "GER" : "DE",
+                   "D"   : "DE"
+               }
+
+MAPPING_CITY = {"BERLIN"        : "Berlin",
+                "Bln."          : "Berlin",
+                "Lichtenberg"   : "Berlin"
+            }
+
+PHONE_PREFIXES = ("1", "2","3","4","5","6","7","8","9")
+
 ###############################################################################
 def update_country(country):
-    """Changes a string to DE if it matches any of "mapping_country"
+    """Changes a string to DE if it matches any of "MAPPING_COUNTRY"
 
        Input: a single string
         
        Output: a single string 
     """      
-    mapping_country = {"GE"  : "DE",
-                       "GER" : "DE",
-                       "D"   : "DE"
-                   }
-    if country in mapping_country:
-            country = country.replace(country, mapping_country[country])
-    return country
+    return MAPPING_COUNTRY.get(country, country)
 
 ###############################################################################
 def update_city(city):
-    """Changes a string to Berlin if it matches any of "mapping_city"
+    """Changes a string to Berlin if it matches any of "MAPPING_CITY"
 
        Input: a single string
         
        Output: a single string 
     """ 
-    mapping_city = {"BERLIN"        : "Berlin",
-                    "Bln."          : "Berlin",
-                    "Lichtenberg"   : "Berlin"
-                }
-    if city in mapping_city:
-            city = city.replace(city, mapping_city[city])
-    return city
+    return MAPPING_CITY.get(city, city)
 
 ###############################################################################
 def update_streetname(streetname):
@@ -296,12 +542,11 @@ def update_phone(phone):
         
        Output: a single string 
     """     
-    prefixes = ["1", "2","3","4","5","6","7","8","9"]
     phone = ''.join(e for e in phone if e.isalnum())
     if not phone.startswith("49") and phone.startswith("01"):
         phone = phone.replace(phone[0], '')
         phone = ''.join(("49", phone))
-    if not phone.startswith("49") and phone.startswith(tuple(prefixes)):
+    if not phone.startswith("49") and phone.startswith(PHONE_PREFIXES):
         phone = ''.join(("4903", phone))
     if phone.startswith("030"):
         phone = phone.replace(phone[:3], "4930")
@@ -318,7 +563,7 @@ update_phone("0174477845")
 update_phone("+49 0174477845")
 
 ###############################################################################
-def audit_update_streetname(filename, outputname):
+def audit_update_streetname(filename, outputname, max_memory_mb=None):
     """Get all values for the attribute addr:street of the tag "tag" and apply 
     cleaning function "update_streetname" to extracted values. 
         
@@ -327,39 +572,18 @@ def audit_update_streetname(filename, outputname):
         Args:
             filename: Filename of imput XML file
             outputname: Filename of output csv file
+            max_memory_mb: optional ceiling for the growth of the peak memory, see run_audit
             
         Output:
             csv file with each value of the attribute "addr:street"
     """    
-    up_streetname = []
-    for event, element in ET.iterparse(filename):
-        if element.tag == "tag":
-            for tag in element.iter("tag"):
-                if element.attrib['k'] == "addr:street":
-                    changed_streetname = update_streetname(tag.attrib['v'])
-                    up_streetname.append(changed_streetname)
-    k = Counter(up_streetname).keys()
-    v = Counter(up_streetname).values()
-    dic = dict(zip(k, v))
-    dic = sorted(dic.items(), key = lambda x:x[1], reverse = True)
-    with open(outputname, "w", newline="", encoding = "utf-8") as out:
-      csv_out = csv.writer(out)
-      csv_out.writerow(["attrib_value", "num"])
-      for row in dic:
-          csv_out.writerow(row)
-###############################################################################
-def main():
-    
-    count_unique_tags("fk.osm", "unique_tags.csv")
-    count_unique_keys("fk.osm", "unique_keys.csv")
+    run_audit(filename, [UpdatePreview(outputname, "addr:street", update_streetname)], max_memory_mb)
 
-    count_unique_key_values("fk.osm", "country_values.csv","addr:country", 100)
-    count_unique_key_values("fk.osm", "city_values.csv","addr:city", 100)
-    count_unique_key_values("fk.osm", "suburb_values.csv","addr:suburb", 100)
-    count_unique_key_values("fk.osm", "postcode_values.csv","addr:postcode", 100)
-    count_unique_key_values("fk.osm", "streetname_values.csv","addr:street", 100,)
-    count_unique_key_values("fk.osm", "phone_values.csv","contact:phone", 100)
-    count_unique_key_values("fk.osm", "email_values.csv","contact:email", 100)
+###############################################################################
+def audit_rules(directory=""):
+    """The checks of the audit of "fk.osm", their csv files are written to
+    "directory" """
+    path = lambda name: os.path.join(directory, name)
 
     expected_country    = ["DE"]
     expected_city       = ["Berlin"]
@@ -372,15 +596,41 @@ def main():
     expected_email      = [".com", ".org", ".de", "net"]
     expected_phone      = ["+49 30", "+49 1"]
 
-    audit_value_isnot_x("fk.osm", "country_audit.csv", "addr:country", expected_country)
-    audit_value_isnot_x("fk.osm", "city_audit.csv", "addr:city", expected_city)
-    audit_value_isnot_x("fk.osm", "suburb_audit.csv", "addr:suburb", expected_suburb)
-    audit_value_isnot_x("fk.osm", "postcode_audit.csv", "addr:postcode", expected_postcode)
-    audit_value_ends_with_x("fk.osm", "streetname_audit.csv", "addr:street", expected_streetname)
-    audit_value_ends_with_x("fk.osm", "phone_audit.csv", "contact:email", expected_email)
-    audit_value_starts_with_x("fk.osm", "email_audit.csv", "contact:phone", expected_phone)
-
-    audit_update_streetname("fk.osm", "streetname_audit_cleaned.csv")
-   
-    if __name__ == '__main__':
-        main()
\ No newline at end of file
+    return [
+        CountTags(path("unique_tags.csv")),
+        CountKeys(path("unique_keys.csv")),
+
+        CountKeyValues(path("country_values.csv"), "addr:country", 100),
+        CountKeyValues(path("city_values.csv"), "addr:city", 100),
+        CountKeyValues(path("suburb_values.csv"), "addr:suburb", 100),
+        CountKeyValues(path("postcode_values.csv"), "addr:postcode", 100),
+        CountKeyValues(path("streetname_values.csv"), "addr:street", 100),
+        CountKeyValues(path("phone_values.csv"), "contact:phone", 100),
+        CountKeyValues(path("email_values.csv"), "contact:email", 100),
+
+        ValueIsNot(path("country_audit.csv"), "addr:country", expected_country),
+        ValueIsNot(path("city_audit.csv"), "addr:city", expected_city),
+        ValueIsNot(path("suburb_audit.csv"), "addr:suburb", expected_suburb),
+        ValueIsNot(path("postcode_audit.csv"), "addr:postcode", expected_postcode),
+        ValueEndsWith(path("streetname_audit.csv"), "addr:street", expected_streetname),
+        ValueEndsWith(path("phone_audit.csv"), "contact:email", expected_email),
+        ValueStartsWith(path("email_audit.csv"), "contact:phone", expected_phone),
+
+        UpdatePreview(path("streetname_audit_cleaned.csv"), "addr:street", update_streetname),
+    ]
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Audit an OSM XML file")
+    parser.add_argument("osm_file", nargs="?", default="fk.osm")
+    parser.add_argument("--max-memory-mb", type=float,
+                        help="stop with MemoryError when the peak memory grows by "
+                        "more than this during the audit")
+    args = parser.parse_args()
+
+    # all checks are evaluated together in one single pass over the file
+    run_audit(args.osm_file, audit_rules(), args.max_memory_mb)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# BENCHMARK EVERY STAGE OF THE PIPELINE, FROM THE .osm FILE TO THE QUERIES.
+#
+# - the input is a .osm file, if it does not exist a synthetic one is written
+#   with "synthetic_osm.py" (and kept for the next run)
+# - the pipeline runs as a list of passes, every pass in a fresh process, so
+#   the peak memory of a pass is its own:
+#     get_element      iterparse pass of parse_to_csv.get_element
+#     convert          parse (expat records), shape_element, validate_element
+#                      and csv_write (CsvSink), timed per batch of elements
+#     process_map      the whole conversion as parse_to_csv.py runs it
+#     load_into_sql    load_csvs of the csv files into a new database
+#     audit            one run_audit pass with the rules of audit.py
+#     queries_raw      the RAW_QUERIES of analyze_sql.py (ENCODED_QUERIES with
+#                      "--encoded", which loads the tags dictionary encoded)
+#     optimize         indexes and summary tables of analyze_sql.py
+#     queries_reports  the REPORT_QUERIES
+# - every stage reports seconds, throughput and the peak memory of its pass,
+#   with "--runs" the fastest run of every stage counts
+# - the report is written as JSON and can be compared with a baseline report
+#   of the same input: stages with less throughput or more memory than the
+#   "--tolerance" allows are regressions and the script exits with status 1
+#
+# Example:
+#   python benchmark_pipeline.py synthetic_1m.osm --elements 1000000 --out baseline.json
+#   python benchmark_pipeline.py synthetic_1m.osm --compare baseline.json
+###############################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from itertools import islice
+from analyze_sql import ENCODED_QUERIES
+from analyze_sql import RAW_QUERIES
+from analyze_sql import REPORT_QUERIES
+from analyze_sql import optimize
+from analyze_sql import run_queries
+from audit import audit_rules
+from audit import peak_memory_mb
+from audit import run_audit
+from load_into_sql import load_csvs
+from osm_io import PARSERS
+from osm_io import detect_parser
+from parse_to_csv import CSV_PATHS
+from parse_to_csv import CsvSink
+from parse_to_csv import SQL_TABLES
+from parse_to_csv import VALIDATE_BATCH
+from parse_to_csv import VALIDATORS
+from parse_to_csv import get_element
+from parse_to_csv import process_map
+from parse_to_csv import shape_element
+from parse_to_csv import shape_rows
+from parse_to_csv import validate_element
+from synthetic_osm import generate
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# size and seed of the synthetic input
+ELEMENTS = 100000
+SEED = 1
+# allowed loss of throughput and growth of memory before a stage is a regression
+TOLERANCE = 0.10
+
+###############################################################################
+def csv_paths(workdir):
+    return [os.path.join(workdir, os.path.basename(path)) for path in CSV_PATHS]
+
+
+def database_path(workdir):
+    return os.path.join(workdir, "benchmark_map")
+
+###############################################################################
+# PASSES
+#
+# Every pass takes (osm_path, workdir, options) and returns
+# {stage: (seconds, items)}, items are what the throughput is counted in.
+###############################################################################
+
+def pass_get_element(osm_path, workdir, options):
+    start = time.perf_counter()
+    count = sum(1 for element in get_element(osm_path))
+    return {"get_element": (time.perf_counter() - start, count)}
+
+
+def pass_convert(osm_path, workdir, options):
+    """The per element functions of parse_to_csv.py on batches of elements"""
+    clock = time.perf_counter
+    seconds = dict.fromkeys(["parse", "shape_element", "validate_element", "csv_write"], 0.0)
+    validator = VALIDATORS[options["validator"]]()
+    records = PARSERS[detect_parser(osm_path, "expat")](osm_path, ("node", "way"))
+    sink = CsvSink(csv_paths(workdir))
+    count = 0
+    while True:
+        t0 = clock()
+        batch = list(islice(records, VALIDATE_BATCH))
+        t1 = clock()
+        seconds["parse"] += t1 - t0
+        if not batch:
+            break
+        shaped = [shape_element(record) for record in batch]
+        t2 = clock()
+        for element in shaped:
+            validate_element(element, validator)
+        t3 = clock()
+        rows = [shape_rows(record) for record in batch]
+        t4 = clock()
+        for element in rows:
+            sink.add(element)
+        t5 = clock()
+        seconds["shape_element"] += t2 - t1
+        seconds["validate_element"] += t3 - t2
+        seconds["csv_write"] += t5 - t4
+        count += len(batch)
+    t0 = clock()
+    sink.close()
+    seconds["csv_write"] += clock() - t0
+    return dict((stage, (s, count)) for stage, s in seconds.items())
+
+
+def pass_process_map(osm_path, workdir, options):
+    summary = process_map(osm_path, True, workers=options["workers"],
+                          validator=options["validator"], pipeline=options["pipeline"],
+                          sink=CsvSink(csv_paths(workdir)), report=None)
+    return {"process_map": (summary["wall_seconds"], summary["elements"])}
+
+
+def pass_load_into_sql(osm_path, workdir, options):
+    start = time.perf_counter()
+    rows = load_csvs(database_path(workdir), list(zip(csv_paths(workdir), SQL_TABLES)),
+                     progress=False, encoded=options["encoded"])
+    return {"load_into_sql": (time.perf_counter() - start, rows)}
+
+
+def pass_audit(osm_path, workdir, options):
+    start = time.perf_counter()
+    count = run_audit(osm_path, audit_rules(workdir))
+    return {"audit": (time.perf_counter() - start, count)}
+
+
+def pass_queries_raw(osm_path, workdir, options):
+    queries = ENCODED_QUERIES if options["encoded"] else RAW_QUERIES
+    return {"queries_raw": time_queries(database_path(workdir), queries)}
+
+
+def pass_optimize(osm_path, workdir, options):
+    con = sqlite3.connect(database_path(workdir))
+    start = time.perf_counter()
+    optimize(con)
+    seconds = time.perf_counter() - start
+    con.close()
+    return {"optimize": (seconds, 1)}
+
+
+def pass_queries_reports(osm_path, workdir, options):
+    return {"queries_reports": time_queries(database_path(workdir), REPORT_QUERIES)}
+
+
+def time_queries(database, queries):
+    con = sqlite3.connect(database)
+    start = time.perf_counter()
+    run_queries(con, queries)
+    seconds = time.perf_counter() - start
+    con.close()
+    return seconds, len(queries)
+
+# the passes in the order they depend on each other
+PASSES = [("get_element", pass_get_element),
+          ("convert", pass_convert),
+          ("process_map", pass_process_map),
+          ("load_into_sql", pass_load_into_sql),
+          ("audit", pass_audit),
+          ("queries_raw", pass_queries_raw),
+          ("optimize", pass_optimize),
+          ("queries_reports", pass_queries_reports)]
+
+###############################################################################
+def children_peak_mb():
+    """Peak resident memory of the largest finished child process in MB or
+    None if the platform does not report it"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def run_child(function, args, conn):
+    try:
+        stages = function(*args)
+        # worker processes of the pass count as well, e.g. of process_map
+        peaks = [peak for peak in (peak_memory_mb(), children_peak_mb()) if peak is not None]
+        conn.send((stages, max(peaks) if peaks else None, None))
+    except BaseException as e:
+        conn.send((None, None, "{0}: {1}".format(type(e).__name__, e)))
+    finally:
+        conn.close()
+
+
+def run_pass(function, osm_path, workdir, options):
+    """Run a pass in a new process.
+
+        Output:
+            ({stage: (seconds, items)}, peak memory of the process in MB)
+    """
+    receive, send = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run_child,
+                                      args=(function, (osm_path, workdir, options), send))
+    process.start()
+    send.close()
+    try:
+        stages, peak, error = receive.recv()
+    except EOFError:
+        stages, peak, error = None, None, "process died"
+    process.join()
+    if error is not None:
+        raise RuntimeError("pass {0} failed: {1}".format(function.__name__, error))
+    return stages, peak
+
+###############################################################################
+def benchmark(osm_path, workdir, passes, runs=1, options=None):
+    """Run the passes "runs" times in order and keep the fastest time of
+    every stage and the largest peak memory of every pass.
+
+        Output:
+            list of dicts with name, pass, seconds, items, items_per_second
+            and peak_mb of every stage
+    """
+    options = dict({"validator": "fast", "workers": 1, "pipeline": False, "encoded": False},
+                   **(options or {}))
+    best = {}
+    order = []
+    for run in range(runs):
+        for name, function in passes:
+            stages, peak = run_pass(function, osm_path, workdir, options)
+            for stage, (seconds, items) in stages.items():
+                entry = best.get(stage)
+                if entry is None:
+                    entry = best[stage] = {"name": stage, "pass": name, "seconds": seconds,
+                                           "items": items, "peak_mb": peak}
+                    order.append(stage)
+                entry["seconds"] = min(entry["seconds"], seconds)
+                if peak is not None:
+                    entry["peak_mb"] = max(entry["peak_mb"] or 0.0, peak)
+    report = []
+    for stage in order:
+        entry = best[stage]
+        entry["items_per_second"] = entry["items"] / entry["seconds"] if entry["seconds"] else None
+        report.append(entry)
+    return report
+
+###############################################################################
+def compare(report, baseline, tolerance=TOLERANCE):
+    """Add the throughput and memory of a baseline report to every stage of
+    "report" with the same name and flag regressions.
+
+        Output:
+            names of the stages that regressed
+    """
+    before = dict((entry["name"], entry) for entry in baseline)
+    regressions = []
+    for entry in report:
+        old = before.get(entry["name"])
+        if old is None:
+            continue
+        entry["baseline_items_per_second"] = old["items_per_second"]
+        entry["baseline_peak_mb"] = old["peak_mb"]
+        entry["speedup"] = entry["items_per_second"] / old["items_per_second"] \
+            if entry["items_per_second"] and old["items_per_second"] else None
+        entry["memory_ratio"] = entry["peak_mb"] / old["peak_mb"] \
+            if entry["peak_mb"] and old["peak_mb"] else None
+        entry["regression"] = bool(
+            (entry["speedup"] is not None and entry["speedup"] < 1.0 - tolerance) or
+            (entry["memory_ratio"] is not None and entry["memory_ratio"] > 1.0 + tolerance))
+        if entry["regression"]:
+            regressions.append(entry["name"])
+    return regressions
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline")
+    parser.add_argument("osm_file", nargs="?",
+                        help="input file, written with synthetic_osm.py if it does not exist")
+    parser.add_argument("--elements", type=int, default=ELEMENTS,
+                        help="size of a synthetic input")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--passes", nargs="+", choices=[name for name, function in PASSES],
+                        help="run only these passes (the later ones need the output of the earlier ones)")
+    parser.add_argument("--validator", choices=sorted(VALIDATORS), default="fast")
+    parser.add_argument("--workers", type=int, default=1, help="workers of the process_map pass")
+    parser.add_argument("--pipeline", action="store_true", help="run the process_map pass pipelined")
+    parser.add_argument("--encoded", action="store_true",
+                        help="load the database with dictionary encoded tags")
+    parser.add_argument("--workdir", help="directory of the csv files and the database, "
+                        "default is a temporary directory that is removed afterwards")
+    parser.add_argument("--out", default="pipeline_benchmark.json")
+    parser.add_argument("--compare", help="JSON report of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="osm_benchmark_")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    osm_path = args.osm_file or os.path.join(
+        workdir, "synthetic_{0}_{1}.osm".format(args.elements, args.seed))
+    synthetic = not os.path.exists(osm_path)
+    if synthetic:
+        generate(osm_path, args.elements, args.seed)
+    input_bytes = os.path.getsize(osm_path)
+    passes = [(name, function) for name, function in PASSES
+              if not args.passes or name in args.passes]
+    try:
+        stages = benchmark(osm_path, workdir, passes, args.runs,
+                           {"validator": args.validator, "workers": args.workers,
+                            "pipeline": args.pipeline, "encoded": args.encoded})
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"input": args.osm_file or "synthetic", "input_bytes": input_bytes,
+              "elements": args.elements if synthetic else None,
+              "seed": args.seed if synthetic else None, "runs": args.runs,
+              "validator": args.validator, "workers": args.workers, "pipeline": args.pipeline,
+              "encoded": args.encoded,
+              "python": platform.python_version(), "stages": stages}
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("input_bytes") != report["input_bytes"]:
+            print("warning: the baseline was run on a different input")
+        regressions = compare(stages, baseline["stages"], args.tolerance)
+        report["baseline"] = args.compare
+        report["regressions"] = regressions
+    with open(args.out, "w", encoding="utf-8") as out:
+        json.dump(report, out, indent=2)
+
+    for entry in stages:
+        line = "{name:17s} {seconds:9.3f} s {items_per_second:12.0f} /s {peak:8.1f} MB".format(
+            peak=entry["peak_mb"] or 0.0, **entry)
+        if entry.get("speedup"):
+            line += "  x{0:.2f}".format(entry["speedup"])
+        if entry.get("regression"):
+            line += "  REGRESSION"
+        print(line)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
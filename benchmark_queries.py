@@ -0,0 +1,121 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# BENCHMARK THE QUERY SETS OF "analyze_sql.py" AGAINST A DATABASE.
+#
+# - every query is run N times, latencies are reported as percentiles
+# - the "EXPLAIN QUERY PLAN" of every query is captured
+# - the report is written as JSON (and CSV) and can be compared with the
+#   report of an earlier run, e.g. before and after adding an index
+#
+# Example:
+#   python benchmark_queries.py fk_map --runs 20 --out after.json --compare before.json
+###############################################################################
+
+import argparse
+import csv
+import json
+import sqlite3
+import time
+from analyze_sql import QUERY_SETS
+
+PERCENTILES = [50, 90, 99]
+
+###############################################################################
+def percentile(sorted_values, p):
+    """Percentile of an already sorted list with linear interpolation"""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+###############################################################################
+def query_plan(con, sql, params):
+    """Return the EXPLAIN QUERY PLAN of a query as a list of lines"""
+    rows = con.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    return [row[-1] for row in rows]
+
+###############################################################################
+def benchmark(database, queries, runs=10, warmup=1):
+    """Run every query "runs" times after "warmup" untimed runs.
+
+        Output:
+            list of dicts with name, sql, params, number of rows, plan and
+            latencies (ms): min, mean, max and the PERCENTILES
+    """
+    con = sqlite3.connect(database)
+    report = []
+    for name, sql, params in queries:
+        for i in range(warmup):
+            con.execute(sql, params).fetchall()
+        timings = []
+        for i in range(runs):
+            start = time.perf_counter()
+            rows = con.execute(sql, params).fetchall()
+            timings.append((time.perf_counter() - start) * 1000.0)
+        timings.sort()
+        entry = {"name": name, "sql": sql, "params": params, "rows": len(rows),
+                 "runs": runs, "plan": query_plan(con, sql, params),
+                 "min_ms": timings[0], "mean_ms": sum(timings) / len(timings),
+                 "max_ms": timings[-1]}
+        for p in PERCENTILES:
+            entry["p{0}_ms".format(p)] = percentile(timings, p)
+        report.append(entry)
+    con.close()
+    return report
+
+###############################################################################
+def compare(report, baseline):
+    """Add the median of a baseline report and the speedup to every entry
+    of "report" with the same name"""
+    before = dict((entry["name"], entry) for entry in baseline)
+    for entry in report:
+        old = before.get(entry["name"])
+        if old is None:
+            continue
+        entry["baseline_p50_ms"] = old["p50_ms"]
+        entry["speedup"] = old["p50_ms"] / entry["p50_ms"] if entry["p50_ms"] else None
+        entry["plan_changed"] = old["plan"] != entry["plan"]
+    return report
+
+###############################################################################
+def write_csv(report, filename):
+    """Write the report without the plans as csv file"""
+    fields = ["name", "rows", "runs", "min_ms", "mean_ms", "max_ms"] + \
+             ["p{0}_ms".format(p) for p in PERCENTILES] + \
+             ["baseline_p50_ms", "speedup", "plan_changed"]
+    with open(filename, "w", newline="", encoding="utf-8") as out:
+        writer = csv.DictWriter(out, fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(report)
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the queries of analyze_sql.py")
+    parser.add_argument("database")
+    parser.add_argument("--queries", choices=sorted(QUERY_SETS), default="reports")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--out", default="query_benchmark.json")
+    parser.add_argument("--csv", help="also write the report as csv file")
+    parser.add_argument("--compare", help="JSON report of an earlier run")
+    args = parser.parse_args()
+
+    report = benchmark(args.database, QUERY_SETS[args.queries], args.runs)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    with open(args.out, "w", encoding="utf-8") as out:
+        json.dump(report, out, indent=2)
+    if args.csv:
+        write_csv(report, args.csv)
+
+    for entry in report:
+        line = "{name:20s} p50 {p50_ms:9.3f} ms  p99 {p99_ms:9.3f} ms".format(**entry)
+        if entry.get("speedup"):
+            line += "  x{0:.1f}".format(entry["speedup"])
+        print(line)
+
+if __name__ == '__main__':
+    main()
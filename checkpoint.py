@@ -0,0 +1,109 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# CHECKPOINTS OF LONG CONVERSIONS IN "parse_to_csv.py".
+#
+# - while process_map converts a file block by block (osm_io.element_blocks)
+#   it writes a checkpoint every CHECKPOINT_SECONDS: the offset in the input
+#   where the next block starts, the last element before it and the sizes of
+#   the five csv files after everything up to there was flushed
+# - the checkpoint is written to a temporary file and renamed, so there is
+#   always one complete checkpoint, it is removed when the run finishes
+# - a resumed run cuts the csv files back to the sizes of the checkpoint and
+#   continues reading at its offset, which gives the same files as one
+#   uninterrupted run
+#
+# Example:
+#   python parse_to_csv.py fk.osm --checkpoint    write checkpoints
+#   python parse_to_csv.py fk.osm --resume        continue after a crash
+###############################################################################
+
+import json
+import os
+import time
+
+# default filename of the checkpoint
+CHECKPOINT_PATH = "process_map.checkpoint.json"
+# seconds between two checkpoints
+CHECKPOINT_SECONDS = 60
+
+
+def input_info(file_in):
+    """Name, size and modification time of the input file, a checkpoint is
+    only used for the same file"""
+    status = os.stat(file_in)
+    return {'file': os.path.abspath(file_in), 'size': status.st_size,
+            'mtime': int(status.st_mtime)}
+
+
+class Checkpoint(object):
+    """Write the checkpoints of one run to "path".
+
+        checkpoint = Checkpoint("process_map.checkpoint.json", info)
+        ...
+        if checkpoint.due():
+            checkpoint.save(offset, last_element, sink.positions())
+
+    "info" is stored with every checkpoint (input file, options, csv files)
+    and compared by load_checkpoint before a run is resumed.
+    """
+
+    def __init__(self, path, info, interval=CHECKPOINT_SECONDS):
+        self.path = path
+        self.info = info
+        self.interval = interval
+        self.saved = time.perf_counter()
+        self.count = 0
+
+    def due(self):
+        return time.perf_counter() - self.saved >= self.interval
+
+    def save(self, offset, last_element, positions):
+        """Record that the input up to "offset" is in the outputs, which end
+        at "positions" (bytes of each csv file)"""
+        state = dict(self.info, offset=offset, last_element=last_element,
+                     positions=positions, saved=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            json.dump(state, out, indent=2)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+        self.saved = time.perf_counter()
+        self.count += 1
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_checkpoint(path, info):
+    """Read a checkpoint written by Checkpoint.save.
+
+        Args:
+            path: Filename of the checkpoint
+            info: the info of the new run, it must match the checkpoint
+                  except for the csv files, which come from the checkpoint
+
+        Output:
+            the checkpoint as dict or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        state = json.load(f)
+    for name, value in info.items():
+        if name != 'paths' and state.get(name) != value:
+            raise ValueError("checkpoint {0} was written with {1}={2!r}, not {3!r}".format(
+                path, name, state.get(name), value))
+    return state
+
+
+def truncate_outputs(paths, positions):
+    """Cut the output files back to the sizes of a checkpoint"""
+    for path, position in zip(paths, positions):
+        if not os.path.exists(path) or os.path.getsize(path) < position:
+            raise ValueError("{0} is shorter than at the checkpoint, it can not be resumed".format(path))
+    for path, position in zip(paths, positions):
+        with open(path, 'r+b') as f:
+            f.truncate(position)
@@ -0,0 +1,242 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# BYTE OFFSET INDEX OF THE TOP LEVEL ELEMENTS OF A .osm FILE.
+#
+# - "build_index" scans the file once and writes (type, id, offset, length)
+#   of every node, way and relation into a compact binary index file
+#   ("fk.osm.idx" next to "fk.osm", 21 bytes per element)
+# - the index is sorted by type and id and memory mapped by "ElementIndex",
+#   any element or id range is found by binary search and read with a seek,
+#   no matter where it is in the file
+# - elements are handed out as raw XML bytes or parsed into the OsmRecords
+#   of "osm_io.py" (or shaped with shape_element of "parse_to_csv.py")
+# - for .gz and .bz2 files the offsets are positions in the decompressed XML,
+#   reading them seeks by decompressing, so requests are best made in file
+#   order (records_at sorts them)
+#
+# Example:
+#   python element_index.py fk.osm                  build fk.osm.idx
+#   python element_index.py fk.osm --show way 4711  print one element
+###############################################################################
+
+import argparse
+import io
+import os
+import struct
+import numpy as np
+from osm_io import ELEMENT_ID
+from osm_io import PARSERS
+from osm_io import OSM_END
+from osm_io import SCAN_BLOCK
+from osm_io import is_pbf
+from osm_io import open_osm
+# element type -> type code in the index, the index is sorted in this order
+ELEMENT_TYPES = ('node', 'way', 'relation')
+TYPE_CODES = dict((name.encode(), code) for code, name in enumerate(ELEMENT_TYPES))
+# one entry of the index
+INDEX_DTYPE = np.dtype([('type', 'u1'), ('id', '<i8'), ('offset', '<u8'), ('length', '<u4')])
+# file header: magic, size of the indexed .osm file and number of entries
+INDEX_MAGIC = b'OSMIDX1\0'
+INDEX_HEADER = struct.Struct('<8sQQ')
+# elements further apart than this are read with separate seeks
+MAX_GAP = 64 * 1024
+# most bytes read and parsed at once
+MAX_SPAN = 16 * 1024 * 1024
+
+
+def index_path(osm_path):
+    """Default filename of the index of a .osm file"""
+    return osm_path + '.idx'
+
+###############################################################################
+def scan_elements(osm_path):
+    """Find all top level elements of a .osm file.
+
+        Output:
+            (types, ids, starts, end) with one entry per element in file order
+            and the offset of "</osm>" where the last element ends
+    """
+    types, ids, starts = [], [], []
+    with open_osm(osm_path) as osm_file:
+        carry = b''
+        carry_start = 0
+        while True:
+            block = osm_file.read(SCAN_BLOCK)
+            data = carry + block
+            # the last element of a block may be cut, it is scanned again
+            # together with the next block
+            last = len(data) if not block else data.rfind(b'<')
+            for match in ELEMENT_ID.finditer(data, 0, max(last, 0)):
+                if match.group(2) is None:
+                    raise ValueError("{0} at byte {1} has no id".format(
+                        match.group(1).decode(), carry_start + match.start()))
+                types.append(TYPE_CODES[match.group(1)])
+                ids.append(int(match.group(2)))
+                starts.append(carry_start + match.start())
+            if not block:
+                break
+            carry = data[last:] if last >= 0 else b''
+            carry_start += len(data) - len(carry)
+    # the end of a file is always in the last carry
+    pos = data.rfind(OSM_END)
+    end = carry_start + (pos if pos >= 0 else len(data))
+    return types, ids, starts, end
+
+###############################################################################
+def build_index(osm_path, path=None):
+    """Write the byte offset index of a .osm file.
+
+        Args:
+            osm_path: Filename of the .osm file
+            path: Filename of the index, default is index_path(osm_path)
+
+        Output:
+            number of indexed elements
+    """
+    if is_pbf(osm_path):
+        raise ValueError("{0} is a PBF file, only XML files can be indexed".format(osm_path))
+    path = path or index_path(osm_path)
+    types, ids, starts, end = scan_elements(osm_path)
+    index = np.empty(len(ids), dtype=INDEX_DTYPE)
+    index['type'] = types
+    index['id'] = ids
+    index['offset'] = starts
+    # an element reaches up to the next one (or "</osm>")
+    index['length'] = np.diff(np.append(index['offset'], end))
+    index = index[np.lexsort((index['id'], index['type']))]
+    with open(path, 'wb') as out:
+        out.write(INDEX_HEADER.pack(INDEX_MAGIC, os.path.getsize(osm_path), len(index)))
+        index.tofile(out)
+    return len(index)
+
+
+class ElementIndex(object):
+    """Random access to the elements of a .osm file through its index.
+
+        index = ElementIndex("fk.osm")
+        index.get("way", 4711)            OsmRecord of one element
+        index.raw("node", 1)              its XML text as bytes
+        index.get_range("node", 1, 999)   OsmRecords of an id range
+    """
+
+    def __init__(self, osm_path, path=None, parser='expat'):
+        self.osm_path = osm_path
+        self.path = path or index_path(osm_path)
+        self.parser = parser
+        with open(self.path, 'rb') as f:
+            magic, size, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError("{0} is not an element index".format(self.path))
+        if size != os.path.getsize(osm_path):
+            raise ValueError("{0} is out of date, rebuild it with build_index".format(self.path))
+        if count:
+            self.index = np.memmap(self.path, dtype=INDEX_DTYPE, mode='r',
+                                   offset=INDEX_HEADER.size, shape=(count,))
+        else:
+            self.index = np.empty(0, dtype=INDEX_DTYPE)
+        # first and last+1 position of every element type in the index
+        bounds = np.searchsorted(self.index['type'], np.arange(len(ELEMENT_TYPES) + 1))
+        self.type_slices = dict((name, (bounds[code], bounds[code + 1]))
+                                for code, name in enumerate(ELEMENT_TYPES))
+        self.osm_file = open_osm(osm_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self.osm_file.close()
+
+    def count(self, element_type):
+        """Number of elements of a type"""
+        lo, hi = self.type_slices[element_type]
+        return hi - lo
+
+    def positions(self, element_type, first_id, last_id):
+        """Positions in the index of the elements of a type with
+        first_id <= id <= last_id"""
+        lo, hi = self.type_slices[element_type]
+        ids = self.index['id'][lo:hi]
+        return np.arange(lo + np.searchsorted(ids, first_id, 'left'),
+                         lo + np.searchsorted(ids, last_id, 'right'))
+
+    def locate(self, element_type, element_id):
+        """(offset, length) of an element or None if it is not in the file"""
+        found = self.positions(element_type, element_id, element_id)
+        if not len(found):
+            return None
+        entry = self.index[found[0]]
+        return int(entry['offset']), int(entry['length'])
+
+    def read(self, offset, length):
+        self.osm_file.seek(offset)
+        return self.osm_file.read(length)
+
+    def raw(self, element_type, element_id):
+        """XML text of an element as bytes or None"""
+        location = self.locate(element_type, element_id)
+        if location is None:
+            return None
+        return self.read(*location).rstrip()
+
+    def parse(self, data):
+        """Parse the XML bytes of top level elements into OsmRecords"""
+        return list(PARSERS[self.parser](io.BytesIO(b'<osm>' + data + b'</osm>'), ELEMENT_TYPES))
+
+    def get(self, element_type, element_id):
+        """OsmRecord of an element or None"""
+        data = self.raw(element_type, element_id)
+        if data is None:
+            return None
+        return self.parse(data)[0]
+
+    def records_at(self, positions):
+        """Yield the OsmRecords at the given positions of the index in file
+        order. Elements close to each other in the file are read together, so
+        compressed files are only read front to back once."""
+        entries = np.sort(self.index[np.asarray(positions, dtype=np.int64)], order='offset')
+        i = 0
+        while i < len(entries):
+            # grow a span of nearby elements and parse it in one go
+            j = i + 1
+            span_end = int(entries[i]['offset']) + int(entries[i]['length'])
+            while j < len(entries) and int(entries[j]['offset']) - span_end <= MAX_GAP and \
+                    span_end - int(entries[i]['offset']) < MAX_SPAN:
+                span_end = int(entries[j]['offset']) + int(entries[j]['length'])
+                j += 1
+            start = int(entries[i]['offset'])
+            records = self.parse(self.read(start, span_end - start))
+            if len(records) == j - i:
+                for record in records:
+                    yield record
+            else:
+                wanted = set(zip(entries['type'][i:j].tolist(), entries['id'][i:j].tolist()))
+                for record in records:
+                    if (ELEMENT_TYPES.index(record.tag), int(record.attrib['id'])) in wanted:
+                        yield record
+            i = j
+
+    def get_range(self, element_type, first_id, last_id):
+        """Yield the OsmRecords of a type with first_id <= id <= last_id"""
+        return self.records_at(self.positions(element_type, first_id, last_id))
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the byte offset index of a .osm file")
+    parser.add_argument("osm_file")
+    parser.add_argument("--index", help="filename of the index, default is OSM_FILE.idx")
+    parser.add_argument("--show", nargs=2, metavar=("TYPE", "ID"),
+                        help="print one element instead of building the index")
+    args = parser.parse_args()
+
+    if args.show:
+        index = ElementIndex(args.osm_file, args.index)
+        data = index.raw(args.show[0], int(args.show[1]))
+        index.close()
+        print(data.decode('utf-8') if data is not None else "not found")
+    else:
+        count = build_index(args.osm_file, args.index)
+        print("indexed {0} elements".format(count))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# A SMALL VALIDATOR THAT IS COMPILED ONCE FROM A CERBERUS STYLE SCHEMA (SEE
+# "schema.py") INTO ONE CHECK FUNCTION PER FIELD.
+#
+# - supports the "required", "type", "coerce" and "schema" rules used by
+#   "schema.py" with the same semantics and error messages as cerberus
+# - unknown fields and None values are reported like cerberus does
+# - the document itself is never changed, coerced values are only checked
+# - can be used in place of cerberus.Validator() in "validate_element" and
+#   validates many shaped elements at a time with "validate_batch"
+# - "row_checker" checks the rows of parse_to_csv.ShapedElement (tuples in
+#   the order of the csv fields) without building any dict
+###############################################################################
+
+from collections.abc import Mapping
+from collections.abc import Sequence
+
+# type name of the schema -> check of an (already coerced) value
+TYPE_CHECKS = {
+    'boolean': lambda v: isinstance(v, bool),
+    'dict': lambda v: isinstance(v, Mapping),
+    'float': lambda v: isinstance(v, (float, int)),
+    'integer': lambda v: isinstance(v, int),
+    'list': lambda v: isinstance(v, Sequence) and not isinstance(v, str),
+    'number': lambda v: isinstance(v, (float, int)) and not isinstance(v, bool),
+    'string': lambda v: isinstance(v, str),
+}
+
+# error messages of cerberus
+NULL_MESSAGE = 'null value not allowed'
+REQUIRED_MESSAGE = 'required field'
+UNKNOWN_MESSAGE = 'unknown field'
+TYPE_MESSAGE = 'must be of {0} type'
+COERCE_MESSAGE = "field '{0}' cannot be coerced: {1}"
+
+###############################################################################
+def compile_rules(field, rules, nested):
+    """Return a function that checks one value against the "rules" of a field
+    and returns a list of error messages or None if the value is valid.
+    "nested" tells if the field is part of a sub document, for those cerberus
+    reports coercion errors after the other errors
+    """
+    type_name = rules.get('type')
+    type_check = TYPE_CHECKS[type_name] if type_name else (lambda v: True)
+    type_message = TYPE_MESSAGE.format(type_name)
+    coerce = rules.get('coerce')
+
+    if 'schema' in rules and type_name == 'dict':
+        sub_check = compile_mapping(rules['schema'], True)
+    elif 'schema' in rules and type_name == 'list':
+        sub_check = compile_sequence(rules['schema'])
+    else:
+        sub_check = None
+
+    def check_value(value):
+        if value is None:
+            return [NULL_MESSAGE]
+        if not type_check(value):
+            return [type_message]
+        if sub_check is not None:
+            errors = sub_check(value)
+            if errors:
+                return [errors]
+        return None
+
+    if coerce is None:
+        return check_value
+
+    def check_coerced(value):
+        try:
+            coerced = coerce(value)
+        except Exception as e:
+            message = COERCE_MESSAGE.format(field, e)
+            errors = check_value(value) or []
+            return errors + [message] if nested else [message] + errors
+        return check_value(coerced)
+
+    return check_coerced
+
+###############################################################################
+def compile_mapping(schema, nested):
+    """Return a function that checks a dict against a schema and returns the
+    errors in the format of cerberus' "errors" or None if the dict is valid
+    """
+    checks = dict((field, compile_rules(field, rules, nested))
+                  for field, rules in schema.items())
+    required = [field for field, rules in schema.items() if rules.get('required')]
+
+    def check(document):
+        errors = None
+        for field, value in document.items():
+            check_field = checks.get(field)
+            messages = check_field(value) if check_field else [UNKNOWN_MESSAGE]
+            if messages:
+                if errors is None:
+                    errors = {}
+                errors[field] = messages
+        for field in required:
+            if field not in document:
+                if errors is None:
+                    errors = {}
+                errors[field] = [REQUIRED_MESSAGE]
+        if errors is None:
+            return None
+        return dict(sorted(errors.items()))
+
+    return check
+
+###############################################################################
+def compile_sequence(item_rules):
+    """Return a function that checks every item of a list against
+    "item_rules" and returns {index: errors} or None
+    """
+    # items are checked like fields named after their index, which only
+    # matters for the message of a failed coercion
+    if item_rules.get('coerce') is None:
+        single = compile_rules(None, item_rules, True)
+        item_check = lambda index: single
+    else:
+        checks = {}
+        def item_check(index):
+            if index not in checks:
+                checks[index] = compile_rules(index, item_rules, True)
+            return checks[index]
+
+    def check(items):
+        errors = None
+        for index, item in enumerate(items):
+            messages = item_check(index)(item)
+            if messages:
+                if errors is None:
+                    errors = {}
+                errors[index] = messages
+        return errors
+
+    return check
+
+
+###############################################################################
+def compile_row(schema, fields):
+    """Return a function that tells if a tuple with the values of "fields"
+    (in this order) is valid against the schema of a dict. It only answers
+    True or False, the errors of an invalid row come from "validate"
+    """
+    unknown = lambda v: [UNKNOWN_MESSAGE]
+    checks = [compile_rules(field, schema[field], True) if field in schema else unknown
+              for field in fields]
+    missing = any(rules.get('required') and field not in fields
+                  for field, rules in schema.items())
+
+    def check(row):
+        if missing or len(row) != len(checks):
+            return False
+        for check_value, value in zip(checks, row):
+            if check_value(value):
+                return False
+        return True
+
+    return check
+
+
+class FastValidator(object):
+    """Drop-in replacement for cerberus.Validator() for "validate_element".
+    The schema is compiled on first use (or given right away) and cached, so
+    "validate" only runs the compiled checks.
+    """
+
+    def __init__(self, schema=None):
+        self.schema = None
+        self.check = None
+        self.row_checks = {}
+        self.errors = {}
+        if schema is not None:
+            self.compile(schema)
+
+    def compile(self, schema):
+        self.schema = schema
+        self.check = compile_mapping(schema, False)
+        self.row_checks = {}
+
+    def row_checker(self, name, fields):
+        """Compiled check of the rows of the sub document "name" of the
+        schema (e.g. "node" or "node_tags") given as tuples of "fields" """
+        key = (name, tuple(fields))
+        if key not in self.row_checks:
+            rules = self.schema[name]
+            if rules.get('type') == 'list':
+                rules = rules['schema']
+            self.row_checks[key] = compile_row(rules['schema'], fields)
+        return self.row_checks[key]
+
+    def validate(self, document, schema=None):
+        """Return True if "document" is valid, otherwise set "errors" and
+        return False"""
+        if schema is not None and schema is not self.schema:
+            self.compile(schema)
+        if not isinstance(document, Mapping):
+            raise ValueError("'{0}' is not a document, must be a dict".format(document))
+        errors = self.check(document)
+        self.errors = errors or {}
+        return errors is None
+
+    def validate_batch(self, documents):
+        """Validate many documents at a time and return a list of
+        (index, errors) for the invalid ones"""
+        check = self.check
+        invalid = []
+        for index, document in enumerate(documents):
+            errors = check(document)
+            if errors is not None:
+                invalid.append((index, errors))
+        return invalid
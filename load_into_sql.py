@@ -2,36 +2,259 @@
 # WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
 ###############################################################################
 # This script loads csv files into a local sqlite database
+#
+# With "--encoded" the tag tables are dictionary encoded: every (key, type)
+# and every value is interned once in tag_keys and tag_values while loading
+# and nodes_tags/ways_tags become views over tables of integer ids.
+# Triggers on the views intern new strings, so "apply_osc.py" and the
+# queries of "analyze_sql.py" work on both kinds of databases.
 
 # -*- coding: utf-8 -*-
-import csv, sqlite3, pandas as pd
+import argparse, csv, sqlite3, sys, time
+from itertools import islice
+import schema
+from analyze_sql import SUMMARY_TABLES
+from analyze_sql import is_encoded
+
+# csv files written by parse_to_csv.py and their tables
+CSV_TABLES = [("nodes.csv", "nodes"),
+              ("nodes_tags.csv", "nodes_tags"),
+              ("ways.csv", "ways"),
+              ("ways_nodes.csv", "ways_nodes"),
+              ("ways_tags.csv", "ways_tags")]
+
+# number of csv rows read, inserted and committed at a time
+CHUNK_ROWS = 100000
+
+# settings for a fast bulk load, the database is rebuilt from scratch anyway
+LOAD_PRAGMAS = ["PRAGMA journal_mode = OFF",
+                "PRAGMA synchronous = OFF",
+                "PRAGMA temp_store = MEMORY",
+                "PRAGMA cache_size = -262144",
+                "PRAGMA locking_mode = EXCLUSIVE"]
+
+# R*Tree over the node coordinates, each node is a box of zero size. It is
+# filled from the nodes table after the load, queries are in "spatial.py"
+SPATIAL_INDEX = "nodes_rtree"
+
+# view of an encoded tag table with the columns of the plain one, and the
+# triggers that turn inserts and deletes on the view into ones on the ids
+TAG_VIEW = ("CREATE VIEW {0} AS SELECT t.id AS id, k.key AS key, v.value AS value, k.type AS type "
+            "FROM {1} t JOIN tag_keys k ON k.id = t.key_id JOIN tag_values v ON v.id = t.value_id;")
+TAG_TRIGGERS = [
+    "CREATE TRIGGER {0}_insert INSTEAD OF INSERT ON {0} BEGIN "
+    "INSERT OR IGNORE INTO tag_keys (key, type) VALUES (NEW.key, NEW.type); "
+    "INSERT OR IGNORE INTO tag_values (value) VALUES (NEW.value); "
+    "INSERT INTO {1} (id, key_id, value_id) VALUES (NEW.id, "
+    "(SELECT id FROM tag_keys WHERE key IS NEW.key AND type IS NEW.type), "
+    "(SELECT id FROM tag_values WHERE value IS NEW.value)); END;",
+    "CREATE TRIGGER {0}_delete INSTEAD OF DELETE ON {0} BEGIN "
+    "DELETE FROM {1} WHERE id = OLD.id "
+    "AND key_id IN (SELECT id FROM tag_keys WHERE key IS OLD.key AND type IS OLD.type) "
+    "AND value_id IN (SELECT id FROM tag_values WHERE value IS OLD.value); END;",
+]
 
 # Option1 using pandas which requires to actually read the data
 def csv_to_sql(filename, connection, tablename):
+    import pandas as pd
     df    = pd.read_csv(filename, encoding = "utf-8")
     con   = sqlite3.connect(connection)
     df.to_sql(tablename, con, index = False)
-    del df    
-    con.close()  
-    
-csv_to_sql("nodes.csv", "fk_map", "nodes")
-csv_to_sql("nodes_tags.csv", "fk_map", "nodes_tags")
-csv_to_sql("ways.csv", "fk_map", "ways")
-csv_to_sql("ways_nodes.csv", "fk_map", "ways_nodes")
-csv_to_sql("ways_tags.csv", "fk_map", "ways_tags")
-
-# Option2 for large files (only nodes.csv as example)
-con = sqlite3.connect("fk_map")
-cur = con.cursor()
-cur.execute("CREATE TABLE nodes (id, lat, lon, user, uid, version, changeset, timestamp);")
-
-with open("nodes.csv","rb") as fin: 
-    dr = csv.DictReader(fin) 
-    to_db = [(i['id'], i['lat'], i['lon'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-
-cur.executemany("INSERT INTO nodes (id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", to_db)
-con.commit()
-con.close()
-
-
- 
+    del df
+    con.close()
+
+# Option2 for large files, streams the csv files in chunks into typed tables
+def create_tables(con, tables=None, encoded=False):
+    """(Re)create the typed tables of schema.sql_schema. The summary tables
+    of analyze_sql.py are dropped as well, they are stale after a new load.
+    With "encoded" the tag tables are views over the dictionary encoded
+    tables of schema.sql_encoded_schema."""
+    for name, create, fill, index in SUMMARY_TABLES:
+        con.execute("DROP TABLE IF EXISTS {0};".format(name))
+    con.execute("DROP TABLE IF EXISTS {0};".format(SPATIAL_INDEX))
+    tables = tables or list(schema.sql_schema)
+    for table in tables:
+        drop_table(con, table)
+        if table in schema.sql_encoded_tags:
+            drop_table(con, schema.sql_encoded_tags[table])
+    # the dictionaries go with the last encoded tag table
+    if not any(has_table(con, encoded_table) for encoded_table in schema.sql_encoded_tags.values()):
+        drop_table(con, 'tag_keys')
+        drop_table(con, 'tag_values')
+    for table in tables:
+        if encoded and table in schema.sql_encoded_tags:
+            encoded_table = schema.sql_encoded_tags[table]
+            for name in ('tag_keys', 'tag_values', encoded_table):
+                if not has_table(con, name):
+                    create_table(con, name, schema.sql_encoded_schema[name])
+            con.execute(TAG_VIEW.format(table, encoded_table))
+            for trigger in TAG_TRIGGERS:
+                con.execute(trigger.format(table, encoded_table))
+        else:
+            create_table(con, table, schema.sql_schema[table])
+
+def create_table(con, table, columns):
+    con.execute("CREATE TABLE {0} ({1});".format(
+        table, ", ".join("{0} {1}".format(name, sql_type) for name, sql_type in columns)))
+
+def has_table(con, name):
+    cur = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?;", (name,))
+    return cur.fetchone()[0] > 0
+
+def drop_table(con, name):
+    """Drop a table or view if it exists"""
+    row = con.execute("SELECT type FROM sqlite_master WHERE name=? AND type IN ('table', 'view');",
+                      (name,)).fetchone()
+    if row is not None:
+        con.execute("DROP {0} {1};".format(row[0].upper(), name))
+
+def create_indexes(con):
+    """Build the indexes of schema.sql_indexes (schema.sql_encoded_indexes
+    for encoded tags) and the spatial index once the data is loaded"""
+    for index in schema.sql_encoded_indexes if is_encoded(con) else schema.sql_indexes:
+        con.execute(index)
+    create_spatial_index(con)
+    con.execute("ANALYZE;")
+
+def create_spatial_index(con):
+    """(Re)build the R*Tree of the node coordinates from the nodes table"""
+    con.execute("DROP TABLE IF EXISTS {0};".format(SPATIAL_INDEX))
+    con.execute("CREATE VIRTUAL TABLE {0} USING rtree(id, min_lat, max_lat, min_lon, max_lon);"
+                .format(SPATIAL_INDEX))
+    con.execute("INSERT INTO {0} SELECT id, lat, lat, lon, lon FROM nodes "
+                "WHERE lat IS NOT NULL AND lon IS NOT NULL;".format(SPATIAL_INDEX))
+
+def insert_statement(tablename, encoded=False):
+    """INSERT statement with one ? per column of the table. With "encoded"
+    the rows of the tag tables go to their encoded table as (id, key_id,
+    value_id), see TagEncoder"""
+    if encoded and tablename in schema.sql_encoded_tags:
+        tablename = schema.sql_encoded_tags[tablename]
+        columns = [name for name, sql_type in schema.sql_encoded_schema[tablename]]
+    else:
+        columns = [name for name, sql_type in schema.sql_schema[tablename]]
+    return "INSERT INTO {0} ({1}) VALUES ({2});".format(
+        tablename, ", ".join(columns), ", ".join("?" for c in columns))
+
+class TagEncoder(object):
+    """In-memory intern maps of the tag keys (with their type) and values of
+    an encoded database, started from the dictionaries already in "con".
+    "rows" turns the (id, key, value, type) rows of a tag table into (id,
+    key_id, value_id), "write" inserts the strings seen for the first time
+    into tag_keys and tag_values."""
+
+    def __init__(self, con=None):
+        self.keys = {}
+        self.values = {}
+        if con is not None and is_encoded(con):
+            self.keys = dict(((key, tag_type), key_id) for key_id, key, tag_type
+                             in con.execute("SELECT id, key, type FROM tag_keys;"))
+            self.values = dict((value, value_id) for value_id, value
+                               in con.execute("SELECT id, value FROM tag_values;"))
+        self.next_key = max(self.keys.values() or [0]) + 1
+        self.next_value = max(self.values.values() or [0]) + 1
+        self.new_keys = []
+        self.new_values = []
+
+    def rows(self, tablename, rows):
+        """Encode the rows of a tag table, rows of other tables are returned
+        as they are"""
+        if tablename not in schema.sql_encoded_tags:
+            return rows
+        return self.encode(rows)
+
+    def encode(self, rows):
+        keys = self.keys
+        values = self.values
+        for element_id, key, value, tag_type in rows:
+            key_id = keys.get((key, tag_type))
+            if key_id is None:
+                key_id = keys[(key, tag_type)] = self.next_key
+                self.next_key += 1
+                self.new_keys.append((key_id, key, tag_type))
+            value_id = values.get(value)
+            if value_id is None:
+                value_id = values[value] = self.next_value
+                self.next_value += 1
+                self.new_values.append((value_id, value))
+            yield element_id, key_id, value_id
+
+    def write(self, con):
+        if self.new_keys:
+            con.executemany("INSERT INTO tag_keys (id, key, type) VALUES (?, ?, ?);", self.new_keys)
+            del self.new_keys[:]
+        if self.new_values:
+            con.executemany("INSERT INTO tag_values (id, value) VALUES (?, ?);", self.new_values)
+            del self.new_values[:]
+
+def stream_csv_to_sql(filename, con, tablename, chunk_rows=CHUNK_ROWS, progress=True,
+                      encoder=None):
+    """Insert a csv file into an existing table chunk by chunk, each chunk in
+    its own transaction. Only one chunk is held in memory at a time.
+
+        Args:
+            filename: Filename of input csv file
+            con: sqlite3 connection opened with isolation_level=None
+            tablename: name of the table, columns are matched by the header
+            chunk_rows: number of rows per chunk
+            progress: print rows and rows/sec while loading
+            encoder: TagEncoder of an encoded database
+
+        Output:
+            number of rows loaded
+    """
+    columns = [name for name, sql_type in schema.sql_schema[tablename]]
+    insert = insert_statement(tablename, encoder is not None)
+    start = time.time()
+    loaded = 0
+    with open(filename, "r", newline="", encoding="utf-8") as fin:
+        reader = csv.reader(fin)
+        header = next(reader)
+        if header != columns:
+            order = [header.index(name) for name in columns]
+            reader = ([row[i] for i in order] for row in reader)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                break
+            con.execute("BEGIN;")
+            if encoder is not None:
+                con.executemany(insert, encoder.rows(tablename, rows))
+                encoder.write(con)
+            else:
+                con.executemany(insert, rows)
+            con.execute("COMMIT;")
+            loaded += len(rows)
+            if progress:
+                elapsed = max(time.time() - start, 1e-9)
+                sys.stdout.write("\r{0}: {1} rows, {2:.0f} rows/sec".format(
+                    tablename, loaded, loaded / elapsed))
+                sys.stdout.flush()
+    if progress:
+        sys.stdout.write("\n")
+    return loaded
+
+def load_csvs(connection, csv_tables=CSV_TABLES, chunk_rows=CHUNK_ROWS, progress=True,
+              encoded=False):
+    """Load all five csv files into freshly created typed tables and build
+    the indexes afterwards, returns the number of rows loaded. With "encoded"
+    the tags are dictionary encoded."""
+    con = sqlite3.connect(connection, isolation_level=None)
+    for pragma in LOAD_PRAGMAS:
+        con.execute(pragma)
+    create_tables(con, [tablename for filename, tablename in csv_tables], encoded)
+    encoder = TagEncoder(con) if encoded else None
+    loaded = 0
+    for filename, tablename in csv_tables:
+        loaded += stream_csv_to_sql(filename, con, tablename, chunk_rows, progress, encoder)
+    create_indexes(con)
+    con.close()
+    return loaded
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load the csv files into a sqlite database")
+    parser.add_argument("database", nargs="?", default="fk_map")
+    parser.add_argument("--encoded", action="store_true",
+                        help="store the tags dictionary encoded")
+    args = parser.parse_args()
+    load_csvs(args.database, encoded=args.encoded)
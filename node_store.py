@@ -0,0 +1,150 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# COMPACT BINARY COLUMNAR STORE OF THE NODES NEXT TO THE CSV FILES.
+#
+# - one NumPy .npy file per column plus a small "meta.json" header
+# - ids are int64, lat/lon are fixed point int32 (degrees * 1e7, the
+#   precision of OSM itself), uid is int32, changeset and the timestamp (unix
+#   epoch seconds) are uint32
+# - about 28 bytes per node instead of ~80 bytes of csv text
+# - "open_node_store" maps the columns with np.load(mmap_mode="r"), so
+#   opening is zero copy and takes milliseconds whatever the size
+#
+# Write it during the conversion with
+#   process_map(OSM_PATH, True, sink=TeeSink(CsvSink(), NodeStoreSink("nodes_store")))
+###############################################################################
+
+import csv
+import io
+import json
+import os
+import shutil
+import numpy as np
+import numpy.lib.format
+
+# column name -> dtype of the store
+NODE_COLUMNS = [('id', np.int64),
+                ('lat', np.int32),
+                ('lon', np.int32),
+                ('uid', np.int32),
+                ('changeset', np.uint32),
+                ('timestamp', np.uint32)]
+# fixed point scale of lat and lon
+COORDINATE_SCALE = 10 ** 7
+# version of the store layout written to meta.json
+STORE_FORMAT = 1
+# number of nodes converted and written at a time
+STORE_BATCH = 65536
+# position of the stored fields in a row of nodes.csv (and NODE_FIELDS)
+CSV_COLUMNS = {'id': 0, 'lat': 1, 'lon': 2, 'uid': 4, 'changeset': 6, 'timestamp': 7}
+
+###############################################################################
+def convert_columns(columns):
+    """Turn lists of the text values of the XML file into the arrays of the
+    store"""
+    lat = np.array(columns['lat'], dtype=np.float64)
+    lon = np.array(columns['lon'], dtype=np.float64)
+    timestamps = [t[:-1] if t.endswith('Z') else t for t in columns['timestamp']]
+    return {
+        'id': np.array(columns['id'], dtype=np.int64),
+        'lat': np.rint(lat * COORDINATE_SCALE).astype(np.int32),
+        'lon': np.rint(lon * COORDINATE_SCALE).astype(np.int32),
+        'uid': np.array(columns['uid'], dtype=np.int32),
+        'changeset': np.array(columns['changeset'], dtype=np.uint32),
+        'timestamp': np.array(timestamps, dtype='datetime64[s]').astype(np.uint32),
+    }
+
+
+class NodeStoreSink(object):
+    """Sink for process_map that writes the nodes into a columnar store.
+    Columns are appended to raw files batch by batch and turned into .npy
+    files in "close", when the number of nodes is known."""
+
+    def __init__(self, directory, batch_size=STORE_BATCH):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.batch_size = batch_size
+        self.raw = dict((name, open(self.path(name) + '.raw', 'wb'))
+                        for name, dtype in NODE_COLUMNS)
+        self.columns = dict((name, []) for name, dtype in NODE_COLUMNS)
+        self.count = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    def add(self, shaped):
+        """Collect the node of a ShapedElement of parse_to_csv.py"""
+        if shaped.tag != 'node':
+            return
+        row = shaped.row
+        columns = self.columns
+        for name, position in CSV_COLUMNS.items():
+            columns[name].append(row[position])
+        if len(columns['id']) >= self.batch_size:
+            self.flush()
+
+    def append_chunk(self, paths):
+        """Collect the nodes of the nodes csv file written by a worker"""
+        with open(paths[0], 'r', newline='', encoding='utf-8') as chunk:
+            self.append_rows(csv.reader(chunk))
+
+    def append_text(self, texts):
+        """Collect the nodes of the csv text of the nodes table"""
+        self.append_rows(csv.reader(io.StringIO(texts[0])))
+
+    def append_rows(self, rows):
+        for row in rows:
+            for name, position in CSV_COLUMNS.items():
+                self.columns[name].append(row[position])
+            if len(self.columns['id']) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if not self.columns['id']:
+            return
+        arrays = convert_columns(self.columns)
+        for name, dtype in NODE_COLUMNS:
+            arrays[name].tofile(self.raw[name])
+            del self.columns[name][:]
+        self.count += len(arrays['id'])
+
+    def close(self):
+        self.flush()
+        for name, dtype in NODE_COLUMNS:
+            self.raw[name].close()
+            raw_path = self.path(name) + '.raw'
+            header = {'descr': numpy.lib.format.dtype_to_descr(np.dtype(dtype)),
+                      'fortran_order': False, 'shape': (self.count,)}
+            with open(self.path(name), 'wb') as out, open(raw_path, 'rb') as raw:
+                numpy.lib.format.write_array_header_1_0(out, header)
+                shutil.copyfileobj(raw, out)
+            os.remove(raw_path)
+        meta = {'format': STORE_FORMAT,
+                'count': self.count,
+                'coordinate_scale': COORDINATE_SCALE,
+                'columns': dict((name, np.dtype(dtype).name) for name, dtype in NODE_COLUMNS)}
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as out:
+            json.dump(meta, out, indent=2)
+
+###############################################################################
+def open_node_store(directory):
+    """Map the columns of a node store without reading them.
+
+        Output:
+            (meta, columns) where "columns" maps the column names to read-only
+            memory mapped arrays
+    """
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format'] != STORE_FORMAT:
+        raise ValueError("Unknown node store format {0}".format(meta['format']))
+    columns = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+                   for name in meta['columns'])
+    return meta, columns
+
+###############################################################################
+def coordinates(columns, scale=COORDINATE_SCALE):
+    """Return lat and lon of a store as float64 degrees"""
+    return columns['lat'] / float(scale), columns['lon'] / float(scale)
@@ -0,0 +1,676 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# LOW LEVEL READING OF OPEN STREET MAP XML FILES SHARED BY THE OTHER SCRIPTS.
+#
+# - split a .osm file into byte ranges that start at top level elements
+#   ("node", "way", "relation") so they can be parsed independently
+# - parse such a byte range as if it was a small .osm file of its own
+# - turn top level elements into lightweight records with exchangeable parser
+#   backends (ElementTree or plain expat callbacks)
+# - read .osm.gz and .osm.bz2 files transparently ("open_osm"), see
+#   COMPRESSED INPUT below
+# - read .osm.pbf files with the "pbf" backend of "osm_pbf.py", picked
+#   automatically by "detect_parser"
+###############################################################################
+
+import bz2
+import gzip
+import io
+import os
+import queue
+import re
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+# start of a top level element, attribute values never contain a raw "<"
+TOP_LEVEL_START = re.compile(br'<(?:node|way|relation)[\s/>]')
+# start of a top level element and its id attribute, the id group is None
+# when the element has no id (also used by element_index.py)
+ELEMENT_ID = re.compile(br'<(node|way|relation)(?=[\s/>])(?:\s(?:[^<]*?\s)?id="(-?\d+)")?')
+# closing tag of the whole document
+OSM_END = b'</osm>'
+# block size used when scanning for element boundaries
+SCAN_BLOCK = 1024 * 1024
+# block size fed to the expat parser
+READ_BLOCK = 1024 * 1024
+# approximate size of the blocks of element_blocks
+PIPELINE_BLOCK = 4 * 1024 * 1024
+
+###############################################################################
+# COMPRESSED INPUT
+#
+# "open_osm" looks at the first bytes of a file and returns a binary file
+# object with the decompressed XML, so every reader below takes .osm,
+# .osm.gz and .osm.bz2 files alike:
+#
+# - gzip and single stream bzip2 files are decompressed by a thread that
+#   stays up to READ_AHEAD blocks ahead of the parser
+# - multi stream bzip2 files (pbzip2, lbzip2 and the planet dumps) are cut
+#   into units of whole streams at their "BZh" headers, the units are
+#   decompressed by a pool of threads (bz2 releases the GIL) with at most
+#   two units per thread in flight
+#
+# Compressed files can only be read front to back: seeking forward skips
+# data, seeking backwards starts over, so the parallel byte range processing
+# of "parse_to_csv.py" is not available for them.
+###############################################################################
+
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+# header of a bzip2 stream followed by the magic of its first block
+BZ2_STREAM_START = re.compile(br'BZh[1-9]1AY&SY')
+# bytes at the start of a bzip2 file searched for a second stream
+BZ2_PROBE = 4 * 1024 * 1024
+# compressed bytes per unit of work of the parallel bzip2 decompression
+BZ2_UNIT = 4 * 1024 * 1024
+# number of decompressed blocks read ahead for gzip and single stream bzip2
+READ_AHEAD = 8
+# number of threads for multi stream bzip2 files, None means one per cpu
+DECOMPRESS_WORKERS = None
+
+
+def compression_of(filename):
+    """Return "gzip", "bz2" or None for a plain file"""
+    with open(filename, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if magic == BZ2_MAGIC:
+        return 'bz2'
+    return None
+
+
+def is_compressed(source):
+    return isinstance(source, str) and compression_of(source) is not None
+
+
+def is_multistream(filename):
+    """True if a bzip2 file holds more than one stream"""
+    with open(filename, 'rb') as f:
+        head = f.read(BZ2_PROBE)
+    return BZ2_STREAM_START.search(head, 1) is not None
+
+###############################################################################
+def read_ahead(fileobj, block_size=READ_BLOCK, depth=READ_AHEAD):
+    """Yield the blocks of a file object while a thread reads up to "depth"
+    blocks ahead. The file object is closed at the end."""
+    blocks = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            while not stop.is_set():
+                block = fileobj.read(block_size)
+                put(block)
+                if not block:
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            fileobj.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                return
+            yield block
+    finally:
+        stop.set()
+        # a reader left open at exit is cleaned up while the interpreter shuts
+        # down, the daemon thread is frozen by then and can not be joined
+        if not sys.is_finalizing():
+            thread.join()
+
+###############################################################################
+def bz2_units(f, unit_size=BZ2_UNIT):
+    """Yield the compressed bytes of a multi stream bzip2 file in units of
+    about "unit_size" bytes that start and end at stream boundaries"""
+    buffer = b''
+    while True:
+        block = f.read(unit_size)
+        if not block:
+            break
+        buffer += block
+        last = None
+        for last in BZ2_STREAM_START.finditer(buffer, 1):
+            pass
+        if last is not None:
+            yield buffer[:last.start()]
+            buffer = buffer[last.start():]
+    if buffer:
+        yield buffer
+
+
+def parallel_bz2_blocks(filename, workers, unit_size=BZ2_UNIT):
+    """Yield the decompressed units of a multi stream bzip2 file in order,
+    decompressed by a pool of "workers" threads"""
+    pool = ThreadPoolExecutor(workers)
+    pending = deque()
+    f = open(filename, 'rb')
+    units = bz2_units(f, unit_size)
+
+    def fill():
+        while len(pending) < 2 * workers:
+            unit = next(units, None)
+            if unit is None:
+                return
+            pending.append((unit, pool.submit(bz2.decompress, unit)))
+
+    try:
+        fill()
+        while pending:
+            unit, future = pending.popleft()
+            try:
+                data = future.result()
+            except (OSError, ValueError, EOFError):
+                # a "BZh" header inside the compressed data split a stream,
+                # decompress it together with the following units
+                data = None
+                while data is None:
+                    fill()
+                    if not pending:
+                        raise OSError("Invalid bzip2 data in {0}".format(filename))
+                    unit += pending.popleft()[0]
+                    try:
+                        data = bz2.decompress(unit)
+                    except (OSError, ValueError, EOFError):
+                        pass
+            fill()
+            yield data
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        f.close()
+
+
+class DecompressedFile(object):
+    """Read-only binary file object with the decompressed content of a gzip
+    or bzip2 file, filled by "read_ahead" or "parallel_bz2_blocks" """
+
+    def __init__(self, filename, compression, workers=None):
+        self.filename = filename
+        self.compression = compression
+        self.workers = workers or DECOMPRESS_WORKERS or os.cpu_count() or 1
+        self.blocks = None
+        self.rewind()
+
+    def rewind(self):
+        """Start reading from the beginning of the file again"""
+        if self.blocks is not None:
+            self.blocks.close()
+        if self.compression == 'bz2' and self.workers > 1 and is_multistream(self.filename):
+            self.blocks = parallel_bz2_blocks(self.filename, self.workers)
+        else:
+            opener = gzip.open if self.compression == 'gzip' else bz2.open
+            self.blocks = read_ahead(opener(self.filename, 'rb'))
+        self.buffer = b''
+        self.buffer_pos = 0
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        parts = []
+        while size != 0:
+            if self.buffer_pos >= len(self.buffer):
+                self.buffer = next(self.blocks, b'')
+                self.buffer_pos = 0
+                if not self.buffer:
+                    break
+            available = len(self.buffer) - self.buffer_pos
+            n = available if size < 0 else min(size, available)
+            parts.append(self.buffer[self.buffer_pos:self.buffer_pos + n])
+            self.buffer_pos += n
+            if size > 0:
+                size -= n
+        data = b''.join(parts)
+        self.offset += len(data)
+        return data
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.offset
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("compressed files can not seek from the end")
+        if offset < self.offset:
+            self.rewind()
+        while self.offset < offset:
+            if not self.read(min(offset - self.offset, READ_BLOCK)):
+                break
+        return self.offset
+
+    def close(self):
+        if self.blocks is not None:
+            self.blocks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_osm(filename, workers=None):
+    """Open a .osm file for binary reading, .gz and .bz2 files are
+    decompressed on the fly"""
+    compression = compression_of(filename)
+    if compression is None:
+        return open(filename, 'rb')
+    return DecompressedFile(filename, compression, workers)
+
+###############################################################################
+def element_start_after(osm_file, offset):
+    """Return the byte offset of the first top level element starting at or
+    after "offset" or None if there is none.
+
+        Args:
+            osm_file: binary file object of the .osm file
+            offset: byte offset to start scanning from
+    """
+    osm_file.seek(offset)
+    carry = b''
+    block_start = offset
+    while True:
+        block = osm_file.read(SCAN_BLOCK)
+        if not block:
+            return None
+        data = carry + block
+        match = TOP_LEVEL_START.search(data)
+        if match:
+            return block_start - len(carry) + match.start()
+        # keep the tail in case a tag is split between two blocks
+        carry = data[-16:]
+        block_start += len(block)
+
+###############################################################################
+def document_end(osm_file):
+    """Return the byte offset of the closing "</osm>" tag (or the file size)"""
+    osm_file.seek(0, os.SEEK_END)
+    size = osm_file.tell()
+    osm_file.seek(max(0, size - SCAN_BLOCK))
+    tail = osm_file.read()
+    pos = tail.rfind(OSM_END)
+    if pos < 0:
+        return size
+    return size - len(tail) + pos
+
+###############################################################################
+def last_element_start(data):
+    """Offset of the last top level element that starts in "data" or -1"""
+    pos = data.rfind(b'<')
+    while pos >= 0 and not TOP_LEVEL_START.match(data, pos):
+        pos = data.rfind(b'<', 0, pos)
+    return pos
+
+
+def last_element(data):
+    """(type, id) of the last top level element that starts in "data" or
+    None, the id as it is written in the file"""
+    match = ELEMENT_ID.match(data, max(last_element_start(data), 0))
+    if match is None or match.group(2) is None:
+        return None
+    return match.group(1).decode(), match.group(2).decode()
+
+
+def element_blocks(source, block_size=PIPELINE_BLOCK, start=None):
+    """Yield the top level elements of a .osm file as blocks of raw XML of
+    about "block_size" bytes. Every block starts at a top level element and
+    ends where the next block starts (the last one right before "</osm>"), so
+    it can be parsed on its own wrapped into "<osm>" and "</osm>". .gz and
+    .bz2 files are decompressed on the way, the head of the file (XML
+    declaration, "<osm>", "<bounds>") is left out.
+
+        Args:
+            source: Filename or binary file object of the .osm file
+            block_size: bytes read at once
+            start: offset of a top level element to start at instead of the
+                   first one, e.g. the end of a block of an earlier run
+
+        Output:
+            (offset, block) with the offset of the block in the (decompressed)
+            XML
+    """
+    osm_file = open_osm(source) if isinstance(source, str) else source
+    try:
+        data = b''
+        offset = 0
+        started = start is not None
+        if started:
+            osm_file.seek(start)
+            offset = start
+        while True:
+            block = osm_file.read(block_size)
+            data += block
+            if not started:
+                match = TOP_LEVEL_START.search(data)
+                if match is None:
+                    if not block:
+                        return
+                    # keep the tail in case a tag is split between two blocks
+                    offset += max(len(data) - 16, 0)
+                    data = data[-16:]
+                    continue
+                offset += match.start()
+                data = data[match.start():]
+                started = True
+            if not block:
+                end = data.rfind(OSM_END)
+                if end >= 0:
+                    data = data[:end]
+                if data.strip():
+                    yield offset, data
+                return
+            # the last element may be cut, it goes with the next block
+            cut = last_element_start(data)
+            if cut > 0:
+                yield offset, data[:cut]
+                offset += cut
+                data = data[cut:]
+    finally:
+        if osm_file is not source:
+            osm_file.close()
+
+###############################################################################
+def split_ranges(filename, n_chunks):
+    """Split a .osm file into at most "n_chunks" byte ranges of about the same
+    size. Every range starts at a top level element and ends where the next
+    range starts (the last one right before "</osm>"), so the ranges together
+    hold every top level element exactly once and in file order.
+
+        Args:
+            filename: Filename of imput XML file
+            n_chunks: number of ranges wanted
+
+        Output:
+            list of (start, end) byte offsets
+    """
+    if is_pbf(filename):
+        import osm_pbf
+        return osm_pbf.split_blob_ranges(filename, n_chunks)
+    with open(filename, 'rb') as osm_file:
+        end = document_end(osm_file)
+        first = element_start_after(osm_file, 0)
+        if first is None or first >= end:
+            return []
+        starts = [first]
+        step = (end - first) // max(1, n_chunks)
+        for i in range(1, n_chunks):
+            start = element_start_after(osm_file, first + i * step)
+            if start is None or start >= end:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+    return list(zip(starts, starts[1:] + [end]))
+
+
+class RangeFile(object):
+    """Read-only file object that serves the bytes [start, end) of a .osm
+    file wrapped into "<osm>" and "</osm>", so ElementTree can parse a byte
+    range from split_ranges on its own
+    """
+
+    def __init__(self, filename, start, end):
+        self.raw = open_osm(filename)
+        self.raw.seek(start)
+        self.left = end - start
+        self.head = io.BytesIO(b'<osm>')
+        self.tail = io.BytesIO(b'</osm>')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.left + 16
+        data = self.head.read(size)
+        if len(data) < size and self.left:
+            chunk = self.raw.read(min(size - len(data), self.left))
+            self.left -= len(chunk)
+            data += chunk
+        if len(data) < size and not self.left:
+            data += self.tail.read(size - len(data))
+        return data
+
+    def close(self):
+        self.raw.close()
+
+###############################################################################
+# PARSER BACKENDS
+#
+# A parser backend is a generator function "parser(source, tags)" that yields
+# one lightweight OsmRecord per top level element whose name is in "tags"
+# (all top level elements if "tags" is None). "source" is a filename or a
+# binary file object such as RangeFile. Backends are registered in PARSERS.
+###############################################################################
+
+class OsmRecord(object):
+    """A top level element ("node", "way", "relation", ...) with its
+    attributes and children reduced to plain lists:
+
+        tags: list of (k, v) tuples of the "tag" children
+        nds: list of the "ref" attributes of the "nd" children
+        members: list of (type, ref, role) tuples of the "member" children
+    """
+    __slots__ = ('tag', 'attrib', 'tags', 'nds', 'members')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = []
+        self.nds = []
+        self.members = []
+
+
+def record_from_element(element):
+    """Turn an ElementTree element into an OsmRecord"""
+    record = OsmRecord(element.tag, element.attrib)
+    for child in element:
+        if child.tag == 'tag':
+            record.tags.append((child.attrib['k'], child.attrib['v']))
+        elif child.tag == 'nd':
+            record.nds.append(child.attrib['ref'])
+        elif child.tag == 'member':
+            record.members.append((child.attrib['type'], child.attrib['ref'],
+                                   child.attrib['role']))
+    return record
+
+###############################################################################
+def etree_records(source, tags=('node', 'way', 'relation'), element_counts=None):
+    """Parser backend built on ElementTree's iterparse. "element_counts" is
+    an optional Counter of the names of all elements of the file"""
+    osm_file = open_osm(source) if isinstance(source, str) else source
+    try:
+        context = ET.iterparse(osm_file, events=('start', 'end'))
+        _, root = next(context)
+        depth = 1
+        for event, elem in context:
+            if event == 'start':
+                depth += 1
+                continue
+            if element_counts is not None:
+                element_counts[elem.tag] += 1
+            depth -= 1
+            if depth == 1:
+                if tags is None or elem.tag in tags:
+                    yield record_from_element(elem)
+                root.clear()
+    finally:
+        if osm_file is not source:
+            osm_file.close()
+
+###############################################################################
+def expat_records(source, tags=('node', 'way', 'relation'), element_counts=None):
+    """Parser backend built directly on the expat callbacks. No Element
+    objects are built and only "start" events are handled, so this is lighter
+    than iterparse. "element_counts" is an optional Counter of the names of
+    all elements of the file, also of the ones no record is built for.
+    """
+    top_level = TOP_LEVEL
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    done = []
+    # top level elements never nest, so a record is complete as soon as the
+    # next top level element starts and no end events are needed at all
+    current = None
+
+    def start(name, attrs):
+        nonlocal current
+        if name == 'tag':
+            if current is not None:
+                current.tags.append((attrs['k'], attrs['v']))
+        elif name == 'nd':
+            if current is not None:
+                current.nds.append(attrs['ref'])
+        elif name == 'member':
+            if current is not None:
+                current.members.append((attrs['type'], attrs['ref'], attrs['role']))
+        elif name in top_level:
+            if current is not None:
+                done.append(current)
+            if tags is None or name in tags:
+                current = OsmRecord(name, attrs)
+            else:
+                current = None
+
+    parser.StartElementHandler = start
+    if element_counts is not None:
+        # counted as they end, in the order of iterparse
+        def end(name):
+            element_counts[name] += 1
+        parser.EndElementHandler = end
+
+    osm_file = open_osm(source) if isinstance(source, str) else source
+    try:
+        while True:
+            block = osm_file.read(READ_BLOCK)
+            parser.Parse(block, not block)
+            if not block and current is not None:
+                done.append(current)
+            if done:
+                for record in done:
+                    yield record
+                del done[:]
+            if not block:
+                break
+    finally:
+        if osm_file is not source:
+            osm_file.close()
+
+
+# names of the top level elements the expat backend builds records for
+TOP_LEVEL = ('node', 'way', 'relation', 'bounds', 'changeset')
+
+def pbf_records(source, tags=('node', 'way', 'relation')):
+    """Parser backend for .osm.pbf files, see osm_pbf.py"""
+    import osm_pbf
+    return osm_pbf.pbf_records(source, tags)
+
+
+PARSERS = {'etree': etree_records,
+           'expat': expat_records,
+           'pbf': pbf_records}
+
+
+def is_pbf(source):
+    """True if a file starts with the OSMHeader blob of a PBF file"""
+    if not isinstance(source, str):
+        return False
+    with open(source, 'rb') as f:
+        head = f.read(15)
+    return head[4:15] == b'\n\tOSMHeader'
+
+
+def detect_parser(source, parser='expat'):
+    """Name of the backend for a file: "pbf" for PBF files, else "parser" """
+    return 'pbf' if is_pbf(source) else parser
+
+###############################################################################
+def range_records(filename, start, end, tags=('node', 'way', 'relation'), parser='expat'):
+    """Yield the OsmRecords of the byte range [start, end) of a .osm file"""
+    if parser == 'pbf':
+        import osm_pbf
+        for record in osm_pbf.pbf_records(filename, tags, start, end, workers=1):
+            yield record
+        return
+    range_file = RangeFile(filename, start, end)
+    try:
+        for record in PARSERS[parser](range_file, tags):
+            yield record
+    finally:
+        range_file.close()
+
+
+def block_records(block, tags=('node', 'way', 'relation'), parser='expat'):
+    """Yield the OsmRecords of a block of top level elements (raw XML bytes,
+    e.g. from element_blocks)"""
+    return PARSERS[parser](io.BytesIO(b'<osm>' + block + b'</osm>'), tags)
+
+###############################################################################
+def osc_records(source):
+    """Yield (action, OsmRecord) for every element of an OsmChange (.osc) file,
+    "action" is "create", "modify" or "delete". Built on expat like
+    "expat_records"."""
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    done = []
+    action = None
+    current = None
+
+    def start(name, attrs):
+        nonlocal action, current
+        if name == 'tag':
+            if current is not None:
+                current.tags.append((attrs['k'], attrs['v']))
+        elif name == 'nd':
+            if current is not None:
+                current.nds.append(attrs['ref'])
+        elif name == 'member':
+            if current is not None:
+                current.members.append((attrs['type'], attrs['ref'], attrs['role']))
+        elif name in ('node', 'way', 'relation'):
+            current = OsmRecord(name, attrs)
+        elif name in ('create', 'modify', 'delete'):
+            action = name
+
+    def end(name):
+        nonlocal current
+        if current is not None and name == current.tag:
+            done.append((action, current))
+            current = None
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+
+    osc_file = open_osm(source) if isinstance(source, str) else source
+    try:
+        while True:
+            block = osc_file.read(READ_BLOCK)
+            parser.Parse(block, not block)
+            for change in done:
+                yield change
+            del done[:]
+            if not block:
+                break
+    finally:
+        if osc_file is not source:
+            osc_file.close()
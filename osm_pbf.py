@@ -0,0 +1,447 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# READ OPEN STREET MAP PBF FILES (.osm.pbf) WITHOUT ANY PROTOBUF LIBRARY.
+#
+# - a PBF file is a sequence of blobs: a 4 byte length, a BlobHeader and a
+#   Blob holding one raw, zlib or lzma compressed block
+# - the first block (OSMHeader) lists the features a reader must support,
+#   the other blocks (OSMData) are PrimitiveBlocks with a string table and
+#   groups of nodes, dense nodes, ways and relations
+# - the few protobuf messages are decoded by hand, the packed arrays of dense
+#   nodes and way refs with NumPy
+# - every element becomes an OsmRecord of "osm_io.py" with the same string
+#   attributes an XML file would have (lat/lon with 7 decimals, timestamps
+#   as "2015-03-06T10:00:00Z"), so shape_element, process_map and the audit
+#   engine take PBF and XML files alike
+# - blobs are independent of each other: "pbf_records" decodes them in a
+#   pool of processes, "split_blob_ranges" hands whole blobs to the workers
+#   of process_map
+#
+# Reference: https://wiki.openstreetmap.org/wiki/PBF_Format
+###############################################################################
+
+import lzma
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from itertools import accumulate
+import numpy as np
+from osm_io import OsmRecord
+
+# features of the OsmSchema this reader understands
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes'}
+# limits of the format
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+# number of processes decoding blobs, None means one per cpu
+PBF_WORKERS = None
+# member types of relations
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+# packed fields of at least this many bytes are decoded with NumPy
+NUMPY_MIN_BYTES = 512
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BYTES = 2
+WIRE_FIXED32 = 5
+
+###############################################################################
+# PROTOBUF DECODING
+###############################################################################
+
+def read_varint(buf, pos):
+    """Decode the varint at "pos", return (value, position after it)"""
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def signed64(value):
+    """Reinterpret an unsigned varint as int64"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def message(buf):
+    """Decode a protobuf message into {field number: [values]}. Varints are
+    ints, length delimited fields are memoryviews into "buf"."""
+    buf = memoryview(buf)
+    fields = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == WIRE_BYTES:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == WIRE_FIXED64:
+            value = bytes(buf[pos:pos + 8])
+            pos += 8
+        elif wire_type == WIRE_FIXED32:
+            value = bytes(buf[pos:pos + 4])
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {0}".format(wire_type))
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def first(fields, number, default=None):
+    values = fields.get(number)
+    return values[0] if values else default
+
+
+def field_bytes(fields, number):
+    values = fields.get(number)
+    if not values:
+        return b''
+    if len(values) == 1:
+        return values[0]
+    return b''.join(bytes(v) for v in values)
+
+
+def varints(data):
+    """Decode a run of varints with plain Python, fastest for short runs"""
+    values = []
+    append = values.append
+    result = shift = 0
+    for b in bytes(data):
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            append(result)
+            result = shift = 0
+        else:
+            shift += 7
+    return values
+
+
+def varint_array(data):
+    """Decode a run of varints into a uint64 array with NumPy"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # every byte adds its 7 bits at 7 * (its position within the varint)
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def zigzag_array(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def packed(fields, number):
+    """Decode a packed repeated varint field into a list of ints"""
+    data = field_bytes(fields, number)
+    if len(data) < NUMPY_MIN_BYTES:
+        return varints(data)
+    return varint_array(data).tolist()
+
+
+def packed_delta(fields, number):
+    """Decode a packed, zigzag and delta encoded field into a list of ints"""
+    data = field_bytes(fields, number)
+    if len(data) < NUMPY_MIN_BYTES:
+        return list(accumulate((v >> 1) ^ -(v & 1) for v in varints(data)))
+    return np.cumsum(zigzag_array(varint_array(data))).tolist()
+
+###############################################################################
+# BLOBS
+###############################################################################
+
+def read_blob_header(f):
+    """Read the next BlobHeader, return (type, size of the blob) or None at
+    the end of the file"""
+    head = f.read(4)
+    if not head:
+        return None
+    if len(head) < 4:
+        raise ValueError("Truncated PBF file")
+    size, = struct.unpack('>I', head)
+    if size > MAX_HEADER_SIZE:
+        raise ValueError("BlobHeader of {0} bytes is too large".format(size))
+    header = message(f.read(size))
+    return bytes(first(header, 1)).decode('utf-8'), first(header, 3)
+
+
+def blob_data(blob):
+    """Uncompressed content of a Blob message"""
+    fields = message(blob)
+    if 1 in fields:
+        return bytes(first(fields, 1))
+    if 3 in fields:
+        return zlib.decompress(first(fields, 3))
+    if 4 in fields:
+        return lzma.decompress(first(fields, 4))
+    raise ValueError("Unsupported PBF blob compression, fields {0}".format(sorted(fields)))
+
+
+def check_header(data):
+    """Raise ValueError if the OSMHeader requires features we lack"""
+    header = message(data)
+    required = set(bytes(v).decode('utf-8') for v in header.get(4, []))
+    missing = required - SUPPORTED_FEATURES
+    if missing:
+        raise ValueError("PBF file requires unsupported features: {0}".format(
+            ", ".join(sorted(missing))))
+
+
+def iter_blobs(f, end=None):
+    """Yield (offset, type, raw Blob) from the current position of a binary
+    file object up to "end" (or the end of the file)"""
+    while end is None or f.tell() < end:
+        offset = f.tell()
+        header = read_blob_header(f)
+        if header is None:
+            return
+        blob_type, size = header
+        if size > MAX_BLOB_SIZE:
+            raise ValueError("Blob of {0} bytes at {1} is too large".format(size, offset))
+        blob = f.read(size)
+        if len(blob) < size:
+            raise ValueError("Truncated PBF blob at {0}".format(offset))
+        yield offset, blob_type, blob
+
+###############################################################################
+# PRIMITIVE BLOCKS
+###############################################################################
+
+class BlockContext(object):
+    """String table and coordinate/time scales of one PrimitiveBlock"""
+
+    def __init__(self, block):
+        table = message(first(block, 1, b''))
+        self.strings = [bytes(s).decode('utf-8') for s in table.get(1, [])]
+        self.granularity = first(block, 17, 100)
+        self.date_granularity = first(block, 18, 1000)
+        self.lat_offset = signed64(first(block, 19, 0))
+        self.lon_offset = signed64(first(block, 20, 0))
+        self.timestamps = {}
+
+    def coordinate(self, offset, value):
+        return '%.7f' % ((offset + self.granularity * value) * 1e-9)
+
+    def timestamp(self, value):
+        text = self.timestamps.get(value)
+        if text is None:
+            text = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                 time.gmtime(value * self.date_granularity // 1000))
+            self.timestamps[value] = text
+        return text
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid):
+        attrib['version'] = str(version)
+        attrib['timestamp'] = self.timestamp(timestamp)
+        attrib['changeset'] = str(changeset)
+        attrib['uid'] = str(uid)
+        attrib['user'] = self.strings[user_sid]
+
+    def tags(self, fields):
+        strings = self.strings
+        return [(strings[k], strings[v])
+                for k, v in zip(packed(fields, 2), packed(fields, 3))]
+
+
+def add_info(context, attrib, fields):
+    """Copy the Info message (field 4) of a node, way or relation"""
+    info = first(fields, 4)
+    if info is None:
+        return
+    info = message(info)
+    context.info(attrib, signed64(first(info, 1, -1)), first(info, 2, 0),
+                 first(info, 3, 0), first(info, 4, 0), first(info, 5, 0))
+
+
+def dense_records(context, dense):
+    """OsmRecords of a DenseNodes message"""
+    fields = message(dense)
+    ids = packed_delta(fields, 1)
+    lats = packed_delta(fields, 8)
+    lons = packed_delta(fields, 9)
+    info = message(first(fields, 5, b''))
+    has_info = bool(info)
+    if has_info:
+        versions = packed(info, 1)
+        timestamps = packed_delta(info, 2)
+        changesets = packed_delta(info, 3)
+        uids = packed_delta(info, 4)
+        user_sids = packed_delta(info, 5)
+    keys_vals = packed(fields, 10)
+    strings = context.strings
+    kv = 0
+    records = []
+    for i, node_id in enumerate(ids):
+        attrib = {'id': str(node_id),
+                  'lat': context.coordinate(context.lat_offset, lats[i]),
+                  'lon': context.coordinate(context.lon_offset, lons[i])}
+        if has_info:
+            context.info(attrib, versions[i], timestamps[i], changesets[i], uids[i], user_sids[i])
+        record = OsmRecord('node', attrib)
+        # keys and values of all nodes in one array, every node ends with a 0
+        while kv < len(keys_vals) and keys_vals[kv] != 0:
+            record.tags.append((strings[keys_vals[kv]], strings[keys_vals[kv + 1]]))
+            kv += 2
+        kv += 1
+        records.append(record)
+    return records
+
+
+def node_record(context, node):
+    fields = message(node)
+    attrib = {'id': str(zigzag(first(fields, 1))),
+              'lat': context.coordinate(context.lat_offset, zigzag(first(fields, 8))),
+              'lon': context.coordinate(context.lon_offset, zigzag(first(fields, 9)))}
+    add_info(context, attrib, fields)
+    record = OsmRecord('node', attrib)
+    record.tags = context.tags(fields)
+    return record
+
+
+def way_record(context, way):
+    fields = message(way)
+    attrib = {'id': str(signed64(first(fields, 1)))}
+    add_info(context, attrib, fields)
+    record = OsmRecord('way', attrib)
+    record.tags = context.tags(fields)
+    record.nds = [str(ref) for ref in packed_delta(fields, 8)]
+    return record
+
+
+def relation_record(context, relation):
+    fields = message(relation)
+    attrib = {'id': str(signed64(first(fields, 1)))}
+    add_info(context, attrib, fields)
+    record = OsmRecord('relation', attrib)
+    record.tags = context.tags(fields)
+    strings = context.strings
+    record.members = [(MEMBER_TYPES[t], str(ref), strings[role]) for role, ref, t in
+                      zip(packed(fields, 8), packed_delta(fields, 9),
+                          packed(fields, 10))]
+    return record
+
+
+def block_records(data, tags=None):
+    """Decode an uncompressed PrimitiveBlock into a list of OsmRecords whose
+    name is in "tags" (all if None)"""
+    block = message(data)
+    context = BlockContext(block)
+    records = []
+    for group in block.get(2, []):
+        group = message(group)
+        if tags is None or 'node' in tags:
+            for node in group.get(1, []):
+                records.append(node_record(context, node))
+            for dense in group.get(2, []):
+                records.extend(dense_records(context, dense))
+        if tags is None or 'way' in tags:
+            for way in group.get(3, []):
+                records.append(way_record(context, way))
+        if tags is None or 'relation' in tags:
+            for relation in group.get(4, []):
+                records.append(relation_record(context, relation))
+    return records
+
+
+def decode_blob(args):
+    """Decompress and decode one OSMData blob, runs in a worker process"""
+    blob, tags = args
+    return block_records(blob_data(blob), tags)
+
+###############################################################################
+# READING FILES
+###############################################################################
+
+def pbf_records(source, tags=('node', 'way', 'relation'), start=None, end=None,
+                workers=PBF_WORKERS):
+    """Parser backend for PBF files: yield the OsmRecords of all elements in
+    file order.
+
+        Args:
+            source: Filename of the .osm.pbf file or a binary file object
+            tags: names of the elements wanted, None for all
+            start, end: optional byte range of whole blobs (split_blob_ranges)
+            workers: number of processes decoding blobs, 1 decodes here
+    """
+    workers = workers or os.cpu_count() or 1
+    pbf_file = open(source, 'rb') if isinstance(source, str) else source
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    pending = deque()
+    try:
+        if start:
+            pbf_file.seek(start)
+        for offset, blob_type, blob in iter_blobs(pbf_file, end):
+            if blob_type == 'OSMHeader':
+                check_header(blob_data(blob))
+                continue
+            if blob_type != 'OSMData':
+                continue
+            if pool is None:
+                for record in decode_blob((blob, tags)):
+                    yield record
+                continue
+            # at most two blobs per worker are read ahead
+            pending.append(pool.apply_async(decode_blob, ((blob, tags),)))
+            if len(pending) >= 2 * workers:
+                for record in pending.popleft().get():
+                    yield record
+        while pending:
+            for record in pending.popleft().get():
+                yield record
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if pbf_file is not source:
+            pbf_file.close()
+
+###############################################################################
+def split_blob_ranges(filename, n_chunks):
+    """Split a PBF file into at most "n_chunks" byte ranges of whole OSMData
+    blobs of about the same size, the counterpart of osm_io.split_ranges.
+
+        Output:
+            list of (start, end) byte offsets
+    """
+    blobs = []
+    with open(filename, 'rb') as f:
+        while True:
+            offset = f.tell()
+            header = read_blob_header(f)
+            if header is None:
+                break
+            blob_type, size = header
+            if blob_type == 'OSMHeader':
+                check_header(blob_data(f.read(size)))
+            else:
+                f.seek(size, os.SEEK_CUR)
+                if blob_type == 'OSMData':
+                    blobs.append(offset)
+        size = f.tell()
+    if not blobs:
+        return []
+    step = (size - blobs[0]) / float(max(1, n_chunks))
+    starts = [blobs[0]]
+    for offset in blobs[1:]:
+        if offset - blobs[0] >= step * len(starts):
+            starts.append(offset)
+    return list(zip(starts, starts[1:] + [size]))
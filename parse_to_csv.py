@@ -12,20 +12,68 @@
 #
 # More precicely, the process for this transformation is as follows:
 # - use iterparse to iteratively step through each top level element in the XML
-# - shape each element into several data structures using a custom function
+# - shape each element into rows (tuples in the order of the csv fields)
+#   using a custom function
 # - utilize a schema and validation library to ensure the transformed data is
 #   in the correct format
 # - write each data structure to the appropriate .csv files
+# - time every stage and count the cleaned values and skipped keys, the
+#   summary of each run is written as JSON (see "run_stats.py")
+# - optionally run as a pipeline: read blocks of elements, shape them in worker
+#   processes and write every table in its own thread, connected by bounded
+#   queues (see "process_map_pipeline")
+# - optionally write checkpoints of long runs and resume them after a crash
+#   (see "checkpoint.py")
 ###############################################################################
 # IMPORT LIBRARIES
 
+import argparse
 import csv
-import codecs
+import io
+import multiprocessing
+import os
 import pprint
+import queue
 import re
-import xml.etree.cElementTree as ET
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from itertools import repeat
+from operator import itemgetter
 import cerberus
 import schema
+from checkpoint import CHECKPOINT_PATH
+from checkpoint import Checkpoint
+from checkpoint import input_info
+from checkpoint import load_checkpoint
+from checkpoint import truncate_outputs
+from fast_validator import FastValidator
+from load_into_sql import LOAD_PRAGMAS
+from load_into_sql import TagEncoder
+from load_into_sql import create_indexes
+from load_into_sql import create_tables
+from load_into_sql import insert_statement
+from osm_io import OsmRecord
+from osm_io import PARSERS
+from osm_io import block_records
+from osm_io import detect_parser
+from osm_io import element_blocks
+from osm_io import is_compressed
+from osm_io import last_element
+from osm_io import open_osm
+from osm_io import range_records
+from osm_io import record_from_element
+from osm_io import split_ranges
+from run_stats import RunStats
+from run_stats import SamplingProfiler
+from run_stats import write_report
 from audit import update_country
 from audit import update_city
 from audit import update_phone
@@ -40,6 +88,8 @@ NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+# summary of the last run: stage timers, counters and profile
+REPORT_PATH = "process_map_report.json"
 
 # tag value pattern with : such as "addr:street"
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
@@ -56,194 +106,930 @@ WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
 
+# csv files and their fields in the order they are written
+CSV_PATHS = [NODES_PATH, NODE_TAGS_PATH, WAYS_PATH, WAY_NODES_PATH, WAY_TAGS_PATH]
+CSV_FIELDS = [NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS]
+
+# sqlite tables in the same order as the csv files
+SQL_TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags']
+# number of shaped elements inserted with one executemany per table
+SQL_BATCH = 10000
+# number of shaped elements inserted in one transaction
+SQL_COMMIT_EVERY = 500000
+
+# validators to choose from, the compiled one is built from the schema once
+VALIDATORS = {'fast': lambda: FastValidator(SCHEMA),
+              'cerberus': cerberus.Validator}
+# number of shaped elements validated at a time
+VALIDATE_BATCH = 1000
+# number of shaped elements collected before the csv rows are written
+CSV_BATCH = 5000
+# tag keys whose split is cached, the cache starts over when it is full
+KEY_CACHE_SIZE = 100000
+# the split of a tag key only depends on the key, it is computed once per
+# distinct key and looked up afterwards (see split_key)
+KEY_CACHES = {}
+
+# approximate size of the byte ranges handed to worker processes
+CHUNK_SIZE = 64 * 1024 * 1024
+# blocks of raw XML handed to the workers of the pipeline, whose results
+# may wait in a queue (default 2 per worker) before they are written
+PIPELINE_DEPTH = 2
+
+###############################################################################
+# REGISTER CLEANING FUNCTIONS
+
+# The values of a tag are cleaned by the function registered for its full key
+# (e.g. "addr:city"). Node and way tags use the same registry. The functions
+# only depend on the value, their results are kept in a bounded LRU cache
+# since the same values come up again and again.
+CLEANERS = {}
+# number of cleaned values cached per cleaning function
+CLEANER_CACHE_SIZE = 10000
+# (hits, misses) of the cache of every cleaning function at the last
+# take_counts, the caches stay warm for the whole run and across runs
+CACHE_COUNTS = {}
+
+def register_cleaner(key, function, maxsize=CLEANER_CACHE_SIZE):
+    """Clean the values of tags with the full key "key" with "function" """
+    CLEANERS[key] = lru_cache(maxsize)(function)
+    CACHE_COUNTS.pop(key, None)
+    # the cached key splits hold the cleaning function of a key
+    KEY_CACHES.clear()
+
+def cleaner_stats():
+    """Calls, cache hits, hit rate and cache size of every cleaning function
+    since it was registered"""
+    stats = {}
+    for key, cleaner in sorted(CLEANERS.items()):
+        info = cleaner.cache_info()
+        calls = info.hits + info.misses
+        stats[key] = {'calls': calls, 'hits': info.hits,
+                      'hit_rate': round(info.hits / float(calls), 3) if calls else None,
+                      'size': info.currsize, 'maxsize': info.maxsize}
+    return stats
+
+# the cleaning functions developed in audit.py
+register_cleaner("addr:country", update_country)
+register_cleaner("addr:city", update_city)
+register_cleaner("contact:phone", update_phone)
+# register_cleaner("addr:street", update_streetname)
+
 ###############################################################################
 # DEFINE SHAPE ELEMENT FUNCTION
 
+def key_cache(problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """The cache of split_key for one set of arguments"""
+    cache = KEY_CACHES.get((problem_chars, default_tag_type))
+    if cache is None:
+        cache = KEY_CACHES[(problem_chars, default_tag_type)] = {}
+    return cache
+
+def split_key(k, problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    """Return (type, key, cleaner) for a tag key or None if the tag is
+    skipped. "cleaner" is the registered cleaning function of the key or
+    None"""
+    cache = key_cache(problem_chars, default_tag_type)
+    if k in cache:
+        return cache[k]
+    # if attribute has pattern something:something
+    if LOWER_COLON.match(k):
+        # first part is the type, the rest is the key
+        tag_type, key = k.split(":", 1)
+        split = (tag_type, key, CLEANERS.get(k))
+    # if attribute has any of several special characters ignore entry
+    elif problem_chars.match(k):
+        split = None
+    # for "regular" attributes the type is always "regular", cleaning
+    # functions can be registered for them as well
+    else:
+        split = (default_tag_type, k, CLEANERS.get(k))
+    if len(cache) >= KEY_CACHE_SIZE:
+        cache.clear()
+    cache[k] = split
+    return split
+
+# counters of the current run: values changed by the cleaning functions and
+# tag keys skipped because of problem characters. They are only touched for
+# these rare tags and moved into the RunStats of the run by take_counts, the
+# calls and cache hits come from the caches of the cleaning functions
+CLEANER_CHANGES = Counter()
+SKIPPED_KEYS = Counter()
+
+def take_counts(stats=None):
+    """Move the counters of the current run into a RunStats and reset them.
+    The calls and hits of the cleaning functions are counted since the last
+    take_counts, their caches are kept."""
+    for key, cleaner in CLEANERS.items():
+        info = cleaner.cache_info()
+        hits, misses = CACHE_COUNTS.get(key, (0, 0))
+        hits, misses = info.hits - hits, info.misses - misses
+        if stats is not None and hits + misses:
+            stats.count('cleaner_calls', {key: hits + misses})
+            stats.count('cleaner_hits', {key: hits})
+        CACHE_COUNTS[key] = (info.hits, info.misses)
+    for name, counter in (('cleaner_changes', CLEANER_CHANGES),
+                          ('skipped_keys', SKIPPED_KEYS)):
+        if stats is not None:
+            stats.count(name, counter)
+        counter.clear()
+
+# parse the tags of a top level element into a list of
+# (id, key, value, type) rows, node and way tags are shaped the same way
+def shape_tag_rows(element_id, element_tags, problem_chars=PROBLEMCHARS,
+                   default_tag_type='regular'):
+    rows = []
+    cache = key_cache(problem_chars, default_tag_type)
+    for k, v in element_tags:
+        split = cache.get(k, False)
+        if split is False:
+            split = split_key(k, problem_chars, default_tag_type)
+        if split is None:
+            SKIPPED_KEYS[k] += 1
+            continue
+        tag_type, key, cleaner = split
+        if cleaner is not None:
+            value = cleaner(v)
+            if value != v:
+                CLEANER_CHANGES[k] += 1
+            v = value
+        rows.append((element_id, key, v, tag_type))
+    return rows
+
+
+def row_getter(fields):
+    """Function that picks the attributes of a row in the order of fields"""
+    if len(fields) == 1:
+        return lambda attrib: (attrib[fields[0]],)
+    return itemgetter(*fields)
+
+# the row getters of the default fields are built once
+NODE_ROW = row_getter(NODE_FIELDS)
+WAY_ROW = row_getter(WAY_FIELDS)
+
+
+class ShapedElement(object):
+    """A shaped node or way as rows in the order of the csv fields:
+
+        row: tuple of the NODE_FIELDS or WAY_FIELDS
+        tags: list of (id, key, value, type) tuples
+        nodes: list of (id, node_id, position) tuples, ways only
+    """
+    __slots__ = ('tag', 'row', 'tags', 'nodes')
+
+    def __init__(self, tag, row, tags, nodes=()):
+        self.tag = tag
+        self.row = row
+        self.tags = tags
+        self.nodes = nodes
+
+    def as_dict(self, node_fields=NODE_FIELDS, way_fields=WAY_FIELDS):
+        """The dictionaries of shape_element"""
+        if self.tag == 'node':
+            return {'node': dict(zip(node_fields, self.row)),
+                    'node_tags': [dict(zip(NODE_TAGS_FIELDS, t)) for t in self.tags]}
+        return {'way': dict(zip(way_fields, self.row)),
+                'way_nodes': [dict(zip(WAY_NODES_FIELDS, n)) for n in self.nodes],
+                'way_tags': [dict(zip(WAY_TAGS_FIELDS, t)) for t in self.tags]}
+
 # parse the information from each parent ement and it's 
-# childeren into dictionaries. "element" refers to a single top level node
-def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
-                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
-    
-    # initialite empty dictionaries and lissts
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
-    tags = []  
+# childeren into rows. "element" refers to a single top level node,
+# either an ElementTree element or an OsmRecord of one of the parser backends
+def shape_rows(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+               problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+
+    # ElementTree elements are reduced to the records the backends emit
+    if not isinstance(element, OsmRecord):
+        element = record_from_element(element)
+    attrib = element.attrib
 
     # if top level tag is "node"
     if element.tag == 'node':
-        # check if top level node attributes belong to NODE_FIELDS
-        for node in NODE_FIELDS:
-            # and collect them to  node_attribs dictionary
-            node_attribs[node] = element.attrib[node]
-
-        # initialize empty dictionary for tags
-        node_tags_dict = {}
-
-        # collect attributes of childs 
-        for child in element:
-            # if attribute has pattern something:something 
-            if LOWER_COLON.match(child.attrib["k"]):
-                # store first part as type in node_tags_dict
-                node_tags_dict['type'] =  child.attrib["k"].split(":",2)[0]
-                # store second part as key in node_tags_dict
-                node_tags_dict['key']  =  child.attrib["k"].split(":",1)[1]
-                # store id as id in node_tags_dict
-                node_tags_dict['id']   =  element.attrib['id']
-                # if child.attrib["k"] == "addr:street":
-                # node_tags_dict["value"] = update_streetname(child.attrib["v"])
-                # apply cleaning functions if child.attrib["k"] matches
-                if child.attrib["k"] == "addr:country":
-                    node_tags_dict["value"] = update_country(child.attrib["v"])
-                elif child.attrib["k"] == "addr:city":
-                    node_tags_dict["value"] = update_city(child.attrib["v"])
-                elif child.attrib["k"] == "contact:phone":
-                    node_tags_dict["value"] = update_phone(child.attrib["v"])
-                else:
-                    node_tags_dict["value"] = child.attrib["v"]
-                # otherwise just use regular value and append to tag list 
-                tags.append(node_tags_dict)
-            # if attribute has any of several special characters ignore entry
-            elif PROBLEMCHARS.match(child.attrib["k"]):
-                continue
-            # for "regular"  attributes
-            else:
-                # type is always "regular"
-                node_tags_dict['type']  = "regular"
-                # store key as key in node_tags_dict
-                node_tags_dict['key']   = child.attrib["k"]
-                # store id as id in node_tags_dict                                
-                node_tags_dict['id']    = element.attrib['id']
-                # If there would be any cleaning functions that refer to 
-                # regular child.attrib["k"] they need to replace the line
-                # below
-                # store value as value in node_tags_dict               
-                node_tags_dict["value"] = child.attrib['v']
-                tags.append(node_tags_dict)
-        return {'node': node_attribs, 'node_tags': tags}
-
-    # procedure is basically the same as above except the distinction between
-    # child tag "tag" and "nd"
+        # collect the top level node attributes in the order of NODE_FIELDS
+        row = (NODE_ROW if node_attr_fields is NODE_FIELDS else row_getter(node_attr_fields))(attrib)
+        tags = shape_tag_rows(attrib['id'], element.tags, problem_chars,
+                              default_tag_type) if element.tags else []
+        return ShapedElement('node', row, tags)
+
+    # procedure is basically the same as above except the additional "nd"
+    # children that are collected with their position
     elif element.tag == 'way':
-        for field in WAY_FIELDS:
-            way_attribs[field] = element.attrib[field]
-
-        position = 0
-        way_tags_dict = {}
-        way_nodes_dict = {}
-
-        for child in element:
-            if child.tag == 'tag':
-                if LOWER_COLON.match(child.attrib["k"]):
-                    way_tags_dict['type'] =  child.attrib["k"].split(":",2)[0]
-                    way_tags_dict['key']  = child.attrib["k"].split(":",1)[1]
-                    way_tags_dict['id']   = element.attrib['id']
-                    #if child.attrib["k"] == "addr:street":
-                    #    way_tags_dict["value"] = update_streetname(child.attrib["v"])
-                    if child.attrib["k"] == "addr:country":
-                        way_tags_dict["value"] = update_country(child.attrib["v"])
-                    elif child.attrib["k"] == "addr:city":
-                        way_tags_dict["value"] = update_city(child.attrib["v"])
-                    elif child.attrib["k"] == "contact:phone":
-                        way_tags_dict["value"] = update_phone(child.attrib["v"])
-                    else:
-                        way_tags_dict["value"] = child.attrib["v"]
-                        tags.append(way_tags_dict)
-                elif PROBLEMCHARS.match(child.attrib["k"]):
-                    continue
-                else:
-                    way_tags_dict['type']  = "regular"
-                    way_tags_dict['key']   = child.attrib["k"]
-                    way_tags_dict['id']    = element.attrib['id']
-                    way_tags_dict["value"] = child.attrib['v']
-                    tags.append(way_tags_dict)
-            elif child.tag == "nd":
-                way_nodes_dict['id'] = element.attrib['id']
-                way_nodes_dict['node_id'] = child.attrib['ref']
-                way_nodes_dict['position'] = position
-                position += 1
-                way_nodes.append(way_nodes_dict)
-        #print({'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags})
-        return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+        element_id = attrib['id']
+        row = (WAY_ROW if way_attr_fields is WAY_FIELDS else row_getter(way_attr_fields))(attrib)
+        tags = shape_tag_rows(element_id, element.tags, problem_chars,
+                              default_tag_type) if element.tags else []
+        nds = element.nds
+        nodes = list(zip(repeat(element_id, len(nds)), nds, range(len(nds))))
+        return ShapedElement('way', row, tags, nodes)
+
+# the dictionaries for the schema, see ShapedElement.as_dict
+def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
+                  problem_chars=PROBLEMCHARS, default_tag_type='regular'):
+    shaped = shape_rows(element, node_attr_fields, way_attr_fields, problem_chars,
+                        default_tag_type)
+    if shaped is not None:
+        return shaped.as_dict(node_attr_fields, way_attr_fields)
 
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
 def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag"""
+    """Yield element if it is the right type of tag, .gz and .bz2 files are
+    decompressed on the fly"""
 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    source = open_osm(osm_file) if isinstance(osm_file, str) else osm_file
+    try:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+    finally:
+        if source is not osm_file:
+            source.close()
 
 
 def validate_element(element, validator, schema=SCHEMA):
     """Raise ValidationError if element does not match schema"""
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        field, errors = next(iter(validator.errors.items()))
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
 
         raise Exception(message_string.format(field, error_string))
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+def validate_elements(elements, validator, schema=SCHEMA):
+    """Raise ValidationError if any of the elements does not match schema.
+    Validators with "validate_batch" check the whole list at once"""
+    if isinstance(validator, FastValidator):
+        if validator.schema is not schema:
+            validator.compile(schema)
+        invalid = validator.validate_batch(elements)
+        if invalid:
+            validate_element(elements[invalid[0][0]], validator, schema)
+    else:
+        for element in elements:
+            validate_element(element, validator, schema)
+
+
+def validate_shaped(batch, validator, schema=SCHEMA):
+    """Raise ValidationError if any ShapedElement does not match schema. The
+    FastValidator checks the rows as they are, other validators get the
+    dictionaries of shape_element"""
+    if not isinstance(validator, FastValidator):
+        validate_elements([shaped.as_dict() for shaped in batch], validator, schema)
+        return
+    if validator.schema is not schema:
+        validator.compile(schema)
+    node = validator.row_checker('node', NODE_FIELDS)
+    node_tag = validator.row_checker('node_tags', NODE_TAGS_FIELDS)
+    way = validator.row_checker('way', WAY_FIELDS)
+    way_node = validator.row_checker('way_nodes', WAY_NODES_FIELDS)
+    way_tag = validator.row_checker('way_tags', WAY_TAGS_FIELDS)
+    for shaped in batch:
+        if shaped.tag == 'node':
+            valid = node(shaped.row) and all(map(node_tag, shaped.tags))
+        else:
+            valid = way(shaped.row) and all(map(way_tag, shaped.tags)) and \
+                all(map(way_node, shaped.nodes))
+        if not valid:
+            # the dictionaries give the same error message as before
+            validate_element(shaped.as_dict(), validator, schema)
+
+
+def convert_records(records, sink, validate, validator, stats=None):
+    """Shape the records, validate them if "validate" is True and hand them
+    to the sink in batches of VALIDATE_BATCH elements. A batch is only written
+    after all of its elements are valid. The time spent reading, shaping,
+    validating and writing every batch is added to "stats" (a RunStats).
+
+        Output:
+            number of records read
+    """
+    stats = stats if stats is not None else RunStats()
+    clock = time.perf_counter
+    records = iter(records)
+    add = sink.add
+    count = 0
+    take_counts()
+    while True:
+        t0 = clock()
+        batch = list(islice(records, VALIDATE_BATCH))
+        t1 = clock()
+        if not batch:
+            stats.add('parse', t1 - t0)
+            break
+        shaped = [element for element in map(shape_rows, batch) if element is not None]
+        t2 = clock()
+        if validate is True:
+            validate_shaped(shaped, validator)
+        t3 = clock()
+        for element in shaped:
+            add(element)
+        t4 = clock()
+        stats.add('parse', t1 - t0, len(batch))
+        stats.add('shape', t2 - t1, len(batch))
+        stats.add('validate', t3 - t2, len(shaped) if validate is True else 0)
+        stats.add('write', t4 - t3, len(shaped))
+        count += len(batch)
+    take_counts(stats)
+    return count
+
+
+class CsvSink(object):
+    """Write shaped elements to the five csv files. The rows are collected
+    per file and written with plain csv writers every "batch_size" elements.
+    Python 3's csv module handles unicode itself. With "append" the rows go
+    to the end of existing files, e.g. to resume a run."""
+
+    def __init__(self, paths=CSV_PATHS, header=True, batch_size=CSV_BATCH, append=False):
+        self.paths = list(paths)
+        self.setup([open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+                    for path in paths], batch_size)
+        if header:
+            for writer, fields in zip(self.writers, CSV_FIELDS):
+                writer.writerow(fields)
+
+    def setup(self, files, batch_size):
+        self.files = files
+        self.writers = [csv.writer(f) for f in files]
+        self.buffers = [[] for f in files]
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def add(self, shaped):
+        """Collect the rows of a ShapedElement"""
+        buffers = self.buffers
+        if shaped.tag == 'node':
+            buffers[0].append(shaped.row)
+            buffers[1].extend(shaped.tags)
+        else:
+            buffers[2].append(shaped.row)
+            buffers[3].extend(shaped.nodes)
+            buffers[4].extend(shaped.tags)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.write()
+
+    def write(self):
+        for writer, rows in zip(self.writers, self.buffers):
+            if rows:
+                writer.writerows(rows)
+                del rows[:]
+        self.pending = 0
+
+    def append_chunk(self, paths):
+        """Append the five csv files (without header) written by a worker"""
+        self.flush()
+        for out, path in zip(self.files, paths):
+            with open(path, 'r', newline='', encoding='utf-8') as chunk:
+                shutil.copyfileobj(chunk, out)
+
+    def append_text(self, texts):
+        """Append the csv text (without header) of the five files"""
+        self.write()
+        for out, text in zip(self.files, texts):
+            out.write(text)
+
+    def append_table(self, position, text):
+        """Append csv text to one of the files. The pipeline of process_map
+        calls this from one writer thread per file."""
+        self.files[position].write(text)
+
+    def flush(self):
+        self.write()
+        for f in self.files:
+            f.flush()
+
+    def positions(self):
+        """Write everything to disk and return the size of every file"""
+        self.flush()
+        for f in self.files:
+            os.fsync(f.fileno())
+        return [f.buffer.tell() for f in self.files]
+
+    def close(self):
+        self.write()
+        for f in self.files:
+            f.close()
+
+
+class CsvTextSink(CsvSink):
+    """CsvSink that writes the csv text of the five files (without header)
+    into memory, used by the workers of the pipeline"""
+
+    def __init__(self, batch_size=CSV_BATCH):
+        self.setup([io.StringIO() for path in CSV_PATHS], batch_size)
+
+    def texts(self):
+        self.write()
+        return [f.getvalue() for f in self.files]
+
+    def close(self):
+        self.write()
+
+
+class SqliteSink(object):
+    """Insert shaped elements straight into the nodes, nodes_tags, ways,
+    ways_nodes and ways_tags tables of a sqlite database instead of csv files.
+    Existing tables are replaced by the typed tables of load_into_sql.py.
+    Rows are collected per table and inserted with executemany in large
+    transactions with journaling and syncing turned off, the indexes are only
+    built in "close". With "encoded" the tags are dictionary encoded (see
+    load_into_sql.py)."""
+
+    def __init__(self, database, batch_size=SQL_BATCH, commit_every=SQL_COMMIT_EVERY,
+                 encoded=False):
+        # the writer thread of the pipeline inserts while this thread waits
+        self.con = sqlite3.connect(database, isolation_level=None, check_same_thread=False)
+        for pragma in LOAD_PRAGMAS:
+            self.con.execute(pragma)
+        create_tables(self.con, SQL_TABLES, encoded)
+        self.encoder = TagEncoder() if encoded else None
+        self.inserts = [insert_statement(t, encoded) for t in SQL_TABLES]
+        self.buffers = [[] for table in SQL_TABLES]
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.pending = 0
+        self.uncommitted = 0
+        self.con.execute('BEGIN')
 
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+    def add(self, shaped):
+        """Collect the rows of a ShapedElement, insert when a batch is full"""
+        buffers = self.buffers
+        if shaped.tag == 'node':
+            buffers[0].append(shaped.row)
+            buffers[1].extend(shaped.tags)
+        else:
+            buffers[2].append(shaped.row)
+            buffers[3].extend(shaped.nodes)
+            buffers[4].extend(shaped.tags)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
 
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+    def append_chunk(self, paths):
+        """Insert the five csv files (without header) written by a worker"""
+        self.flush()
+        for table, insert, path in zip(SQL_TABLES, self.inserts, paths):
+            with open(path, 'r', newline='', encoding='utf-8') as chunk:
+                self.insert(table, insert, csv.reader(chunk))
+        self.commit()
+
+    def append_text(self, texts):
+        """Insert the csv text (without header) of the five tables"""
+        self.flush()
+        for table, insert, text in zip(SQL_TABLES, self.inserts, texts):
+            self.insert(table, insert, csv.reader(io.StringIO(text)))
+        self.commit()
+
+    def insert(self, table, insert, rows):
+        if self.encoder is None:
+            self.con.executemany(insert, rows)
+        else:
+            self.con.executemany(insert, self.encoder.rows(table, rows))
+            self.encoder.write(self.con)
+
+    def flush(self):
+        for table, insert, rows in zip(SQL_TABLES, self.inserts, self.buffers):
+            if rows:
+                self.insert(table, insert, rows)
+                del rows[:]
+        self.uncommitted += self.pending
+        self.pending = 0
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.con.execute('COMMIT')
+        self.con.execute('BEGIN')
+        self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.con.execute('COMMIT')
+        create_indexes(self.con)
+        self.con.close()
+
+
+class TeeSink(object):
+    """Hand shaped elements to several sinks, e.g. the csv files and the
+    columnar node store of node_store.py"""
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def add(self, shaped):
+        for sink in self.sinks:
+            sink.add(shaped)
+
+    def append_chunk(self, paths):
+        for sink in self.sinks:
+            sink.append_chunk(paths)
+
+    def append_text(self, texts):
+        for sink in self.sinks:
+            sink.append_text(texts)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+# ================================================== #
+#               Parallel Processing                  #
+# ================================================== #
+def process_chunk(args):
+    """Shape (and validate) the elements of one byte range of the XML file and
+    write them to five csv files without header. Runs in a worker process.
+
+        Output:
+            the csv filenames and the RunStats of the chunk as dict
+    """
+    file_in, start, end, validate, validator, parser, paths, profile = args
+    stats = RunStats()
+    profiler = SamplingProfiler(profile).start() if profile else None
+    sink = CsvSink(paths, header=False)
+    records = range_records(file_in, start, end, ('node', 'way'), parser)
+    try:
+        convert_records(records, sink, validate, VALIDATORS[validator](), stats)
+        t0 = time.perf_counter()
+    finally:
+        sink.close()
+        if profiler is not None:
+            profiler.stop()
+    stats.add('write', time.perf_counter() - t0)
+    if profiler is not None:
+        stats.add_profile(profiler.as_dict())
+    return paths, stats.as_dict()
+
+
+def process_map_parallel(file_in, validate, workers, validator, parser, sink,
+                         stats, profile=None):
+    """Split the XML file into byte ranges aligned to top level elements,
+    shape them in a pool of worker processes and hand the per chunk csv files
+    to the sink in file order. OSM extracts are sorted by id within each
+    element type, so the output is the same as a serial run. The RunStats of
+    the workers are merged into "stats", handing the chunks to the sink is
+    the "merge" stage.
+    """
+    size = os.path.getsize(file_in)
+    n_chunks = max(workers, -(-size // CHUNK_SIZE))
+    ranges = split_ranges(file_in, n_chunks)
+    tmp_dir = tempfile.mkdtemp(prefix='osm_chunks_',
+                               dir=os.path.dirname(os.path.abspath(NODES_PATH)))
+    tasks = []
+    for i, (start, end) in enumerate(ranges):
+        paths = [os.path.join(tmp_dir, '{0:05d}_{1}'.format(i, os.path.basename(p)))
+                 for p in CSV_PATHS]
+        tasks.append((file_in, start, end, validate, validator, parser, paths, profile))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # imap hands back the chunks in order while later ones are still parsed
+        for paths, chunk_stats in pool.imap(process_chunk, tasks):
+            t0 = time.perf_counter()
+            sink.append_chunk(paths)
+            for path in paths:
+                os.remove(path)
+            stats.add('merge', time.perf_counter() - t0)
+            stats.merge(chunk_stats)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        t0 = time.perf_counter()
+        sink.close()
+        stats.add('merge', time.perf_counter() - t0)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# ================================================== #
+#               Pipelined Processing                 #
+# ================================================== #
+def shape_block(args):
+    """Shape (and validate) the elements of one block of raw XML (see
+    osm_io.element_blocks). Runs in a worker process, only the bytes and the
+    csv text travel between the processes.
+
+        Output:
+            the csv text (without header) of the five files and the RunStats
+            of the block as dict
+    """
+    block, validate, validator, parser, profile = args
+    stats = RunStats()
+    profiler = SamplingProfiler(profile).start() if profile else None
+    sink = CsvTextSink()
+    records = block_records(block, ('node', 'way'), parser)
+    try:
+        convert_records(records, sink, validate, VALIDATORS[validator](), stats)
+        t0 = time.perf_counter()
+        texts = sink.texts()
+        stats.add('write', time.perf_counter() - t0)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    if profiler is not None:
+        stats.add_profile(profiler.as_dict())
+    return texts, stats.as_dict()
+
+
+class TableWriter(threading.Thread):
+    """Thread that hands the items of a bounded queue to "write" in order.
+    put() blocks while the queue is full, so a slow disk holds back the
+    parser instead of filling the memory. An error of "write" is kept in
+    "error" and the rest of the queue is drained, put(None) ends the thread.
+    """
+
+    def __init__(self, write, depth, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.write = write
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.seconds = 0.0
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            if self.error is None:
+                t0 = time.perf_counter()
+                try:
+                    self.write(item)
+                except BaseException as e:
+                    self.error = e
+                self.seconds += time.perf_counter() - t0
+            self.queue.task_done()
+
+    def drain(self):
+        """Wait until everything put so far is written"""
+        self.queue.join()
+
+    def finish(self):
+        self.put(None)
+        self.join()
+
+
+def table_writers(sink, depth):
+    """One TableWriter per csv file if the sink can write them separately
+    (CsvSink), otherwise one for the whole sink.
+
+        Output:
+            list of (writer, position of its table or None for all tables)
+    """
+    if hasattr(sink, 'append_table'):
+        return [(TableWriter(lambda text, i=i: sink.append_table(i, text), depth,
+                             'write-' + os.path.basename(path)), i)
+                for i, path in enumerate(CSV_PATHS)]
+    return [(TableWriter(sink.append_text, depth, 'write-sink'), None)]
+
+
+def process_map_pipeline(file_in, validate, workers, validator, parser, sink,
+                         stats, queue_depth=None, profile=None, checkpoint=None,
+                         start=None):
+    """Convert the XML file in three overlapping stages connected by bounded
+    queues:
+
+        read: this process cuts the (possibly compressed) file into blocks
+              of top level elements (osm_io.element_blocks)
+        shape: a pool of "workers" processes parses, shapes and validates
+              the blocks into csv text
+        output: a writer thread per output table appends the text in file
+              order
+
+    At most "queue_depth" blocks (default PIPELINE_DEPTH per worker) are in
+    the pool and at most "queue_depth" results wait for each writer. Time
+    this process is blocked by a full queue is the "wait" stage.
+
+    With a "checkpoint" (see checkpoint.py) the writers are drained and a
+    checkpoint is written whenever it is due, "start" is the offset of the
+    input to continue at.
+    """
+    queue_depth = queue_depth or PIPELINE_DEPTH * workers
+    writers = table_writers(sink, queue_depth)
+    for writer, position in writers:
+        writer.start()
+    pool = multiprocessing.Pool(workers)
+    pending = deque()
+
+    def check_writers():
+        for writer, position in writers:
+            if writer.error is not None:
+                raise writer.error
+
+    def hand_on():
+        t0 = time.perf_counter()
+        end, last, result = pending.popleft()
+        texts, block_stats = result.get()
+        check_writers()
+        for writer, position in writers:
+            writer.put(texts if position is None else texts[position])
+        stats.add('wait', time.perf_counter() - t0)
+        stats.merge(block_stats)
+        if checkpoint is not None and checkpoint.due():
+            t0 = time.perf_counter()
+            for writer, position in writers:
+                writer.drain()
+            check_writers()
+            checkpoint.save(end, last, sink.positions())
+            stats.add('checkpoint', time.perf_counter() - t0)
+
+    try:
+        blocks = element_blocks(file_in, start=start)
+        while True:
+            t0 = time.perf_counter()
+            item = next(blocks, None)
+            stats.add('read', time.perf_counter() - t0)
+            if item is None:
+                break
+            offset, block = item
+            last = last_element(block) if checkpoint is not None else None
+            pending.append((offset + len(block), last, pool.apply_async(
+                shape_block, ((block, validate, validator, parser, profile),))))
+            if len(pending) >= queue_depth:
+                hand_on()
+        while pending:
+            hand_on()
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        t0 = time.perf_counter()
+        for writer, position in writers:
+            writer.finish()
+        stats.add('wait', time.perf_counter() - t0)
+        for writer, position in writers:
+            stats.add('output', writer.seconds)
+        t0 = time.perf_counter()
+        sink.close()
+        stats.add('output', time.perf_counter() - t0)
+    for writer, position in writers:
+        if writer.error is not None:
+            raise writer.error
+
+
+def process_map_blocks(file_in, validate, validator, parser, sink, stats,
+                       checkpoint, start=None):
+    """Convert the XML file in this process block by block (see
+    osm_io.element_blocks) and write a checkpoint between two blocks when it
+    is due. "start" is the offset of the input to continue at."""
+    validator = VALIDATORS[validator]()
+    blocks = element_blocks(file_in, start=start)
+    while True:
+        t0 = time.perf_counter()
+        item = next(blocks, None)
+        stats.add('read', time.perf_counter() - t0)
+        if item is None:
+            break
+        offset, block = item
+        convert_records(block_records(block, ('node', 'way'), parser), sink, validate,
+                        validator, stats)
+        if checkpoint.due():
+            t0 = time.perf_counter()
+            checkpoint.save(offset + len(block), last_element(block), sink.positions())
+            stats.add('checkpoint', time.perf_counter() - t0)
 
 
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
-
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+def process_map(file_in, validate, workers=1, validator='fast', parser='expat',
+                sink=None, report=REPORT_PATH, profile=None, pipeline=False,
+                queue_depth=None, checkpoint=None, resume=False):
+    """Iteratively process each XML element and write to csv(s). With more
+    than one worker the file is processed in parallel chunks. "validator"
+    names one of VALIDATORS and "parser" the backend of osm_io.PARSERS that
+    reads the XML file. Pass e.g. SqliteSink("fk_map") as "sink" to load the
+    elements into a database instead of the csv files. Compressed .gz and
+    .bz2 files can not be split into byte ranges, they are shaped in this
+    process while osm_io decompresses them in parallel. PBF files are read
+    with the "pbf" backend whatever "parser" says.
+
+    "pipeline" overlaps reading, shaping in "workers" processes and writing
+    each table in its own thread (see process_map_pipeline), also for
+    compressed files; "queue_depth" bounds the blocks in flight. PBF files
+    are not split into XML blocks and take the other paths.
+
+    "checkpoint" is the filename of the checkpoints of a long run (see
+    checkpoint.py), they need the csv files of a CsvSink and the file is
+    converted block by block (pipelined with more than one worker). With
+    "resume" the run continues after the checkpoint of an earlier run with
+    the same file and options, its csv files are cut back and appended to.
+    Without a checkpoint the run starts from the beginning.
+
+    Every run is timed per stage (see run_stats.py), the summary is returned
+    and written as JSON to "report" unless it is None. "profile" turns on the
+    SamplingProfiler with a sample every "profile" seconds (e.g. 0.005), in
+    this process and in the workers."""
+
+    started = time.perf_counter()
+    stats = RunStats()
+    parser = detect_parser(file_in, parser)
+    checkpointer = None
+    start = None
+    if checkpoint is not None or resume:
+        if parser == 'pbf':
+            raise ValueError("checkpoints are only written for XML files")
+        checkpoint = checkpoint or CHECKPOINT_PATH
+        info = dict(input_info(file_in), parser=parser, validate=validate is True,
+                    validator=validator)
+        state = load_checkpoint(checkpoint, info) if resume else None
+        if state is not None:
+            if sink is not None:
+                raise ValueError("a resumed run writes to the csv files of its checkpoint, "
+                                 "it takes no sink")
+            truncate_outputs(state['paths'], state['positions'])
+            sink = CsvSink(state['paths'], header=False, append=True)
+            start = state['offset']
+        elif sink is None:
+            sink = CsvSink(CSV_PATHS)
+        if not hasattr(sink, 'positions'):
+            raise ValueError("checkpoints need the csv files of a CsvSink")
+        info['paths'] = sink.paths
+        checkpointer = Checkpoint(checkpoint, info)
+        pipeline = pipeline or workers > 1
+    if sink is None:
+        sink = CsvSink(CSV_PATHS)
+    pipeline = pipeline and parser != 'pbf'
+    if pipeline:
+        process_map_pipeline(file_in, validate, workers, validator, parser, sink,
+                             stats, queue_depth, profile, checkpointer, start)
+    elif workers > 1 and not is_compressed(file_in):
+        process_map_parallel(file_in, validate, workers, validator, parser, sink,
+                             stats, profile)
+    else:
+        workers = 1
+        profiler = SamplingProfiler(profile).start() if profile else None
+        try:
+            if checkpointer is not None:
+                process_map_blocks(file_in, validate, validator, parser, sink, stats,
+                                   checkpointer, start)
+            else:
+                records = PARSERS[parser](file_in, ('node', 'way'))
+                convert_records(records, sink, validate, VALIDATORS[validator](), stats)
+            t0 = time.perf_counter()
+        finally:
+            sink.close()
+            if profiler is not None:
+                profiler.stop()
+        stats.add('write', time.perf_counter() - t0)
+        if profiler is not None:
+            stats.add_profile(profiler.as_dict())
+    if checkpointer is not None:
+        # the outputs are complete, there is nothing left to resume
+        checkpointer.remove()
+
+    summary = stats.report(time.perf_counter() - started, file=file_in, parser=parser,
+                           workers=workers, validate=validate is True,
+                           validator=validator, sink=type(sink).__name__,
+                           pipeline=pipeline)
+    if checkpointer is not None:
+        summary['checkpoints'] = checkpointer.count
+        summary['resumed_at'] = start
+    calls = stats.counters.get('cleaner_calls', {})
+    hits = stats.counters.get('cleaner_hits', {})
+    summary['cleaner_hit_rate'] = dict((key, round(hits.get(key, 0) / float(n), 3))
+                                       for key, n in sorted(calls.items()) if n)
+    if report is not None:
+        write_report(summary, report)
+    return summary
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Clean an OSM XML file and convert it to csv files")
+    parser.add_argument("osm_file", nargs="?", default=OSM_PATH)
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--validator", choices=sorted(VALIDATORS), default="fast")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="overlap reading, shaping and writing")
+    parser.add_argument("--checkpoint", nargs="?", const=CHECKPOINT_PATH,
+                        help="write checkpoints to CHECKPOINT (default %(const)s)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue after the last checkpoint of a run that did not finish")
+    args = parser.parse_args()
+
+    # Note: Validation with cerberus is ~ 10X slower, the compiled validator
+    # only adds a small fraction to the run and can stay on.
+    summary = process_map(args.osm_file, validate=True, workers=args.workers,
+                          validator=args.validator, pipeline=args.pipeline,
+                          checkpoint=args.checkpoint, resume=args.resume)
+    print("converted {0} elements in {1} s".format(summary['elements'], summary['wall_seconds']))
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating.
-    process_map(OSM_PATH, validate = False)
\ No newline at end of file
+    main()
@@ -0,0 +1,190 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# INSTRUMENTATION OF THE CONVERSION IN "parse_to_csv.py".
+#
+# - RunStats collects the cumulative seconds and number of elements of every
+#   stage (parse, shape, validate, write) and named counters, e.g. the values
+#   handed to each cleaning function and the tag keys skipped because of
+#   PROBLEMCHARS. The stages are timed per batch of elements, not per
+#   element, so the numbers are collected in every run.
+# - SamplingProfiler is optional: a thread that looks at the stack of the
+#   converting thread every few milliseconds and counts the functions it finds
+# - the summary of a run is written as JSON, worker processes send their
+#   RunStats as dict and the main process merges them
+#
+# Example:
+#   process_map("fk.osm", True, report="process_map_report.json", profile=0.005)
+###############################################################################
+
+import json
+import os
+import sys
+import threading
+from collections import Counter
+
+# stages of the conversion in the order they run
+STAGES = ['parse', 'shape', 'validate', 'write']
+# default seconds between two samples of the SamplingProfiler
+PROFILE_INTERVAL = 0.005
+# number of functions and keys listed in the report
+REPORT_TOP = 20
+
+
+class RunStats(object):
+    """Cumulative stage timers and counters of one conversion run"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.elements = dict.fromkeys(STAGES, 0)
+        self.counters = {}
+        self.profile = None
+
+    def add(self, stage, seconds, elements=0):
+        """Add the time and number of elements of one batch to a stage"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.elements[stage] = self.elements.get(stage, 0) + elements
+
+    def count(self, name, counts):
+        """Add a dict of counts to the counter "name" """
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = Counter()
+        counter.update(counts)
+
+    def add_profile(self, profile):
+        """Add the samples of a SamplingProfiler (as_dict) to the run"""
+        if self.profile is None:
+            self.profile = {'interval': profile['interval'], 'samples': 0,
+                            'own': Counter(), 'total': Counter()}
+        self.profile['samples'] += profile['samples']
+        self.profile['own'].update(profile['own'])
+        self.profile['total'].update(profile['total'])
+
+    def as_dict(self):
+        """Plain dict of the collected numbers, e.g. to send from a worker"""
+        return {'seconds': dict(self.seconds), 'elements': dict(self.elements),
+                'counters': dict((name, dict(c)) for name, c in self.counters.items()),
+                'profile': None if self.profile is None else
+                dict(self.profile, own=dict(self.profile['own']),
+                     total=dict(self.profile['total']))}
+
+    def merge(self, stats):
+        """Add the numbers of another run (as_dict), e.g. of a worker"""
+        for stage, seconds in stats['seconds'].items():
+            self.add(stage, seconds, stats['elements'].get(stage, 0))
+        for name, counts in stats['counters'].items():
+            self.count(name, counts)
+        if stats['profile'] is not None:
+            self.add_profile(stats['profile'])
+
+    def report(self, wall_seconds, **info):
+        """Summary of the run as dict: "info" (input file, options), wall
+        time, seconds, elements/sec and share of every stage, the counters
+        and the top functions of the profile if there is one.
+
+        With several workers the stage seconds are summed over all processes,
+        so they can add up to more than the wall time."""
+        elements = self.elements.get('parse', 0)
+        busy = sum(self.seconds.values())
+        summary = dict(info)
+        summary['wall_seconds'] = round(wall_seconds, 3)
+        summary['elements'] = elements
+        summary['elements_per_second'] = rate(elements, wall_seconds)
+        summary['stages'] = dict(
+            (stage, {'seconds': round(seconds, 3),
+                     'elements': self.elements.get(stage, 0),
+                     'elements_per_second': rate(self.elements.get(stage, 0), seconds),
+                     'share': round(seconds / busy, 3) if busy else None})
+            for stage, seconds in self.seconds.items())
+        summary['counters'] = dict(
+            (name, {'total': sum(c.values()), 'top': dict(c.most_common(REPORT_TOP))})
+            for name, c in sorted(self.counters.items()))
+        if self.profile is not None:
+            samples = self.profile['samples']
+            summary['profile'] = {
+                'interval': self.profile['interval'],
+                'samples': samples,
+                'own': top_shares(self.profile['own'], samples),
+                'total': top_shares(self.profile['total'], samples)}
+        return summary
+
+
+def rate(count, seconds):
+    return round(count / seconds, 1) if seconds and count else None
+
+
+def top_shares(counter, samples):
+    """The REPORT_TOP most sampled functions with their share of samples"""
+    return [[name, n, round(n / float(samples), 3) if samples else None]
+            for name, n in counter.most_common(REPORT_TOP)]
+
+###############################################################################
+def frame_name(frame):
+    code = frame.f_code
+    return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler(object):
+    """Count the functions running in a thread (default: the one that
+    creates the profiler) every "interval" seconds:
+
+        own: the innermost function of the stack
+        total: every function on the stack, once per sample
+
+    The sampling thread only wakes up every "interval" seconds, the profiled
+    code runs unchanged.
+
+        with SamplingProfiler() as profiler:
+            ...
+        stats.add_profile(profiler.as_dict())
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.samples = 0
+        self.own = Counter()
+        self.total = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.own[frame_name(frame)] += 1
+            names = set()
+            while frame is not None:
+                names.add(frame_name(frame))
+                frame = frame.f_back
+            self.total.update(names)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def as_dict(self):
+        return {'interval': self.interval, 'samples': self.samples,
+                'own': dict(self.own), 'total': dict(self.total)}
+
+###############################################################################
+def write_report(report, filename):
+    """Write the report of a run as JSON file"""
+    with open(filename, 'w', encoding='utf-8') as out:
+        json.dump(report, out, indent=2)
@@ -1,34 +1,285 @@
 # -*- coding: utf-8 -*-
-# ONLY WORKS WITH PYTHON 2!!
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# DRAW A SMALL SAMPLE OF A .osm FILE FOR TESTING THE SCRIPTS.
+#
+# Modes:
+# - every k-th top level element (the original behaviour)
+# - reservoir: a uniform random sample of a given number of elements
+# - stratified: a fraction of every element type and tag key, rare keys are
+#   guaranteed "minimum" elements each
+# - bbox: all nodes inside a bounding box with the ways and relations that
+#   use them
+#
+# The elements are found with the byte offset index of "element_index.py"
+# (built on the first run) and copied as raw byte slices, nothing is
+# re-serialized. Unless turned off all nodes of the sampled ways are added, so
+# the sample is self-consistent. Relations are copied as they are, their
+# members are not added. .osm.gz and .osm.bz2 files are read as well, the
+# sample is written uncompressed.
+#
+# Example:
+#   python sample.py fk.osm sample.osm --fraction 0.01
+###############################################################################
 
-import xml.etree.ElementTree as ET  # Use cElementTree or lxml if too slow
+import argparse
+import math
+import os
+import random
+import numpy as np
+from xml.parsers import expat
+from element_index import ELEMENT_TYPES
+from element_index import ElementIndex
+from element_index import build_index
+from element_index import index_path
+from osm_io import READ_BLOCK
+from osm_io import open_osm
 
 OSM_FILE = "some_osm.osm"  # Replace this with your osm file
 SAMPLE_FILE = "sample.osm"
 
 k = 10 # Parameter: take every k-th top level element
 
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    """Yield element if it is the right type of tag
+# number of elements every tag key gets at least in stratified samples
+STRATUM_MINIMUM = 5
+# bytes copied from the .osm file at a time
+COPY_BLOCK = 1024 * 1024
 
-    Reference:
-    http://stackoverflow.com/questions/3095434/inserting-newlines-in-xml-file-generated-via-xml-etree-elementtree-in-python
+###############################################################################
+def open_index(osm_path):
+    """Open the element index of a .osm file, (re)build it if needed"""
+    if os.path.exists(index_path(osm_path)):
+        try:
+            return ElementIndex(osm_path)
+        except ValueError:
+            pass
+    build_index(osm_path)
+    return ElementIndex(osm_path)
+
+###############################################################################
+def file_order(index):
+    """Positions of the index sorted by byte offset"""
+    return np.argsort(index.index['offset'], kind='stable')
+
+###############################################################################
+def positions_of_offsets(index, offsets):
+    """Turn byte offsets of elements into positions of the index"""
+    order = file_order(index)
+    sorted_offsets = index.index['offset'][order]
+    return order[np.searchsorted(sorted_offsets, np.asarray(offsets, dtype=np.uint64))]
+
+###############################################################################
+# SAMPLING MODES
+#
+# Every mode returns an array of positions of the element index.
+###############################################################################
+
+def sample_every(index, k):
+    """Every k-th top level element in file order"""
+    return file_order(index)[::k]
+
+###############################################################################
+def reservoir_sample(items, n, rng):
+    """Uniform random sample of n items of a sequence with "Algorithm L",
+    which jumps over the items it skips instead of visiting every one"""
+    reservoir = list(items[:n])
+    if len(reservoir) < n or n == 0:
+        return reservoir
+    w = math.exp(math.log(rng.random()) / n)
+    i = n - 1
+    while True:
+        i += int(math.floor(math.log(rng.random()) / math.log(1.0 - w))) + 1
+        if i >= len(items):
+            return reservoir
+        reservoir[rng.randrange(n)] = items[i]
+        w *= math.exp(math.log(rng.random()) / n)
+
+
+def sample_reservoir(index, count, rng):
+    """A uniform random sample of "count" top level elements"""
+    return np.array(reservoir_sample(file_order(index), count, rng), dtype=np.int64)
+
+###############################################################################
+def visit_elements(osm_path, visit):
+    """Stream a .osm file with expat and call visit(tag, attrib, tags, nds,
+    members, offset) for every top level element, "offset" is its position
+    in the file"""
+    parser = expat.ParserCreate()
+    current = []
+
+    def finish():
+        if current:
+            visit(*current)
+            del current[:]
+
+    def start(name, attrs):
+        if current:
+            if name == 'tag':
+                current[2].append(attrs['k'])
+                return
+            if name == 'nd':
+                current[3].append(attrs['ref'])
+                return
+            if name == 'member':
+                current[4].append((attrs['type'], attrs['ref']))
+                return
+        if name in ELEMENT_TYPES:
+            finish()
+            current.extend([name, attrs, [], [], [], parser.CurrentByteIndex])
+
+    parser.StartElementHandler = start
+    with open_osm(osm_path) as osm_file:
+        while True:
+            block = osm_file.read(READ_BLOCK)
+            parser.Parse(block, not block)
+            if not block:
+                break
+    finish()
+
+
+def sample_stratified(index, osm_path, fraction, minimum, rng):
+    """Take every element with probability "fraction". On top of that every
+    stratum (element type, tag key) and (element type, untagged) keeps a
+    reservoir of "minimum" elements, so rare keys make it into the sample
+    as well."""
+    offsets = []
+    seen = {}
+    reservoirs = {}
+
+    def visit(tag, attrib, keys, nds, members, offset):
+        if rng.random() < fraction:
+            offsets.append(offset)
+        for stratum in set((tag, key) for key in keys) or [(tag, None)]:
+            n = seen.get(stratum, 0) + 1
+            seen[stratum] = n
+            reservoir = reservoirs.setdefault(stratum, [])
+            if len(reservoir) < minimum:
+                reservoir.append(offset)
+            else:
+                j = rng.randrange(n)
+                if j < minimum:
+                    reservoir[j] = offset
+
+    visit_elements(osm_path, visit)
+    for reservoir in reservoirs.values():
+        offsets.extend(reservoir)
+    return np.unique(positions_of_offsets(index, offsets))
+
+###############################################################################
+def sample_bbox(index, osm_path, min_lat, min_lon, max_lat, max_lon):
+    """All nodes inside the box, the ways with at least one of these nodes and
+    the relations with one of these nodes or ways as member"""
+    offsets = []
+    nodes = set()
+    ways = set()
+
+    def visit(tag, attrib, keys, nds, members, offset):
+        if tag == 'node':
+            if min_lat <= float(attrib['lat']) <= max_lat and \
+               min_lon <= float(attrib['lon']) <= max_lon:
+                nodes.add(attrib['id'])
+                offsets.append(offset)
+        elif tag == 'way':
+            if any(ref in nodes for ref in nds):
+                ways.add(attrib['id'])
+                offsets.append(offset)
+        elif any((member_type == 'node' and ref in nodes) or
+                 (member_type == 'way' and ref in ways) for member_type, ref in members):
+            offsets.append(offset)
+
+    visit_elements(osm_path, visit)
+    return positions_of_offsets(index, offsets)
+
+###############################################################################
+def add_way_nodes(index, positions):
+    """Add the positions of all nodes of the sampled ways (referential
+    closure), nodes missing from the file are left out"""
+    way_code = ELEMENT_TYPES.index('way')
+    positions = np.unique(positions)
+    ways = positions[index.index['type'][positions] == way_code]
+    refs = [int(ref) for record in index.records_at(ways) for ref in record.nds]
+    if not refs:
+        return positions
+    lo, hi = index.type_slices['node']
+    node_ids = index.index['id'][lo:hi]
+    refs = np.unique(np.array(refs, dtype=np.int64))
+    found = np.clip(np.searchsorted(node_ids, refs), 0, max(len(node_ids) - 1, 0))
+    found = found[node_ids[found] == refs] if len(node_ids) else found[:0]
+    return np.union1d(positions, found + lo)
+
+###############################################################################
+def write_sample(index, positions, sample_path):
+    """Copy the head of the .osm file (XML declaration, "<osm>" and
+    "<bounds>") and the raw bytes of the sampled elements in file order.
+
+        Output:
+            number of elements written
     """
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
+    entries = np.sort(index.index[np.unique(positions)], order='offset')
+    first = int(index.index['offset'].min()) if len(index) else 0
+    with open(sample_path, 'wb') as output:
+        output.write(index.read(0, first) if first else
+                     b'<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n  ')
+        # neighbouring elements are copied together
+        start = end = None
+        for offset, length in zip(entries['offset'].tolist(), entries['length'].tolist()):
+            if offset != end:
+                copy_bytes(index, start, end, output)
+                start = offset
+            end = offset + length
+        copy_bytes(index, start, end, output)
+        output.write(b'</osm>\n')
+    return len(entries)
+
 
+def copy_bytes(index, start, end, output):
+    if start is None:
+        return
+    index.osm_file.seek(start)
+    left = end - start
+    while left > 0:
+        block = index.osm_file.read(min(COPY_BLOCK, left))
+        if not block:
+            break
+        output.write(block)
+        left -= len(block)
 
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Draw a sample of a .osm file")
+    parser.add_argument("osm_file", nargs="?", default=OSM_FILE)
+    parser.add_argument("sample_file", nargs="?", default=SAMPLE_FILE)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--every", type=int, default=k, help="every k-th element (default)")
+    mode.add_argument("--count", type=int, help="reservoir sample of COUNT elements")
+    mode.add_argument("--fraction", type=float, help="stratified sample by element type and tag key")
+    mode.add_argument("--bbox", type=float, nargs=4,
+                      metavar=("MIN_LAT", "MIN_LON", "MAX_LAT", "MAX_LON"))
+    parser.add_argument("--minimum", type=int, default=STRATUM_MINIMUM,
+                        help="elements per tag key in stratified samples")
+    parser.add_argument("--seed", type=int, help="seed of the random modes")
+    parser.add_argument("--no-closure", dest="closure", action="store_false",
+                        help="do not add the nodes of the sampled ways")
+    args = parser.parse_args()
 
-    # Write every kth top level element
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+    rng = random.Random(args.seed)
+    index = open_index(args.osm_file)
+    try:
+        if args.count is not None:
+            positions = sample_reservoir(index, args.count, rng)
+        elif args.fraction is not None:
+            positions = sample_stratified(index, args.osm_file, args.fraction, args.minimum, rng)
+        elif args.bbox is not None:
+            positions = sample_bbox(index, args.osm_file, *args.bbox)
+        else:
+            positions = sample_every(index, args.every)
+        if args.closure:
+            positions = add_way_nodes(index, positions)
+        count = write_sample(index, positions, args.sample_file)
+    finally:
+        index.close()
+    print("wrote {0} of {1} elements to {2}".format(count, len(index), args.sample_file))
 
-    output.write('</osm>')
+if __name__ == '__main__':
+    main()
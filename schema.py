@@ -63,3 +63,51 @@ schema = {
         }
     }
 }
+
+# Typed sqlite tables for the five csv files. Columns keep the names of the csv
+# headers. Ids and counters are INTEGER and coordinates REAL, so sqlite's type
+# affinity converts the text values of the XML file on insert.
+sql_schema = {
+    'nodes': [('id', 'INTEGER PRIMARY KEY'), ('lat', 'REAL'), ('lon', 'REAL'),
+              ('user', 'TEXT'), ('uid', 'INTEGER'), ('version', 'TEXT'),
+              ('changeset', 'INTEGER'), ('timestamp', 'TEXT')],
+    'nodes_tags': [('id', 'INTEGER'), ('key', 'TEXT'), ('value', 'TEXT'),
+                   ('type', 'TEXT')],
+    'ways': [('id', 'INTEGER PRIMARY KEY'), ('user', 'TEXT'), ('uid', 'INTEGER'),
+             ('version', 'TEXT'), ('changeset', 'INTEGER'), ('timestamp', 'TEXT')],
+    'ways_nodes': [('id', 'INTEGER'), ('node_id', 'INTEGER'), ('position', 'INTEGER')],
+    'ways_tags': [('id', 'INTEGER'), ('key', 'TEXT'), ('value', 'TEXT'),
+                  ('type', 'TEXT')],
+}
+
+# Indexes are created after loading, which is much faster than keeping them
+# up to date row by row
+sql_indexes = [
+    'CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags (id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags (id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id)',
+]
+
+# Dictionary encoded storage of the tag tables (optional, see load_into_sql.py).
+# Every (key, type) and every value is stored once, the tag rows only hold
+# integer ids. Views named nodes_tags and ways_tags with the columns above
+# join the strings back, so queries on the tag tables work unchanged.
+sql_encoded_tags = {'nodes_tags': 'nodes_tags_encoded', 'ways_tags': 'ways_tags_encoded'}
+sql_encoded_schema = {
+    'tag_keys': [('id', 'INTEGER PRIMARY KEY'), ('key', 'TEXT'), ('type', 'TEXT')],
+    'tag_values': [('id', 'INTEGER PRIMARY KEY'), ('value', 'TEXT')],
+    'nodes_tags_encoded': [('id', 'INTEGER'), ('key_id', 'INTEGER'), ('value_id', 'INTEGER')],
+    'ways_tags_encoded': [('id', 'INTEGER'), ('key_id', 'INTEGER'), ('value_id', 'INTEGER')],
+}
+
+# replace the indexes of the tag tables in an encoded database, the unique
+# indexes of the dictionaries let the triggers of the views intern new strings
+sql_encoded_indexes = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS tag_keys_key_type ON tag_keys (key, type)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS tag_values_value ON tag_values (value)',
+    'CREATE INDEX IF NOT EXISTS nodes_tags_encoded_id ON nodes_tags_encoded (id)',
+    'CREATE INDEX IF NOT EXISTS ways_tags_encoded_id ON ways_tags_encoded (id)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes (id, position)',
+    'CREATE INDEX IF NOT EXISTS ways_nodes_node_id ON ways_nodes (node_id)',
+]
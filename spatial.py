@@ -0,0 +1,148 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# NEIGHBOURHOOD QUERIES ON THE NODES OF THE SQLITE DATABASE.
+#
+# - the R*Tree "nodes_rtree" is built by the loader ("load_into_sql.py" and
+#   the SqliteSink of "parse_to_csv.py") and kept up to date by "apply_osc.py"
+# - nodes_in_bbox: all nodes inside a bounding box
+# - nodes_within: all nodes within a radius in metres, sorted by distance
+# - nearest_nodes: the k nearest nodes, the search box grows until it is sure
+#   to hold them
+# - all three take an optional tag filter, e.g. {"amenity": "cafe"} or
+#   {"addr:street": None} (any value), which is checked with the
+#   nodes_tags (id) index for the candidates of the R*Tree only
+#
+# Example:
+#   con = sqlite3.connect("fk_map")
+#   nodes_within(con, 52.5005, 13.4190, 500, {"amenity": "cafe"})
+###############################################################################
+
+import math
+import sqlite3
+from load_into_sql import SPATIAL_INDEX
+from parse_to_csv import split_key
+
+# mean earth radius in metres
+EARTH_RADIUS = 6371008.8
+# metres per degree of latitude
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180.0
+# first search radius of nearest_nodes in metres
+KNN_START_RADIUS = 100.0
+
+###############################################################################
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres between two points in degrees"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2.0) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+###############################################################################
+def radius_bbox(lat, lon, radius):
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) around all points
+    within "radius" metres of a point"""
+    dlat = radius / METRES_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+    dlon = radius / (METRES_PER_DEGREE * cos_lat) if cos_lat > 1e-9 else 180.0
+    return lat - dlat, lon - min(dlon, 180.0), lat + dlat, lon + min(dlon, 180.0)
+
+###############################################################################
+def tag_filter(tags):
+    """Turn a dict of full tag keys ("amenity", "addr:street") and values
+    (None for any value) into SQL conditions on the node id "n.id". Keys
+    are split into type and key with split_key of parse_to_csv.py, like
+    they were when the tags were loaded.
+
+        Output:
+            (list of SQL conditions, list of parameters)
+    """
+    conditions, params = [], []
+    for k, v in sorted((tags or {}).items()):
+        split = split_key(k)
+        if split is None:
+            # tags with problem characters in the key are never loaded
+            conditions.append("0")
+            continue
+        tag_type, key, cleaner = split
+        sql = "EXISTS (SELECT 1 FROM nodes_tags t WHERE t.id = n.id AND t.key = ? AND t.type = ?"
+        params += [key, tag_type]
+        if v is not None:
+            sql += " AND t.value = ?"
+            # the stored values went through the cleaning function of the key
+            params.append(v if cleaner is None else cleaner(v))
+        conditions.append(sql + ")")
+    return conditions, params
+
+###############################################################################
+def nodes_in_bbox(con, min_lat, min_lon, max_lat, max_lon, tags=None):
+    """Return (id, lat, lon) of all nodes inside a bounding box that match
+    the tag filter.
+
+        Args:
+            con: sqlite3 connection of a database with the spatial index
+            min_lat, min_lon, max_lat, max_lon: the box in degrees
+            tags: optional dict of tag filters, see tag_filter
+    """
+    # the R*Tree stores 32 bit floats rounded outwards, the second test on
+    # the exact coordinates of the nodes table drops the few extra matches
+    conditions = ["r.min_lat <= ?", "r.max_lat >= ?", "r.min_lon <= ?", "r.max_lon >= ?",
+                  "n.lat BETWEEN ? AND ?", "n.lon BETWEEN ? AND ?"]
+    params = [max_lat, min_lat, max_lon, min_lon, min_lat, max_lat, min_lon, max_lon]
+    tag_conditions, tag_params = tag_filter(tags)
+    sql = "SELECT n.id, n.lat, n.lon FROM {0} r JOIN nodes n ON n.id = r.id WHERE {1};".format(
+        SPATIAL_INDEX, " AND ".join(conditions + tag_conditions))
+    return con.execute(sql, params + tag_params).fetchall()
+
+###############################################################################
+def nodes_within(con, lat, lon, radius, tags=None):
+    """Return (id, lat, lon, distance in metres) of all nodes within "radius"
+    metres of a point that match the tag filter, nearest first"""
+    found = []
+    for node_id, node_lat, node_lon in nodes_in_bbox(con, *radius_bbox(lat, lon, radius), tags=tags):
+        distance = haversine(lat, lon, node_lat, node_lon)
+        if distance <= radius:
+            found.append((node_id, node_lat, node_lon, distance))
+    found.sort(key=lambda node: (node[3], node[0]))
+    return found
+
+###############################################################################
+def nearest_nodes(con, lat, lon, k=1, tags=None, start_radius=KNN_START_RADIUS):
+    """Return the k nearest nodes to a point that match the tag filter as
+    (id, lat, lon, distance in metres), nearest first.
+
+    The search radius starts at "start_radius" and doubles until k nodes are
+    found within it, so only nodes of the neighbourhood are ever read. If the
+    whole database has less than k matching nodes all of them are returned.
+    """
+    if k < 1:
+        return []
+    total = None
+    radius = start_radius
+    while True:
+        found = nodes_within(con, lat, lon, radius, tags)
+        if len(found) >= k:
+            return found[:k]
+        if radius >= math.pi * EARTH_RADIUS:
+            return found
+        if total is None:
+            total = count_nodes(con, tags)
+        if len(found) == total:
+            return found
+        radius *= 2.0
+
+###############################################################################
+def count_nodes(con, tags=None):
+    """Number of nodes with coordinates that match the tag filter"""
+    tag_conditions, tag_params = tag_filter(tags)
+    sql = "SELECT COUNT(*) FROM {0} n".format(SPATIAL_INDEX)
+    if tag_conditions:
+        sql += " WHERE " + " AND ".join(tag_conditions)
+    return con.execute(sql + ";", tag_params).fetchone()[0]
+
+if __name__ == '__main__':
+
+    con = sqlite3.connect("fk_map")
+    # cafes within 500 m of Schlesisches Tor
+    for node in nodes_within(con, 52.5011, 13.4416, 500, {"amenity": "cafe"}):
+        print(node)
@@ -0,0 +1,412 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# GENERATE A SYNTHETIC .osm FILE OF ANY SIZE FOR BENCHMARKS.
+#
+# - the same seed and number of elements always give the same file
+# - the element mix, tag keys and values follow a city extract like
+#   Friedrichshain-Kreuzberg: most nodes are untagged way nodes, the tagged
+#   ones are addresses, amenities, shops and street furniture, the ways are
+#   mostly buildings and streets
+# - the values the cleaning functions of "audit.py" care about come with
+#   their typical errors ("BERLIN", "Bln.", "GER", "Oranienstrasse", phone
+#   numbers in every format) and some keys have problem characters
+# - nodes, ways and relations are written in id order like real extracts,
+#   ways use runs of neighbouring nodes, a few refer to nodes outside the
+#   extract
+# - the file is streamed, memory does not grow with the number of elements
+#   (10k to 100M). Filenames ending in .gz or .bz2 are compressed.
+#
+# Example:
+#   python synthetic_osm.py synthetic.osm --elements 1000000 --seed 1
+###############################################################################
+
+import argparse
+import bisect
+import bz2
+import gzip
+import random
+from xml.sax.saxutils import quoteattr
+
+# share of nodes and ways of all elements, the rest are relations
+NODE_SHARE = 0.85
+WAY_SHARE = 0.14
+# bounding box of the nodes: min_lat, min_lon, max_lat, max_lon
+BOUNDS = (52.482, 13.368, 52.531, 13.491)
+# first ids, consecutive elements of a type are ID_STEP apart
+NODE_ID_START = 20000000
+WAY_ID_START = 4000000
+RELATION_ID_START = 10000
+ID_STEP = 3
+# share of nodes with tags
+TAGGED_NODES = 0.12
+# share of tagged elements with a key that has problem characters
+PROBLEM_KEYS = 0.01
+# share of ways with one node outside the extract
+MISSING_NODES = 0.02
+# number of different users, a few of them make most of the edits
+USERS = 3000
+# elements collected before they are written
+WRITE_BATCH = 10000
+
+
+class Choice(object):
+    """Weighted random choice from a list of (value, weight) pairs"""
+
+    def __init__(self, pairs):
+        self.values = [value for value, weight in pairs]
+        self.cum_weights = []
+        total = 0.0
+        for value, weight in pairs:
+            total += weight
+            self.cum_weights.append(total)
+        self.total = total
+
+    def __call__(self, rng):
+        return self.values[bisect.bisect(self.cum_weights, rng.random() * self.total)]
+
+###############################################################################
+# TAG VALUES
+
+STREETS = ["Oranienstraße", "Skalitzer Straße", "Bergmannstraße", "Wiener Straße",
+           "Köpenicker Straße", "Falckensteinstraße", "Warschauer Straße", "Boxhagener Straße",
+           "Simon-Dach-Straße", "Frankfurter Allee", "Karl-Marx-Allee", "Revaler Straße",
+           "Gneisenaustraße", "Yorckstraße", "Mehringdamm", "Kottbusser Damm",
+           "Urbanstraße", "Wrangelstraße", "Schlesische Straße", "Paul-Lincke-Ufer",
+           "Fraenkelufer", "Mariannenplatz", "Heinrichplatz", "Görlitzer Straße",
+           "Reichenberger Straße", "Manteuffelstraße", "Adalbertstraße", "Dresdener Straße",
+           "Grünberger Straße", "Kopernikusstraße", "Rigaer Straße", "Samariterstraße",
+           "Petersburger Straße", "Mühlenstraße", "Stralauer Allee", "Holzmarktstraße",
+           "Hasenheide", "Zossener Straße", "Blücherstraße", "Marheinekeplatz"]
+POSTCODES = ["10243", "10245", "10247", "10249", "10785", "10961", "10963",
+             "10965", "10967", "10969", "10997", "10999"]
+
+CITY = Choice([("Berlin", 0.96), ("BERLIN", 0.015), ("Bln.", 0.01), ("Lichtenberg", 0.01),
+               ("berlin", 0.005)])
+COUNTRY = Choice([("DE", 0.97), ("D", 0.01), ("GER", 0.01), ("GE", 0.005), ("Deutschland", 0.005)])
+# how a street name is spelled, see street_name
+STREET_SPELLING = Choice([("ok", 0.9), ("ss", 0.04), ("lower", 0.02), ("number", 0.02),
+                          ("street", 0.01), ("abbreviated", 0.01)])
+# how a phone number is written, see phone_number
+PHONE_FORMAT = Choice([("+49 30 {0}", 0.35), ("030 {0}", 0.2), ("030/{0}", 0.1),
+                       ("+49 (0)30 {0}", 0.05), ("+4930{0}", 0.05), ("{0}", 0.05),
+                       ("+49 1{1} {0}", 0.1), ("01{1} {0}", 0.08), ("+49 030 {0}", 0.02)])
+
+AMENITY = Choice([("bench", 12), ("restaurant", 10), ("cafe", 8), ("waste_basket", 7),
+                  ("bicycle_parking", 7), ("fast_food", 6), ("bar", 5), ("pub", 4),
+                  ("vending_machine", 3), ("post_box", 3), ("kindergarten", 2), ("doctors", 2),
+                  ("pharmacy", 2), ("atm", 2), ("place_of_worship", 1), ("school", 1),
+                  ("recycling", 1), ("dentist", 1), ("ice_cream", 1), ("nightclub", 1),
+                  ("toilets", 1), ("bank", 1), ("library", 0.5), ("theatre", 0.5)])
+SHOP = Choice([("clothes", 8), ("convenience", 7), ("hairdresser", 6), ("bakery", 5),
+               ("kiosk", 5), ("supermarket", 3), ("books", 2), ("bicycle", 2), ("beauty", 2),
+               ("second_hand", 2), ("optician", 1), ("florist", 1), ("tattoo", 1),
+               ("mobile_phone", 1), ("furniture", 1), ("butcher", 0.5)])
+STREET_FURNITURE = Choice([(("highway", "crossing"), 6), (("highway", "traffic_signals"), 4),
+                           (("highway", "bus_stop"), 3), (("highway", "street_lamp"), 3),
+                           (("barrier", "bollard"), 3), (("barrier", "gate"), 1),
+                           (("entrance", "yes"), 2), (("natural", "tree"), 6),
+                           (("railway", "subway_entrance"), 0.5)])
+MISC = Choice([(("created_by", "JOSM"), 2), (("source", "survey"), 2),
+               (("source", "Bing"), 1), (("note", "check opening hours"), 1),
+               (("fixme", "position"), 1), (("name", "Späti"), 1)])
+OPENING_HOURS = Choice([("Mo-Fr 09:00-18:00", 4), ("Mo-Sa 10:00-20:00", 3), ("24/7", 1),
+                        ("Mo-Su 12:00-23:00", 2), ("Tu-Su 18:00+", 1)])
+WHEELCHAIR = Choice([("yes", 3), ("no", 2), ("limited", 1)])
+NAMES = ["Zur Kneipe", "Café Kotti", "Späti am Eck", "Curry 36", "Mustafas", "Markthalle",
+         "Ankerklause", "Café Fleury", "Hops & Barley", "Süß & Salzig", "Bäckerei Müller",
+         "Dr. Schmidt", "Zum \"Goldenen\" Hahn", "Buchladen <Kreuzberg>"]
+# keys with characters PROBLEMCHARS of "parse_to_csv.py" looks for
+PROBLEM_KEY = Choice([("name;de", 2), ("note 2", 2), (".source", 1), ("#fixme", 1),
+                      ("@user", 1), ("addr:street ", 1), ("FIXME?", 1), ("name&co", 1)])
+
+BUILDING = Choice([("yes", 5), ("residential", 3), ("apartments", 3), ("commercial", 1),
+                   ("garage", 1), ("retail", 0.5), ("school", 0.2), ("church", 0.1)])
+HIGHWAY = Choice([("residential", 4), ("footway", 5), ("service", 4), ("path", 2),
+                  ("cycleway", 1), ("tertiary", 1), ("secondary", 1), ("primary", 0.5),
+                  ("steps", 0.5), ("living_street", 0.5), ("pedestrian", 0.3)])
+AREA = Choice([(("landuse", "grass"), 3), (("leisure", "park"), 2), (("leisure", "playground"), 2),
+               (("landuse", "residential"), 1), (("amenity", "parking"), 2), (("natural", "water"), 0.3)])
+LINE = Choice([(("barrier", "fence"), 3), (("barrier", "wall"), 2), (("railway", "subway"), 0.5),
+               (("railway", "tram"), 0.5), (("waterway", "canal"), 0.2)])
+SURFACE = Choice([("asphalt", 4), ("paving_stones", 3), ("sett", 2), ("cobblestone", 1)])
+MAXSPEED = Choice([("30", 4), ("50", 3), ("walk", 1)])
+
+###############################################################################
+# TAGS
+
+def street_name(rng):
+    """A street name, some with the errors update_streetname fixes"""
+    street = rng.choice(STREETS)
+    spelling = STREET_SPELLING(rng)
+    if spelling == "ss":
+        return street.replace("straße", "strasse").replace("Straße", "Strasse")
+    if spelling == "lower":
+        return street.lower()
+    if spelling == "number":
+        return "{0} {1}".format(street, rng.randint(1, 150))
+    if spelling == "street":
+        return street.replace("Straße", "Street").replace("straße", " Street")
+    if spelling == "abbreviated":
+        return street.replace("Straße", "Str.").replace("straße", "str.")
+    return street
+
+
+def phone_number(rng):
+    """A Berlin landline or mobile number in one of many formats"""
+    return PHONE_FORMAT(rng).format(rng.randint(100000, 99999999), rng.randint(50, 79))
+
+
+def address_tags(rng, tags):
+    tags.append(("addr:street", street_name(rng)))
+    tags.append(("addr:housenumber", str(rng.randint(1, 150)) +
+                 ("" if rng.random() < 0.9 else rng.choice("abc"))))
+    tags.append(("addr:postcode", rng.choice(POSTCODES)))
+    if rng.random() < 0.8:
+        tags.append(("addr:city", CITY(rng)))
+    if rng.random() < 0.6:
+        tags.append(("addr:country", COUNTRY(rng)))
+    if rng.random() < 0.3:
+        tags.append(("addr:suburb", rng.choice(["Friedrichshain", "Kreuzberg"])))
+
+
+def poi_tags(rng, tags, key, value):
+    """Tags of an amenity or shop"""
+    tags.append((key, value))
+    if rng.random() < 0.7:
+        tags.append(("name", rng.choice(NAMES)))
+    if rng.random() < 0.35:
+        tags.append(("opening_hours", OPENING_HOURS(rng)))
+    if rng.random() < 0.25:
+        tags.append(("contact:phone", phone_number(rng)))
+    if rng.random() < 0.15:
+        tags.append(("contact:website", "https://example.com/{0}".format(rng.randint(1, 9999))))
+    if rng.random() < 0.05:
+        tags.append(("contact:email", "info@example.{0}".format(rng.choice(["de", "com", "org"]))))
+    if rng.random() < 0.2:
+        tags.append(("wheelchair", WHEELCHAIR(rng)))
+    if rng.random() < 0.5:
+        address_tags(rng, tags)
+
+
+def node_tags(rng):
+    tags = []
+    kind = rng.random()
+    if kind < 0.35:
+        address_tags(rng, tags)
+    elif kind < 0.60:
+        poi_tags(rng, tags, "amenity", AMENITY(rng))
+    elif kind < 0.75:
+        poi_tags(rng, tags, "shop", SHOP(rng))
+    elif kind < 0.95:
+        tags.append(STREET_FURNITURE(rng))
+    else:
+        tags.append(MISC(rng))
+    if rng.random() < PROBLEM_KEYS:
+        tags.append((PROBLEM_KEY(rng), "yes"))
+    return tags
+
+
+def way_tags(rng, kind):
+    tags = []
+    if kind == "building":
+        tags.append(("building", BUILDING(rng)))
+        if rng.random() < 0.4:
+            address_tags(rng, tags)
+        if rng.random() < 0.3:
+            tags.append(("building:levels", str(rng.randint(1, 7))))
+    elif kind == "highway":
+        highway = HIGHWAY(rng)
+        tags.append(("highway", highway))
+        if highway in ("residential", "tertiary", "secondary", "primary", "living_street") \
+                or rng.random() < 0.1:
+            tags.append(("name", rng.choice(STREETS)))
+        if rng.random() < 0.3:
+            tags.append(("surface", SURFACE(rng)))
+        if rng.random() < 0.2:
+            tags.append(("maxspeed", MAXSPEED(rng)))
+        if rng.random() < 0.2:
+            tags.append(("lit", "yes"))
+    elif kind == "area":
+        tags.append(AREA(rng))
+    elif kind == "line":
+        tags.append(LINE(rng))
+    if tags and rng.random() < PROBLEM_KEYS:
+        tags.append((PROBLEM_KEY(rng), "yes"))
+    return tags
+
+###############################################################################
+# ELEMENTS
+
+# some user names are not ascii, the file is utf-8
+USER_NAMES = [quoteattr(("mapper_{0}" if i % 10 else "Björn_{0}").format(i)) for i in range(USERS)]
+
+
+def meta(rng):
+    """The attributes every element has, in the order of a real extract"""
+    user = int(USERS ** rng.random()) - 1
+    # a second of a year of 12 months with 28 days each
+    day, second = divmod(int(rng.random() * 12 * 28 * 86400), 86400)
+    hour, second = divmod(second, 3600)
+    minute, second = divmod(second, 60)
+    return 'version="{0}" timestamp="{1}-{2:02d}-{3:02d}T{4:02d}:{5:02d}:{6:02d}Z" ' \
+        'changeset="{7}" uid="{8}" user={9}'.format(
+            min(int(rng.expovariate(0.6)) + 1, 30), 2017 - min(int(rng.expovariate(0.35)), 9),
+            day // 28 + 1, day % 28 + 1, hour, minute, second,
+            1000000 + int(rng.random() * 49000000), 1000 + user * 7, USER_NAMES[user])
+
+# quoted keys and values, most of them come from the lists above
+QUOTED = {}
+
+
+def quote(text):
+    quoted = QUOTED.get(text)
+    if quoted is None:
+        if len(QUOTED) >= 100000:
+            QUOTED.clear()
+        quoted = QUOTED[text] = quoteattr(text)
+    return quoted
+
+
+def tag_lines(tags):
+    return "".join('    <tag k={0} v={1}/>\n'.format(quote(k), quote(v)) for k, v in tags)
+
+
+def write_nodes(out, rng, count):
+    min_lat, min_lon, max_lat, max_lon = BOUNDS
+    lat = (min_lat + max_lat) / 2.0
+    lon = (min_lon + max_lon) / 2.0
+    batch = []
+    for i in range(count):
+        # a random walk with jumps, neighbouring nodes are close to each other
+        if rng.random() < 0.02:
+            lat = rng.uniform(min_lat, max_lat)
+            lon = rng.uniform(min_lon, max_lon)
+        else:
+            lat = min(max(lat + rng.gauss(0.0, 0.0002), min_lat), max_lat)
+            lon = min(max(lon + rng.gauss(0.0, 0.0003), min_lon), max_lon)
+        head = '  <node id="{0}" lat="{1:.7f}" lon="{2:.7f}" {3}'.format(
+            NODE_ID_START + i * ID_STEP, lat, lon, meta(rng))
+        if rng.random() < TAGGED_NODES:
+            batch.append(head + '>\n' + tag_lines(node_tags(rng)) + '  </node>\n')
+        else:
+            batch.append(head + '/>\n')
+        if len(batch) == WRITE_BATCH:
+            out.write("".join(batch))
+            batch = []
+    out.write("".join(batch))
+
+WAY_KIND = Choice([("building", 0.55), ("highway", 0.3), ("area", 0.06), ("line", 0.06),
+                   ("untagged", 0.03)])
+
+
+def write_ways(out, rng, count, nodes):
+    batch = []
+    for i in range(count):
+        kind = WAY_KIND(rng)
+        if kind == "building":
+            length = rng.randint(4, 11)
+        else:
+            length = min(int(rng.expovariate(0.12)) + 2, 200)
+        # the nodes of a way are a run of nodes around "its" part of the file
+        start = int(i * nodes / float(max(count, 1))) + rng.randint(-50, 50)
+        start = min(max(start, 0), max(nodes - length, 0))
+        refs = [NODE_ID_START + (start + j) * ID_STEP for j in range(min(length, nodes))]
+        if kind in ("building", "area") and refs:
+            refs.append(refs[0])
+        if refs and rng.random() < MISSING_NODES:
+            refs[rng.randrange(len(refs))] = NODE_ID_START + (nodes + rng.randint(0, 1000)) * ID_STEP
+        batch.append('  <way id="{0}" {1}>\n{2}{3}  </way>\n'.format(
+            WAY_ID_START + i * ID_STEP, meta(rng),
+            "".join('    <nd ref="{0}"/>\n'.format(ref) for ref in refs),
+            tag_lines(way_tags(rng, kind))))
+        if len(batch) == WRITE_BATCH:
+            out.write("".join(batch))
+            batch = []
+    out.write("".join(batch))
+
+RELATION_KIND = Choice([("multipolygon", 0.6), ("route", 0.25), ("restriction", 0.15)])
+
+
+def write_relations(out, rng, count, nodes, ways):
+    batch = []
+    for i in range(count):
+        kind = RELATION_KIND(rng)
+        members = []
+        way = lambda: WAY_ID_START + rng.randrange(max(ways, 1)) * ID_STEP
+        if kind == "multipolygon":
+            members.append(("way", way(), "outer"))
+            members.extend(("way", way(), "inner") for j in range(rng.randint(0, 3)))
+            tags = [("type", "multipolygon"), ("building", BUILDING(rng)) if rng.random() < 0.5
+                    else AREA(rng)]
+        elif kind == "route":
+            members.extend(("way", way(), "") for j in range(rng.randint(5, 30)))
+            members.extend(("node", NODE_ID_START + rng.randrange(max(nodes, 1)) * ID_STEP, "stop")
+                           for j in range(rng.randint(0, 8)))
+            tags = [("type", "route"), ("route", rng.choice(["bus", "bicycle", "tram", "subway"])),
+                    ("ref", str(rng.randint(1, 300))), ("name", rng.choice(STREETS))]
+        else:
+            members = [("way", way(), "from"),
+                       ("node", NODE_ID_START + rng.randrange(max(nodes, 1)) * ID_STEP, "via"),
+                       ("way", way(), "to")]
+            tags = [("type", "restriction"),
+                    ("restriction", rng.choice(["no_left_turn", "no_u_turn", "only_straight_on"]))]
+        batch.append('  <relation id="{0}" {1}>\n{2}{3}  </relation>\n'.format(
+            RELATION_ID_START + i * ID_STEP, meta(rng),
+            "".join('    <member type="{0}" ref="{1}" role="{2}"/>\n'.format(*member)
+                    for member in members),
+            tag_lines(tags)))
+        if len(batch) == WRITE_BATCH:
+            out.write("".join(batch))
+            batch = []
+    out.write("".join(batch))
+
+###############################################################################
+def element_counts(elements):
+    """Number of nodes, ways and relations of a file with "elements" elements"""
+    nodes = int(round(elements * NODE_SHARE))
+    ways = min(int(round(elements * WAY_SHARE)), elements - nodes)
+    return nodes, ways, elements - nodes - ways
+
+
+def open_output(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", newline="\n")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "wt", encoding="utf-8", newline="\n")
+    return open(path, "w", encoding="utf-8", newline="\n")
+
+
+def generate(path, elements, seed=1):
+    """Write a synthetic .osm file with "elements" top level elements.
+
+        Output:
+            (nodes, ways, relations) written
+    """
+    rng = random.Random(seed)
+    nodes, ways, relations = element_counts(elements)
+    with open_output(path) as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<osm version="0.6" generator="synthetic_osm.py">\n'
+                  ' <bounds minlat="{0}" minlon="{1}" maxlat="{2}" maxlon="{3}"/>\n'.format(*BOUNDS))
+        write_nodes(out, rng, nodes)
+        write_ways(out, rng, ways, nodes)
+        write_relations(out, rng, relations, nodes, ways)
+        out.write('</osm>\n')
+    return nodes, ways, relations
+
+###############################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic .osm file")
+    parser.add_argument("osm_file")
+    parser.add_argument("--elements", type=int, default=100000,
+                        help="number of nodes, ways and relations together")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    nodes, ways, relations = generate(args.osm_file, args.elements, args.seed)
+    print("wrote {0} nodes, {1} ways and {2} relations to {3}".format(
+        nodes, ways, relations, args.osm_file))
+
+if __name__ == '__main__':
+    main()
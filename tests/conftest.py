@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the scripts of the project live in the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,187 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# WRITE THE PBF FIXTURES OF THE TESTS FROM A SMALL .osm FILE.
+#
+# A minimal PBF encoder, only used to (re)build the fixtures next to it:
+#
+#   small_dense_zlib.osm.pbf   dense nodes, zlib compressed blobs
+#   small_plain_raw.osm.pbf    plain nodes, uncompressed (raw) blobs
+#
+# Every block holds at most PER_BLOCK elements of one type, so the fixtures
+# have several blobs and the deltas start again in each of them.
+#
+# Example:
+#   python tests/fixtures/make_pbf.py
+###############################################################################
+
+import calendar
+import os
+import struct
+import time
+import zlib
+import xml.etree.ElementTree as ET
+
+FIXTURES = os.path.dirname(os.path.abspath(__file__))
+GRANULARITY = 100
+MEMBER_TYPES = ['node', 'way', 'relation']
+PER_BLOCK = 2
+
+
+def varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field_varint(number, value):
+    return varint(number << 3) + varint(value)
+
+
+def field_bytes(number, data):
+    return varint((number << 3) | 2) + varint(len(data)) + data
+
+
+def field_packed(number, values):
+    if not values:
+        return b''
+    return field_bytes(number, b''.join(varint(v) for v in values))
+
+
+def deltas(values):
+    out, last = [], 0
+    for value in values:
+        out.append(zigzag(value - last))
+        last = value
+    return out
+
+
+def seconds(timestamp):
+    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def coordinate(text):
+    return int(round(float(text) * 1e9 / GRANULARITY))
+
+
+class StringTable(object):
+    def __init__(self):
+        self.index = {'': 0}
+        self.strings = ['']
+
+    def __call__(self, text):
+        if text not in self.index:
+            self.index[text] = len(self.strings)
+            self.strings.append(text)
+        return self.index[text]
+
+
+def blob(blob_type, data, compress):
+    if compress:
+        body = field_varint(2, len(data)) + field_bytes(3, zlib.compress(data))
+    else:
+        body = field_bytes(1, data)
+    header = field_bytes(1, blob_type.encode()) + field_varint(3, len(body))
+    return struct.pack('>I', len(header)) + header + body
+
+
+def info(element, strings):
+    return field_bytes(4, field_varint(1, int(element.get('version'))) +
+                       field_varint(2, seconds(element.get('timestamp'))) +
+                       field_varint(3, int(element.get('changeset'))) +
+                       field_varint(4, int(element.get('uid'))) +
+                       field_varint(5, strings(element.get('user'))))
+
+
+def tag_fields(element, strings):
+    tags = element.findall('tag')
+    return (field_packed(2, [strings(t.get('k')) for t in tags]) +
+            field_packed(3, [strings(t.get('v')) for t in tags]))
+
+
+def dense_group(nodes, strings):
+    keys_vals = []
+    for node in nodes:
+        for tag in node.findall('tag'):
+            keys_vals += [strings(tag.get('k')), strings(tag.get('v'))]
+        keys_vals.append(0)
+    dense_info = (field_packed(1, [int(n.get('version')) for n in nodes]) +
+                  field_packed(2, deltas([seconds(n.get('timestamp')) for n in nodes])) +
+                  field_packed(3, deltas([int(n.get('changeset')) for n in nodes])) +
+                  field_packed(4, deltas([int(n.get('uid')) for n in nodes])) +
+                  field_packed(5, deltas([strings(n.get('user')) for n in nodes])))
+    dense = (field_packed(1, deltas([int(n.get('id')) for n in nodes])) +
+             field_bytes(5, dense_info) +
+             field_packed(8, deltas([coordinate(n.get('lat')) for n in nodes])) +
+             field_packed(9, deltas([coordinate(n.get('lon')) for n in nodes])) +
+             field_packed(10, keys_vals))
+    return field_bytes(2, dense)
+
+
+def node_group(nodes, strings):
+    return b''.join(field_bytes(1, field_varint(1, zigzag(int(n.get('id')))) +
+                                tag_fields(n, strings) + info(n, strings) +
+                                field_varint(8, zigzag(coordinate(n.get('lat')))) +
+                                field_varint(9, zigzag(coordinate(n.get('lon')))))
+                    for n in nodes)
+
+
+def way_group(ways, strings):
+    return b''.join(field_bytes(3, field_varint(1, int(w.get('id'))) +
+                                tag_fields(w, strings) + info(w, strings) +
+                                field_packed(8, deltas([int(nd.get('ref')) for nd in w.findall('nd')])))
+                    for w in ways)
+
+
+def relation_group(relations, strings):
+    return b''.join(field_bytes(4, field_varint(1, int(r.get('id'))) +
+                                tag_fields(r, strings) + info(r, strings) +
+                                field_packed(8, [strings(m.get('role')) for m in r.findall('member')]) +
+                                field_packed(9, deltas([int(m.get('ref')) for m in r.findall('member')])) +
+                                field_packed(10, [MEMBER_TYPES.index(m.get('type'))
+                                                  for m in r.findall('member')]))
+                    for r in relations)
+
+
+def primitive_block(elements, dense):
+    strings = StringTable()
+    tag = elements[0].tag
+    if tag == 'node':
+        group = dense_group(elements, strings) if dense else node_group(elements, strings)
+    elif tag == 'way':
+        group = way_group(elements, strings)
+    else:
+        group = relation_group(elements, strings)
+    table = b''.join(field_bytes(1, s.encode('utf-8')) for s in strings.strings)
+    return field_bytes(1, table) + field_bytes(2, group) + field_varint(17, GRANULARITY)
+
+
+def write_pbf(osm_path, pbf_path, dense, compress):
+    """Write the nodes, ways and relations of a .osm file as PBF"""
+    root = ET.parse(osm_path).getroot()
+    with open(pbf_path, 'wb') as out:
+        out.write(blob('OSMHeader', field_bytes(4, b'OsmSchema-V0.6') +
+                       field_bytes(4, b'DenseNodes'), compress))
+        for tag in MEMBER_TYPES:
+            elements = root.findall(tag)
+            for i in range(0, len(elements), PER_BLOCK):
+                out.write(blob('OSMData', primitive_block(elements[i:i + PER_BLOCK], dense),
+                               compress))
+
+
+if __name__ == '__main__':
+    source = os.path.join(FIXTURES, 'small.osm')
+    write_pbf(source, os.path.join(FIXTURES, 'small_dense_zlib.osm.pbf'), True, True)
+    write_pbf(source, os.path.join(FIXTURES, 'small_plain_raw.osm.pbf'), False, False)
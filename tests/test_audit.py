@@ -0,0 +1,70 @@
+import csv
+import os
+import xml.etree.ElementTree as ET
+from collections import Counter
+
+import pytest
+
+import audit
+from audit import CountTags, run_audit
+from conftest import FIXTURES
+
+OSM = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+ <note>The data is made available under ODbL.</note>
+ <meta osm_base="2017-01-01T00:00:00Z"/>
+ <bounds minlat="52.49" minlon="13.40" maxlat="52.52" maxlon="13.45"/>
+ <node id="1" lat="52.5" lon="13.4" version="1" timestamp="2015-03-06T10:00:00Z" changeset="1" uid="1" user="a"><tag k="amenity" v="cafe"/></node>
+ <node id="2" lat="52.5" lon="13.4" version="1" timestamp="2015-03-06T10:00:00Z" changeset="1" uid="1" user="a"/>
+ <way id="3" version="1" timestamp="2015-03-06T10:00:00Z" changeset="1" uid="1" user="a"><nd ref="1"/><nd ref="2"/><tag k="highway" v="path"/><extra/></way>
+ <relation id="4" version="1" timestamp="2015-03-06T10:00:00Z" changeset="1" uid="1" user="a"><member type="way" ref="3" role=""/></relation>
+</osm>
+"""
+
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        return [(name, int(n)) for name, n in list(csv.reader(f))[1:]]
+
+
+@pytest.mark.parametrize('osm_name', ['odd.osm', 'small.osm'])
+@pytest.mark.parametrize('parser', ['expat', 'etree'])
+def test_count_tags_counts_every_element(tmp_path, osm_name, parser):
+    if osm_name == 'odd.osm':
+        osm_path = str(tmp_path / osm_name)
+        with open(osm_path, 'w', encoding='utf-8') as out:
+            out.write(OSM)
+    else:
+        osm_path = os.path.join(FIXTURES, osm_name)
+    rule = CountTags(str(tmp_path / 'tags.csv'))
+    run_audit(osm_path, [rule], parser=parser)
+    # the counts of the iterparse pass the audit started with
+    counts = Counter(element.tag for event, element in ET.iterparse(osm_path))
+    expected = sorted(counts.items(), key=lambda x: x[1], reverse=True)
+    assert read_rows(rule.outputname) == expected
+
+
+def test_count_tags_of_pbf(tmp_path):
+    rule = CountTags(str(tmp_path / 'tags.csv'))
+    run_audit(os.path.join(FIXTURES, 'small_dense_zlib.osm.pbf'), [rule])
+    assert dict(read_rows(rule.outputname)) == {'osm': 1, 'node': 5, 'way': 2, 'relation': 1,
+                                                'tag': 12, 'nd': 7, 'member': 2}
+
+
+def fake_peaks(monkeypatch, peaks):
+    """peak_memory_mb returns "peaks" one after the other, the first one is
+    the peak at the start of the audit"""
+    peaks = iter(peaks)
+    monkeypatch.setattr(audit, 'peak_memory_mb', lambda: next(peaks))
+    monkeypatch.setattr(audit, 'MEMORY_CHECK_EVERY', 1)
+
+
+def test_memory_limit_applies_to_the_growth_of_the_peak(tmp_path, monkeypatch):
+    osm_path = os.path.join(FIXTURES, 'small.osm')
+    # the process used 500 MB before the audit, which adds 40 MB
+    fake_peaks(monkeypatch, [500.0] + [540.0] * 20)
+    run_audit(osm_path, [CountTags(str(tmp_path / 'tags.csv'))], max_memory_mb=50)
+
+    fake_peaks(monkeypatch, [500.0, 520.0, 560.0] + [560.0] * 20)
+    with pytest.raises(MemoryError, match='more than 50 MB'):
+        run_audit(osm_path, [CountTags(str(tmp_path / 'tags.csv'))], max_memory_mb=50)
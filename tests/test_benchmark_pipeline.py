@@ -0,0 +1,52 @@
+import pytest
+
+from benchmark_pipeline import PASSES, benchmark, compare
+from synthetic_osm import generate
+
+
+def stage(name, items_per_second, peak_mb):
+    return {"name": name, "pass": name, "seconds": 1.0, "items": items_per_second,
+            "items_per_second": items_per_second, "peak_mb": peak_mb}
+
+
+def test_compare():
+    baseline = [stage("parse", 1000.0, 100.0), stage("load", 500.0, 200.0),
+                stage("audit", 100.0, 50.0), stage("queries", 10.0, 10.0),
+                stage("gone", 10.0, 10.0)]
+    report = [stage("parse", 2000.0, 50.0),   # faster, half the memory
+              stage("load", 440.0, 200.0),    # 12% slower
+              stage("audit", 95.0, 54.0),     # within the tolerance
+              stage("new", 1.0, 1.0),         # not in the baseline
+              stage("queries", None, None)]
+    assert compare(report, baseline) == ["load"]
+    parse, load, audit, new, queries = report
+    assert parse["speedup"] == pytest.approx(2.0)
+    assert parse["memory_ratio"] == pytest.approx(0.5)
+    assert parse["baseline_items_per_second"] == 1000.0
+    assert parse["baseline_peak_mb"] == 100.0
+    assert load["speedup"] == pytest.approx(0.88)
+    assert load["regression"] and not parse["regression"] and not audit["regression"]
+    assert "speedup" not in new
+    assert queries["speedup"] is None and queries["memory_ratio"] is None
+    assert not queries["regression"]
+
+
+def test_compare_tolerance():
+    baseline = [stage("parse", 1000.0, 100.0), stage("load", 1000.0, 100.0)]
+    report = [stage("parse", 940.0, 100.0), stage("load", 1000.0, 106.0)]
+    assert compare(report, baseline, tolerance=0.10) == []
+    assert compare(report, baseline, tolerance=0.05) == ["parse", "load"]
+
+
+def test_benchmark_smoke(tmp_path):
+    osm_path = str(tmp_path / "synthetic.osm")
+    generate(osm_path, 300)
+    report = benchmark(osm_path, str(tmp_path), PASSES)
+    names = [entry["name"] for entry in report]
+    assert names[:2] == ["get_element", "parse"]
+    for name in ["process_map", "load_into_sql", "audit", "queries_raw", "optimize",
+                 "queries_reports"]:
+        assert name in names
+    for entry in report:
+        assert entry["seconds"] >= 0 and entry["items"] > 0
+    assert compare(report, report) == []
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+import osm_io
+import parse_to_csv
+from checkpoint import Checkpoint
+from parse_to_csv import CsvSink, process_map
+from synthetic_osm import generate
+
+TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags']
+BLOCK_SIZE = 16 * 1024
+# blocks converted before the run is interrupted
+INTERRUPT_AFTER = 8
+
+
+class Interrupted(Exception):
+    pass
+
+
+def small_blocks(interrupt_after=None):
+    """element_blocks with small blocks that raises Interrupted after a
+    number of blocks, like a run that is killed"""
+    def blocks(source, block_size=BLOCK_SIZE, start=None):
+        for count, item in enumerate(osm_io.element_blocks(source, BLOCK_SIZE, start)):
+            if count == interrupt_after:
+                raise Interrupted()
+            yield item
+    return blocks
+
+
+def first_checkpoints(self):
+    # two checkpoints at the start of a run and none after them, so the
+    # interrupted run has written more than its checkpoint
+    return self.count < 2
+
+
+def csv_paths(directory):
+    directory.mkdir()
+    return [str(directory / (table + '.csv')) for table in TABLES]
+
+
+def read_all(paths):
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+
+@pytest.fixture(scope='module')
+def osm_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('osm') / 'synthetic.osm')
+    generate(path, 3000)
+    return path
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_resume_gives_same_csvs(osm_path, tmp_path, monkeypatch, workers):
+    expected_paths = csv_paths(tmp_path / 'expected')
+    process_map(osm_path, True, sink=CsvSink(expected_paths), report=None)
+
+    monkeypatch.setattr(Checkpoint, 'due', first_checkpoints)
+    monkeypatch.setattr(parse_to_csv, 'element_blocks', small_blocks(INTERRUPT_AFTER))
+    paths = csv_paths(tmp_path / 'resumed')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    with pytest.raises(Interrupted):
+        process_map(osm_path, True, workers=workers, sink=CsvSink(paths), report=None,
+                    checkpoint=checkpoint)
+    with open(checkpoint) as f:
+        state = json.load(f)
+    assert state['paths'] == paths
+    assert any(os.path.getsize(path) > position
+               for path, position in zip(paths, state['positions']))
+
+    monkeypatch.setattr(parse_to_csv, 'element_blocks', small_blocks())
+    summary = process_map(osm_path, True, workers=workers, report=None,
+                          checkpoint=checkpoint, resume=True)
+    assert summary['resumed_at'] == state['offset']
+    assert summary['pipeline'] == (workers > 1)
+    assert not os.path.exists(checkpoint)
+    assert read_all(paths) == read_all(expected_paths)
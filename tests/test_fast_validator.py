@@ -0,0 +1,113 @@
+import cerberus
+import pytest
+
+import schema
+from fast_validator import FastValidator
+from parse_to_csv import NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS
+from parse_to_csv import WAY_TAGS_FIELDS, ShapedElement
+
+NODE = ShapedElement('node', ('-3', '52.5023456', '13.4012345', 'Anna', '42', '2', '28000000',
+                              '2015-03-06T10:00:01Z'),
+                     [('-3', 'street', 'Oranienstraße', 'addr'), ('-3', 'amenity', 'cafe', 'regular')])
+WAY = ShapedElement('way', ('9876543210', 'Jörg', '2147483647', '4', '150000000',
+                            '2024-05-01T12:31:00Z'),
+                    [('9876543210', 'building', 'yes', 'regular')],
+                    [('9876543210', '-7', '0'), ('9876543210', '12345678901', '1')])
+
+
+def node(**changes):
+    document = NODE.as_dict()
+    document['node'].update(changes)
+    return document
+
+
+def way(**changes):
+    document = WAY.as_dict()
+    document['way'].update(changes)
+    return document
+
+
+def with_tag(document, name, **changes):
+    document[name][0].update(changes)
+    return document
+
+
+def without(document, name, field):
+    del document[name][field]
+    return document
+
+
+DOCUMENTS = {
+    'valid node': node(),
+    'valid way': way(),
+    'valid native types': node(id=-3, lat=52.5, lon=13, uid=42, changeset=1),
+    'none value': node(user=None),
+    'none coerced value': node(lat=None),
+    'wrong type': node(version=2),
+    'wrong nested type': with_tag(node(), 'node_tags', value=7),
+    'coercion fails': node(lat='north', uid='x'),
+    'nested coercion fails': with_tag(way(), 'way_nodes', node_id='n1', position=None),
+    'nested coercion and type fail': with_tag(way(), 'way_nodes', node_id=[1]),
+    'unknown field': node(colour='red'),
+    'unknown nested field': with_tag(way(), 'way_tags', colour='red'),
+    'unknown top level field': dict(node(), extra={}),
+    'missing field': without(node(), 'node', 'timestamp'),
+    'missing nested field': dict(way(), way_nodes=[{'id': '1', 'node_id': '2'}]),
+    'tags not a list': dict(node(), node_tags={'id': 1}),
+}
+
+
+@pytest.mark.parametrize('name', sorted(DOCUMENTS))
+def test_same_result_as_cerberus(name):
+    document = DOCUMENTS[name]
+    expected = cerberus.Validator()
+    fast = FastValidator()
+    result = fast.validate(document, schema.schema)
+    assert result == expected.validate(document, schema.schema)
+    assert fast.errors == expected.errors
+    assert result == name.startswith('valid')
+
+
+def test_validate_batch():
+    names = sorted(DOCUMENTS)
+    fast = FastValidator(schema.schema)
+    invalid = fast.validate_batch([DOCUMENTS[name] for name in names])
+    for index, errors in invalid:
+        validator = cerberus.Validator()
+        assert not validator.validate(DOCUMENTS[names[index]], schema.schema)
+        assert errors == validator.errors
+    assert len(invalid) == len([name for name in names if not name.startswith('valid')])
+
+
+ROWS = [
+    ('node', NODE_FIELDS, NODE.row, True),
+    ('node', NODE_FIELDS, NODE.row[:1] + ('north',) + NODE.row[2:], False),
+    ('node', NODE_FIELDS, NODE.row[:3] + (None,) + NODE.row[4:], False),
+    ('node', NODE_FIELDS, NODE.row[:5] + (2,) + NODE.row[6:], False),
+    ('node', NODE_FIELDS, NODE.row[:-1], False),
+    ('node', NODE_FIELDS[:-1], NODE.row[:-1], False),
+    ('node_tags', NODE_TAGS_FIELDS, NODE.tags[0], True),
+    ('node_tags', NODE_TAGS_FIELDS, ('x',) + NODE.tags[0][1:], False),
+    ('node_tags', NODE_TAGS_FIELDS + ['colour'], NODE.tags[0] + ('red',), False),
+    ('way', WAY_FIELDS, WAY.row, True),
+    ('way', WAY_FIELDS, WAY.row[:2] + ('2.5',) + WAY.row[3:], False),
+    ('way_nodes', WAY_NODES_FIELDS, WAY.nodes[1], True),
+    ('way_nodes', WAY_NODES_FIELDS, WAY.nodes[1][:2] + (None,), False),
+    ('way_tags', WAY_TAGS_FIELDS, WAY.tags[0], True),
+    ('way_tags', WAY_TAGS_FIELDS, WAY.tags[0][:2] + (None,) + WAY.tags[0][3:], False),
+]
+
+
+@pytest.mark.parametrize('name, fields, row, valid', ROWS)
+def test_row_checker_agrees_with_validate(name, fields, row, valid):
+    fast = FastValidator(schema.schema)
+    # the same row as a document, the other fields come from a valid element
+    document = (NODE if name.startswith('node') else WAY).as_dict()
+    item = dict(zip(fields, row))
+    if isinstance(document[name], list):
+        document[name] = [item]
+    else:
+        document[name] = item
+    assert fast.row_checker(name, fields)(row) == valid
+    assert fast.validate(document) == valid
+    assert cerberus.Validator().validate(document, schema.schema) == valid
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from conftest import FIXTURES
+from osm_io import PARSERS
+from osm_pbf import pbf_records
+from parse_to_csv import CsvSink, process_map
+
+XML_PATH = os.path.join(FIXTURES, 'small.osm')
+# written by fixtures/make_pbf.py from small.osm
+PBF_PATHS = [os.path.join(FIXTURES, 'small_dense_zlib.osm.pbf'),
+             os.path.join(FIXTURES, 'small_plain_raw.osm.pbf')]
+TABLES = ['nodes', 'nodes_tags', 'ways', 'ways_nodes', 'ways_tags']
+
+
+def as_tuples(records):
+    return [(r.tag, r.attrib, r.tags, r.nds, r.members) for r in records]
+
+
+def convert(file_in, directory):
+    paths = [str(directory / (table + '.csv')) for table in TABLES]
+    process_map(file_in, validate=True, sink=CsvSink(paths), report=None)
+    csvs = {}
+    for table, path in zip(TABLES, paths):
+        with open(path, 'rb') as f:
+            csvs[table] = f.read()
+    return csvs
+
+
+@pytest.mark.parametrize('pbf_path', PBF_PATHS)
+def test_records_match_xml(pbf_path):
+    expected = as_tuples(PARSERS['expat'](XML_PATH, ('node', 'way', 'relation')))
+    records = as_tuples(pbf_records(pbf_path, workers=1))
+    assert records == expected
+    ids = [attrib['id'] for tag, attrib, tags, nds, members in records]
+    # negative ids and ids beyond 32 bit survive the delta coding
+    assert '-7' in ids and '12345678901' in ids and '9876543210' in ids
+
+
+@pytest.mark.parametrize('pbf_path', PBF_PATHS)
+def test_records_filter_tags(pbf_path):
+    records = as_tuples(pbf_records(pbf_path, ('way',), workers=1))
+    assert [attrib['id'] for tag, attrib, tags, nds, members in records] == ['-11', '9876543210']
+    assert records[0][3] == ['-7', '-3', '12345678901', '-7']
+
+
+@pytest.mark.parametrize('pbf_path', PBF_PATHS)
+def test_process_map_matches_xml(pbf_path, tmp_path):
+    (tmp_path / 'xml').mkdir()
+    (tmp_path / 'pbf').mkdir()
+    expected = convert(XML_PATH, tmp_path / 'xml')
+    csvs = convert(pbf_path, tmp_path / 'pbf')
+    assert csvs['nodes'].count(b'\n') == 6
+    assert csvs['ways_nodes'].count(b'\n') == 8
+    assert csvs == expected
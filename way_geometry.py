@@ -0,0 +1,152 @@
+###############################################################################
+# WRANGLE OPEN STREET MAP DATA FOR FRIEDRICHSHAIN-KREUZBERG ###################
+###############################################################################
+# RESOLVE THE GEOMETRY OF ALL WAYS WITHOUT A DATABASE JOIN.
+#
+# - a sorted node id -> (lat, lon) index is built from the columnar node store
+#   of "node_store.py" (or from nodes.csv)
+# - "ways_nodes.csv" is read in chunks, the node ids of each chunk are looked
+#   up at once with a vectorized binary search (np.searchsorted)
+# - per way the bounding box, the length in metres (haversine), whether the
+#   way is closed and how many of its nodes are missing from the extract are
+#   computed with np.*.reduceat over the way boundaries
+###############################################################################
+
+import numpy as np
+import pandas as pd
+from node_store import open_node_store
+
+NODE_STORE = "nodes_store"
+NODES_PATH = "nodes.csv"
+WAY_NODES_PATH = "ways_nodes.csv"
+GEOMETRY_PATH = "ways_geometry.csv"
+
+# mean earth radius in metres
+EARTH_RADIUS = 6371008.8
+# number of ways_nodes rows resolved at a time
+GEOMETRY_CHUNK = 5000000
+
+GEOMETRY_FIELDS = ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+                   'length_m', 'closed', 'nodes', 'missing_nodes']
+
+
+class NodeIndex(object):
+    """Node ids sorted ascending with their coordinates in degrees"""
+
+    def __init__(self, ids, lat, lon):
+        ids = np.asarray(ids)
+        if len(ids) > 1 and not (ids[1:] > ids[:-1]).all():
+            order = np.argsort(ids, kind='stable')
+            ids, lat, lon = ids[order], np.asarray(lat)[order], np.asarray(lon)[order]
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+
+    @classmethod
+    def from_store(cls, directory=NODE_STORE):
+        """Build the index from a node store, ids stay memory mapped"""
+        meta, columns = open_node_store(directory)
+        scale = float(meta['coordinate_scale'])
+        return cls(columns['id'], columns['lat'] / scale, columns['lon'] / scale)
+
+    @classmethod
+    def from_csv(cls, filename=NODES_PATH):
+        """Build the index from nodes.csv"""
+        nodes = pd.read_csv(filename, usecols=['id', 'lat', 'lon'],
+                            dtype={'id': np.int64, 'lat': np.float64, 'lon': np.float64})
+        return cls(nodes['id'].values, nodes['lat'].values, nodes['lon'].values)
+
+    def lookup(self, node_ids):
+        """Return lat, lon (NaN for unknown nodes) and a mask of found ids"""
+        ids = self.ids
+        if len(ids) == 0:
+            missing = np.full(len(node_ids), np.nan)
+            return missing, missing.copy(), np.zeros(len(node_ids), dtype=bool)
+        pos = np.searchsorted(ids, node_ids)
+        np.clip(pos, 0, len(ids) - 1, out=pos)
+        found = ids[pos] == node_ids
+        lat = np.where(found, self.lat[pos], np.nan)
+        lon = np.where(found, self.lon[pos], np.nan)
+        return lat, lon, found
+
+###############################################################################
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in metres between arrays of points in degrees"""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+###############################################################################
+def resolve_chunk(index, way_ids, node_ids, positions):
+    """Compute the geometry of complete ways from their ways_nodes rows.
+
+        Output:
+            dict of arrays with one entry per way, keys are GEOMETRY_FIELDS
+    """
+    order = np.lexsort((positions, way_ids))
+    way_ids, node_ids = way_ids[order], node_ids[order]
+    n = len(way_ids)
+    starts = np.flatnonzero(np.r_[True, way_ids[1:] != way_ids[:-1]])
+    ends = np.r_[starts[1:], n] - 1
+
+    lat, lon, found = index.lookup(node_ids)
+    # segments between consecutive nodes of the same way, unknown nodes add 0
+    same_way = way_ids[1:] == way_ids[:-1]
+    segments = np.nan_to_num(haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]))
+    segments[~same_way] = 0.0
+    segments = np.r_[segments, 0.0]
+
+    with np.errstate(invalid='ignore'):
+        return {
+            'id': way_ids[starts],
+            'min_lat': np.fmin.reduceat(lat, starts),
+            'min_lon': np.fmin.reduceat(lon, starts),
+            'max_lat': np.fmax.reduceat(lat, starts),
+            'max_lon': np.fmax.reduceat(lon, starts),
+            'length_m': np.add.reduceat(segments, starts),
+            'closed': (node_ids[starts] == node_ids[ends]) & (ends > starts),
+            'nodes': ends - starts + 1,
+            'missing_nodes': np.add.reduceat(~found, starts),
+        }
+
+###############################################################################
+def resolve_ways(index, way_nodes_path=WAY_NODES_PATH, geometry_path=GEOMETRY_PATH,
+                 chunk_rows=GEOMETRY_CHUNK):
+    """Resolve the geometry of every way of ways_nodes.csv and write it to a
+    csv file. The rows of the last way of a chunk are carried over to the
+    next chunk, so ways split between two chunks are resolved complete.
+
+        Output:
+            number of ways resolved
+    """
+    reader = pd.read_csv(way_nodes_path, dtype=np.int64, chunksize=chunk_rows)
+    carry = None
+    count = 0
+    header = True
+    with open(geometry_path, 'w', newline='', encoding='utf-8') as out:
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            last = chunk['id'].values[-1]
+            carry = chunk[chunk['id'] == last]
+            chunk = chunk[chunk['id'] != last]
+            if len(chunk):
+                count += write_geometry(index, chunk, out, header)
+                header = False
+        if carry is not None and len(carry):
+            count += write_geometry(index, carry, out, header)
+    return count
+
+###############################################################################
+def write_geometry(index, chunk, out, header):
+    """Resolve a chunk of complete ways and append it to the csv file"""
+    geometry = resolve_chunk(index, chunk['id'].values, chunk['node_id'].values,
+                             chunk['position'].values)
+    frame = pd.DataFrame(geometry, columns=GEOMETRY_FIELDS)
+    frame['closed'] = frame['closed'].astype(int)
+    frame.to_csv(out, header=header, index=False, float_format='%.7f')
+    return len(frame)
+
+if __name__ == '__main__':
+    resolve_ways(NodeIndex.from_store(NODE_STORE))